@@ -5,10 +5,16 @@ import sys
 _PROCESS_IS_64_BITS = sys.maxsize > 2 ** 32
 
 from .win32   import *
+from .backend import *
 from .process import *
 from .module  import *
+from .pe      import *
 from .scanner import *
 from .thread  import *
 from .memory  import *
 from .function_caller import *
-from .remote_class import *
\ No newline at end of file
+from .remote_class import *
+from .pointer import *
+from .snapshot import *
+from .value_scan import *
+from .ring import *
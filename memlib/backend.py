@@ -0,0 +1,319 @@
+from . import win32
+from . import linux
+from . import utils
+from ctypes import (
+    addressof,
+    byref,
+    sizeof
+)
+
+import os
+import errno
+import ctypes
+
+from .module import (
+    ProcessModule
+)
+
+from .memory import (
+    MemoryRegion
+)
+
+
+class UnsupportedOperation(RuntimeError):
+    """Raised for the operations that aren't supported by the backend or the platform."""
+    pass
+
+
+class MemoryBackend(object):
+    """
+    Interface used by a Process to access the memory of the remote process.
+
+    A backend only moves bytes around, all the decoding is done by Process.
+
+    Properties:
+        - pid
+        - handle
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.handle = None
+
+    def __repr__(self):
+        return "<%s for Process %d>" % (type(self).__name__, self.pid)
+
+    def close(self):
+        """Releases the resources held by the backend."""
+        pass
+
+    def read_into(self, addr, buffer, size):
+        """Reads size bytes at addr into buffer, a ctypes object or a writable bytes-like object."""
+        raise NotImplementedError()
+
+    def read(self, addr, size):
+        """Reads size bytes at addr and returns them as bytes."""
+        buffer = utils.create_buffer(size)
+        self.read_into(addr, buffer, size)
+        return buffer.raw
+
+    def readv(self, ranges, buffer):
+        """Reads every (addr, size) of ranges back to back into the ctypes object buffer."""
+        base = addressof(buffer)
+        offset = 0
+        for addr, size in ranges:
+            self.read_into(addr, (ctypes.c_char * size).from_address(base + offset), size)
+            offset += size
+
+    def write(self, addr, data):
+        """Writes the bytes data at addr."""
+        raise NotImplementedError()
+
+    def query(self, addr):
+        """Returns (size, access right) about the range of pages containing addr."""
+        raise NotImplementedError()
+
+    def regions(self):
+        """Yields the MemoryRegion's of the whole address space, sorted by address."""
+        raise NotImplementedError()
+
+    def alloc(self, size, addr=None, protect=win32.PAGE_EXECUTE_READWRITE):
+        """Allocates size bytes in the remote process and returns their address."""
+        raise NotImplementedError()
+
+    def free(self, addr):
+        """Releases memory previously returned by alloc."""
+        raise NotImplementedError()
+
+    def flush(self, addr=None, size=0):
+        """Flushes the instruction cache of the remote process."""
+        pass
+
+    def modules(self, process):
+        """Returns the ProcessModule's list of the process, starting with the main module."""
+        raise NotImplementedError()
+
+
+class Win32Backend(MemoryBackend):
+    """
+    Backend built on ReadProcessMemory/WriteProcessMemory and friends.
+    """
+
+    def __init__(self, pid, right=win32.PROCESS_ALL_ACCESS):
+        super(Win32Backend, self).__init__(pid)
+        self.handle = win32.OpenProcess(right, False, pid)
+        if not self.handle:
+            raise win32.Win32Exception()
+
+    def close(self):
+        if self.handle:
+            win32.CloseHandle(self.handle)
+            self.handle = None
+
+    def read_into(self, addr, buffer, size):
+        try:
+            pointer = byref(buffer)
+        except TypeError:
+            # Not a ctypes object, but a writable bytes-like object.
+            pointer = byref((ctypes.c_char * size).from_buffer(buffer))
+        success = win32.ReadProcessMemory(self.handle, addr, pointer, size, None)
+        if not success:
+            raise win32.Win32Exception()
+
+    def write(self, addr, data):
+        success = win32.WriteProcessMemory(self.handle, addr, data, len(data), None)
+        if not success:
+            raise win32.Win32Exception()
+
+    def _virtual_query(self, addr):
+        if not win32.PROCESS_IS_64_BITS:
+            buffer = win32.MEMORY_BASIC_INFORMATION()
+        else:
+            buffer = win32.MEMORY_BASIC_INFORMATION64()
+        if not win32.VirtualQueryEx(self.handle, addr, byref(buffer), sizeof(buffer)):
+            return None
+        return buffer
+
+    def query(self, addr):
+        buffer = self._virtual_query(addr)
+        if buffer is None:
+            return 0, 0
+        return buffer.RegionSize, buffer.Protect
+
+    def regions(self):
+        addr = 0
+        while True:
+            buffer = self._virtual_query(addr)
+            if buffer is None or not buffer.RegionSize:
+                break
+            base = buffer.BaseAddress or 0
+            yield MemoryRegion(base, buffer.RegionSize, buffer.Protect, buffer.State, buffer.Type)
+            addr = base + buffer.RegionSize
+
+    def alloc(self, size, addr=None, protect=win32.PAGE_EXECUTE_READWRITE):
+        flags = win32.MEM_COMMIT | win32.MEM_RESERVE
+        memory = win32.VirtualAllocEx(self.handle, addr, size, flags, protect)
+        if not memory:
+            raise win32.Win32Exception()
+        return memory
+
+    def free(self, addr):
+        win32.VirtualFreeEx(self.handle, addr, 0, win32.MEM_RELEASE)
+
+    def flush(self, addr=None, size=0):
+        win32.FlushInstructionCache(self.handle, addr, size)
+
+    def modules(self, process):
+        buffer = win32.MODULEENTRY32()
+        snapshot = win32.CreateToolhelp32Snapshot(
+            win32.TH32CS_SNAPMODULE | win32.TH32CS_SNAPMODULE32, self.pid
+        )
+        if not snapshot:
+            raise win32.Win32Exception()
+
+        _modules = list()
+        success = win32.Module32First(snapshot, byref(buffer))
+        while success:
+            _modules.append(ProcessModule.from_MODULEENTRY32(buffer, process))
+            success = win32.Module32Next(snapshot, byref(buffer))
+
+        win32.CloseHandle(snapshot)
+        return _modules
+
+
+class LinuxBackend(MemoryBackend):
+    """
+    Backend built on process_vm_readv/process_vm_writev and /proc/<pid>/{mem,maps}.
+
+    The handle is the file descriptor of /proc/<pid>/mem, which is used for the
+    single range reads and to write in pages that are not writable (e.g. code)
+    the same way WriteProcessMemory does.
+    """
+
+    def __init__(self, pid, right=None):
+        super(LinuxBackend, self).__init__(pid)
+        try:
+            self.handle = os.open("/proc/%d/mem" % pid, os.O_RDWR)
+        except OSError as e:
+            raise linux.LinuxException(e.errno)
+
+    def close(self):
+        if self.handle is not None:
+            os.close(self.handle)
+            self.handle = None
+
+    def read_into(self, addr, buffer, size):
+        # A single range is cheaper to read with preadv on /proc/<pid>/mem than
+        # with process_vm_readv, which needs two iovec built through ctypes.
+        view = memoryview(buffer)
+        if view.nbytes != size:
+            view = view.cast("B")[:size]
+        try:
+            count = os.preadv(self.handle, [view], addr)
+        except OSError as e:
+            raise linux.LinuxException(e.errno)
+        if count != size:
+            raise linux.LinuxException(errno.EFAULT)
+
+    def readv(self, ranges, buffer):
+        """Same as MemoryBackend.readv, but with at most one syscall per IOV_MAX ranges."""
+        base = addressof(buffer)
+        ranges = list(ranges)
+        for first in range(0, len(ranges), linux.IOV_MAX):
+            chunk = ranges[first : first + linux.IOV_MAX]
+            count = len(chunk)
+            local = (linux.iovec * count)()
+            remote = (linux.iovec * count)()
+            total = 0
+            for i, (addr, size) in enumerate(chunk):
+                local[i].iov_base = base
+                local[i].iov_len = size
+                remote[i].iov_base = addr
+                remote[i].iov_len = size
+                base += size
+                total += size
+            result = linux.process_vm_readv(self.pid, local, count, remote, count, 0)
+            if result != total:
+                raise linux.LinuxException(errno.EFAULT if result >= 0 else None)
+
+    def write(self, addr, data):
+        size = len(data)
+        buffer = ctypes.create_string_buffer(data, size)
+        local = linux.iovec(addressof(buffer), size)
+        remote = linux.iovec(addr, size)
+        count = linux.process_vm_writev(self.pid, byref(local), 1, byref(remote), 1, 0)
+        if count == size:
+            return
+        # process_vm_writev respects the page protections, /proc/<pid>/mem doesn't.
+        try:
+            written = os.pwrite(self.handle, data, addr)
+        except OSError as e:
+            raise linux.LinuxException(e.errno)
+        if written != size:
+            raise linux.LinuxException(errno.EFAULT)
+
+    def query(self, addr):
+        page = addr & ~(linux.PAGE_SIZE - 1)
+        for entry in linux.read_maps(self.pid):
+            if page < entry.start:
+                # Free memory between two mappings, as VirtualQueryEx reports it.
+                return entry.start - page, 0
+            if page < entry.end:
+                return entry.end - page, entry.protect
+        return 0, 0
+
+    def regions(self):
+        entries = linux.read_maps(self.pid)
+        # Paths with executable mappings are the closest thing to MEM_IMAGE.
+        images = set(entry.path for entry in entries if entry.path.startswith("/") and "x" in entry.perms)
+        for entry in entries:
+            if entry.path in images:
+                type = win32.MEM_IMAGE
+            elif entry.path.startswith("/") or entry.perms[3] == "s":
+                type = win32.MEM_MAPPED
+            else:
+                type = win32.MEM_PRIVATE
+            yield MemoryRegion(entry.start, entry.size, entry.protect, win32.MEM_COMMIT, type)
+
+    def alloc(self, size, addr=None, protect=win32.PAGE_EXECUTE_READWRITE):
+        # Requires running a mmap syscall in the remote process (ptrace).
+        raise UnsupportedOperation("Remote allocation isn't supported by the Linux backend.")
+
+    def free(self, addr):
+        raise UnsupportedOperation("Remote allocation isn't supported by the Linux backend.")
+
+    def modules(self, process):
+        try:
+            exe = os.readlink("/proc/%d/exe" % self.pid)
+        except OSError:
+            exe = None
+
+        # A module is every file backed mapping of the same path.
+        ranges = dict()
+        for entry in linux.read_maps(self.pid):
+            if not entry.path.startswith("/"):
+                continue
+            start, end = ranges.get(entry.path, (entry.start, entry.end))
+            ranges[entry.path] = (min(start, entry.start), max(end, entry.end))
+
+        _modules = list()
+        for path, (start, end) in ranges.items():
+            mod = ProcessModule(start, process)
+            mod.name = os.path.basename(path).lower()
+            mod.base = start
+            mod.size = end - start
+            mod.file = path
+            if path == exe:
+                _modules.insert(0, mod)
+            else:
+                _modules.append(mod)
+        return _modules
+
+
+def open_backend(pid, right=win32.PROCESS_ALL_ACCESS):
+    """Returns the default MemoryBackend of the current platform for the process pid."""
+    if os.name == "nt":
+        return Win32Backend(pid, right)
+    if linux.libc is not None:
+        return LinuxBackend(pid, right)
+    raise RuntimeError("No memory backend available for this platform.")
@@ -1,10 +1,13 @@
 from . import win32
 from . import utils
 from contextlib import suppress
+from concurrent.futures import ThreadPoolExecutor
 from ctypes import (
     byref
 )
-from .thread import ProcessThread
+import asyncio
+import threading
+import time
 
 class Hook(object):
     """
@@ -119,14 +122,153 @@ class ProcessHook(object):
         self.proc.flush(self.addr, 1)
 
 
+class HardwareHook(object):
+    """
+    A hook on one of the debug registers DR0-DR3 of the threads of a process.
+    The code and the data of the process are not modified.
+
+    An EXECUTE hook is called with the arguments of the function at addr, like
+    a ProcessHook. A WRITE or ACCESS (read or write) hook watches size bytes
+    at addr and is called with the value(s) read at addr with the argtypes of
+    the Hook, after the access.
+
+    Properties:
+        - proc
+        - addr
+        - hook
+        - slot
+        - condition
+        - size
+    """
+
+    EXECUTE = 0
+    WRITE = 1
+    ACCESS = 3
+
+    # The CONTEXT is the x86 one, 8 bytes breakpoints only exist in x64 contexts.
+    _LENGTHS = {1: 0, 2: 1, 4: 3}
+
+    def __init__(self, proc, addr, hook, slot, condition=EXECUTE, size=1):
+        if size not in HardwareHook._LENGTHS:
+            raise ValueError("A hardware breakpoint watches 1, 2 or 4 bytes.")
+        if condition == HardwareHook.EXECUTE and size != 1:
+            raise ValueError("An execute hardware breakpoint has a size of 1.")
+        if addr % size:
+            raise ValueError("The address of a hardware breakpoint must be aligned on its size.")
+        self.proc = proc
+        self.addr = addr
+        self.hook = hook
+        self.slot = slot
+        self.condition = condition
+        self.size = size
+
+    def __repr__(self):
+        return "<HardwareHook DR%d %08X in Process %d>" % (self.slot, self.addr, self.proc.id)
+
+    def apply(self, ctx):
+        """Sets the debug registers of the hook in the CONTEXT ctx."""
+        setattr(ctx, "Dr%d" % self.slot, self.addr)
+        shift = 16 + 4 * self.slot
+        ctx.Dr7 &= ~((0xF << shift) | (3 << (2 * self.slot)))
+        ctx.Dr7 |= (1 << (2 * self.slot)) | (((HardwareHook._LENGTHS[self.size] << 2) | self.condition) << shift)
+
+    @staticmethod
+    def clear(ctx, slot):
+        """Disables the debug register slot in the CONTEXT ctx."""
+        setattr(ctx, "Dr%d" % slot, 0)
+        ctx.Dr7 &= ~((0xF << (16 + 4 * slot)) | (3 << (2 * slot)))
+
+
+class DebuggerStats(object):
+    """
+    Counters of a ProcessDebugger, updated by the event loop and the workers.
+
+    Properties:
+        - events (debug events handled)
+        - hits (hook calls queued)
+        - pending (hook calls queued and not finished)
+        - max_pending
+        - hooks ({callback: [calls, total latency, max latency]}, latencies in
+          seconds from the capture of the arguments to the end of the call)
+        - errors (hook calls which raised)
+        - last_error ((callback, exception) of the last hook call which raised)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.events = 0
+        self.hits = 0
+        self.pending = 0
+        self.max_pending = 0
+        self.hooks = dict()
+        self.errors = 0
+        self.last_error = None
+
+    def __repr__(self):
+        return "<DebuggerStats %d events, %d hits, %d pending, %d errors>" % (
+            self.events, self.hits, self.pending, self.errors)
+
+    def _queued(self):
+        with self._lock:
+            self.hits += 1
+            self.pending += 1
+            self.max_pending = max(self.max_pending, self.pending)
+
+    def _done(self, callback, latency):
+        with self._lock:
+            self.pending -= 1
+            entry = self.hooks.get(callback)
+            if entry is None:
+                entry = self.hooks[callback] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += latency
+            entry[2] = max(entry[2], latency)
+
+    def _failed(self, callback, error):
+        with self._lock:
+            self.errors += 1
+            self.last_error = (callback, error)
+
+    def latency(self, callback):
+        """Returns the mean latency of the calls of callback, in seconds."""
+        calls, total, _ = self.hooks.get(callback, (0, 0.0, 0.0))
+        return total / calls if calls else 0.0
+
+
 class ProcessDebugger(object):
     """
+    Debugs a process and calls the hooks on their breakpoints.
+
+    With workers, the hooks are called on a pool of threads after the capture
+    of their arguments, so the debugged thread continues without waiting for
+    them. Hooks returning a coroutine are scheduled on the asyncio loop given
+    to start. The exceptions raised by the hooks are recorded in stats.
+
+    e.g.
+    dbg = ProcessDebugger(workers=4)
+    dbg.start(proc)
+    dbg.add_hook(addr, OnSleep)
+    ...
+    dbg.stop()
+
+    Properties:
+        - proc
+        - hooks
+        - hardware_hooks
+        - stats
     """
 
-    def __init__(self, proc=None):
+    def __init__(self, proc=None, workers=None):
         self.hooks = dict()
+        self.hardware_hooks = [None] * 4
+        self.ss_hook = None
         self.attached = False
-        win32.DebugSetProcessKillOnExit(False)
+        self.stats = DebuggerStats()
+        self._workers = workers
+        self._pool = ThreadPoolExecutor(workers) if workers else None
+        self._loop = None
+        self._pump = None
+        self._running = False
         if not proc is None:
             self.attach(proc)
 
@@ -145,10 +287,51 @@ class ProcessDebugger(object):
         self.hooks[addr] = proc_hook
         proc_hook.enable()
 
+    def add_hardware_hook(self, addr, hook, condition=HardwareHook.EXECUTE, size=1):
+        """
+        Hooks addr with a free debug register of every thread, the threads created
+        later get it too. Returns the HardwareHook.
+        """
+        self.remove_hardware_hook(addr)
+        if None not in self.hardware_hooks:
+            raise RuntimeError("The 4 debug registers are already used.")
+        slot = self.hardware_hooks.index(None)
+        self.hardware_hooks[slot] = HardwareHook(self.proc, addr, hook, slot, condition, size)
+        self._update_threads()
+        return self.hardware_hooks[slot]
+
+    def remove_hardware_hook(self, addr):
+        for slot, hw_hook in enumerate(self.hardware_hooks):
+            if hw_hook is not None and hw_hook.addr == addr:
+                self.hardware_hooks[slot] = None
+                self._update_threads()
+
+    def _update_threads(self):
+        for thread in self.proc.threads:
+            # The thread may have exited since the snapshot.
+            with suppress(win32.Win32Exception):
+                self._set_debug_registers(thread)
+
+    def _set_debug_registers(self, thread):
+        """Writes the debug registers of the hardware hooks in the thread."""
+        thread.suspend()
+        try:
+            ctx = thread.context(win32.CONTEXT_DEBUG_REGISTERS)
+            for slot, hw_hook in enumerate(self.hardware_hooks):
+                if hw_hook is not None:
+                    hw_hook.apply(ctx)
+                else:
+                    HardwareHook.clear(ctx, slot)
+            thread.set_context(ctx)
+        finally:
+            thread.resume()
+
     def attach(self, proc):
+        """Attaches to proc, the events are then received by the calling thread only."""
         if self.attached:
             raise RuntimeError("ProcessDebugger already attached")
         self.proc = proc
+        win32.DebugSetProcessKillOnExit(False)
         if not win32.DebugActiveProcess(proc.id):
             raise win32.Win32Exception()
         self.attached = True
@@ -159,20 +342,86 @@ class ProcessDebugger(object):
         with suppress(Exception):
             for hook in self.hooks.values():
                 hook.disable()
+        if any(self.hardware_hooks):
+            self.hardware_hooks = [None] * 4
+            with suppress(Exception):
+                self._update_threads()
         win32.DebugActiveProcessStop(self.proc.id)
         self.attached = False
 
+    def start(self, proc, loop=None):
+        """
+        Attaches to proc and handles its events on a dedicated thread until stop.
+        Coroutines returned by the hooks are scheduled on loop (by default, the
+        running asyncio loop, if any).
+        """
+        if self.attached or self._pump is not None:
+            raise RuntimeError("ProcessDebugger already attached")
+        if loop is None:
+            with suppress(RuntimeError):
+                loop = asyncio.get_running_loop()
+        self._loop = loop
+        if self._workers and self._pool is None:
+            # The pool is shut down by stop.
+            self._pool = ThreadPoolExecutor(self._workers)
+        self._running = True
+        attached = threading.Event()
+        errors = list()
+
+        def pump():
+            # Only the thread which attached receives the events and can detach.
+            try:
+                self.attach(proc)
+            except Exception as e:
+                errors.append(e)
+                return
+            finally:
+                attached.set()
+            try:
+                while self._running and self.attached:
+                    self.poll(100)
+            finally:
+                self.detach()
+
+        self._pump = threading.Thread(target=pump, name="ProcessDebugger", daemon=True)
+        self._pump.start()
+        attached.wait()
+        if errors:
+            self._pump = None
+            raise errors[0]
+
+    def stop(self, wait=True):
+        """Stops the thread started by start, detaches and waits for the hooks left if wait."""
+        self._running = False
+        if self._pump is not None:
+            self._pump.join()
+            self._pump = None
+        if self._pool is not None:
+            self._pool.shutdown(wait)
+            self._pool = None
+
     def run(self, **kw):
         frequency = kw.pop("frequency",  win32.INFINITE)
+        max_events = kw.pop("max_events", 64)
         while self.attached:
-            self.poll(frequency)
-
-    def poll(self, timeout= win32.INFINITE):
-        """Poll the next event dispatch it"""
+            self.poll(frequency, max_events)
+
+    def poll(self, timeout= win32.INFINITE, max_events=1):
+        """
+        Waits at most timeout ms for an event and dispatches it, then the events
+        already queued, up to max_events. Returns the number of events handled.
+        """
+        count = 0
         evt = win32.DEBUG_EVENT()
-        if not win32.WaitForDebugEvent(byref(evt), timeout):
-            return
-
+        while count < max_events and self.attached:
+            if not win32.WaitForDebugEvent(byref(evt), timeout if count == 0 else 0):
+                break
+            self._handle_event(evt)
+            count += 1
+        self.stats.events += count
+        return count
+
+    def _handle_event(self, evt):
         if evt.dwProcessId != self.proc.id:
             win32.ContinueDebugEvent(
                 evt.dwProcessId, evt.dwThreadId,  win32.DBG_EXCEPTION_NOT_HANDLED
@@ -181,23 +430,36 @@ class ProcessDebugger(object):
 
         continue_status =  win32.DBG_CONTINUE
         event_code = evt.dwDebugEventCode
-        thread = ProcessThread(evt.dwThreadId, self.proc)
+        # The handles of the threads are opened once, by the registry of the process.
+        # A new thread is registered with a copy of the handle of its event, the system
+        # closes the original when the thread exits.
+        if event_code == win32.CREATE_THREAD_DEBUG_EVENT:
+            thread = self._register_thread(evt.dwThreadId, evt.u.CreateThread.hThread)
+        elif event_code == win32.CREATE_PROCESS_DEBUG_EVENT:
+            thread = self._register_thread(evt.dwThreadId, evt.u.CreateProcessInfo.hThread)
+        else:
+            thread = self.proc.thread_registry.get(evt.dwThreadId)
 
         if event_code == win32.EXCEPTION_DEBUG_EVENT:
             continue_status = self._on_debug_event(thread, evt.u.Exception)
         elif event_code == win32.CREATE_THREAD_DEBUG_EVENT:
+            self._on_create_thread(thread)
             self.OnCreateThreadDebugEvent(thread, evt.u.CreateThread)
         elif event_code == win32.CREATE_PROCESS_DEBUG_EVENT:
+            self._on_create_thread(thread)
             self.OnCreateProcessDebugEvent(thread, evt.u.CreateProcessInfo)
         elif event_code == win32.EXIT_THREAD_DEBUG_EVENT:
             self.OnExitThreadDebugEvent(thread, evt.u.ExitThread)
+            self.proc.thread_registry.remove(evt.dwThreadId)
         elif event_code == win32.EXIT_PROCESS_DEBUG_EVENT:
             self.exit_code = evt.u.ExitProcess.dwExitCode
             self.OnExitProcessDebugEvent(thread, evt.u.ExitProcess)
             self.detach()
         elif event_code == win32.LOAD_DLL_DEBUG_EVENT:
+            self.proc.module_map.invalidate()
             self.OnLoadDllDebugEvent(thread, evt.u.LoadDll)
         elif event_code == win32.UNLOAD_DLL_DEBUG_EVENT:
+            self.proc.module_map.invalidate()
             self.OnUnloadDllDebugEvent(thread, evt.u.UnloadDll)
         elif event_code == win32.OUTPUT_DEBUG_STRING_EVENT:
             self.OnOutputDebugStringEvent(thread, evt.u.DebugString)
@@ -206,12 +468,51 @@ class ProcessDebugger(object):
 
         win32.ContinueDebugEvent(evt.dwProcessId, evt.dwThreadId, continue_status)
 
+    def _register_thread(self, id, handle):
+        current = win32.GetCurrentProcess()
+        duplicate = win32.HANDLE()
+        if not win32.DuplicateHandle(current, handle, current, byref(duplicate), 0, False, win32.DUPLICATE_SAME_ACCESS):
+            return self.proc.thread_registry.get(id)
+        return self.proc.thread_registry.add(id, duplicate.value)
+
+    def _on_create_thread(self, thread):
+        if any(self.hardware_hooks):
+            with suppress(win32.Win32Exception):
+                self._set_debug_registers(thread)
+
     def _on_single_step(self, thread, addr):
+        # The step after an INT3 hook and a hardware breakpoint can be reported by
+        # the same exception, the breakpoint is put back in both cases.
+        status = win32.DBG_EXCEPTION_NOT_HANDLED
         hook = self.ss_hook
-        if not hook:
-            return win32.DBG_EXCEPTION_NOT_HANDLED
-
-        hook.enable()
+        if hook:
+            self.ss_hook = None
+            hook.enable()
+            status = win32.DBG_CONTINUE
+
+        if any(self.hardware_hooks):
+            ctx = thread.context(win32.CONTEXT_FULL | win32.CONTEXT_DEBUG_REGISTERS)
+            if ctx.Dr6 & 0xF:
+                return self._on_hardware_breakpoint(thread, ctx)
+        return status
+
+    def _on_hardware_breakpoint(self, thread, ctx):
+        for slot, hw_hook in enumerate(self.hardware_hooks):
+            if hw_hook is None or not ctx.Dr6 & (1 << slot):
+                continue
+            hook = hw_hook.hook
+            if hw_hook.condition == HardwareHook.EXECUTE:
+                args = self._read_args(hook, ctx)
+            else:
+                args = self.proc.read(hw_hook.addr, hook.argstr)
+                args = list(args) if isinstance(args, (list, tuple)) else [args]
+            self._dispatch(hook, args)
+
+        # The debug status isn't cleared by the processor. The resume flag lets the
+        # instruction of an execute breakpoint run instead of breaking again.
+        ctx.Dr6 = 0
+        ctx.EFlags |= 0x10000  # RESUME_FLAG
+        thread.set_context(ctx)
         return win32.DBG_CONTINUE
 
     def _on_breakpoint(self, thread, addr):
@@ -222,9 +523,44 @@ class ProcessDebugger(object):
         proc_hook.disable()
 
         ctx = thread.context()
-        args = list()
-
         hook = proc_hook.hook
+        args = self._read_args(hook, ctx)
+        self._dispatch(hook, args)
+
+        # This will enable a "single-step" breakpoint
+        # We cannot reach an other breakpoint before raising Single-Step exception
+        self.ss_hook = proc_hook
+        ctx.Eip -= 1
+        ctx.EFlags |= 0x100  # TRAP_FLAG
+        thread.set_context(ctx)
+        return win32.DBG_CONTINUE
+
+    def _dispatch(self, hook, args):
+        """Calls hook with the captured args, on the worker pool if there is one."""
+        self.stats._queued()
+        start = time.perf_counter()
+        if self._pool is None:
+            self._call_hook(hook, args, start)
+        else:
+            self._pool.submit(self._call_hook, hook, args, start)
+
+    def _call_hook(self, hook, args, start):
+        # The errors of the hooks are counted in the stats, they must not stop the
+        # event loop: the debugged thread waits for its event to be continued.
+        try:
+            result = hook(*args)
+            if asyncio.iscoroutine(result):
+                if self._loop is None:
+                    result.close()
+                    raise RuntimeError("No asyncio loop to run the coroutine of %r." % hook)
+                asyncio.run_coroutine_threadsafe(result, self._loop)
+        except Exception as e:
+            self.stats._failed(hook.callback, e)
+        self.stats._done(hook.callback, time.perf_counter() - start)
+
+    def _read_args(self, hook, ctx):
+        """Returns the arguments of hook at the entry of a function, with the registers of ctx."""
+        args = list()
         conv = hook.callconv
         argc = len(hook.argtypes)
 
@@ -240,18 +576,7 @@ class ProcessDebugger(object):
             args.extend(stack_args)
         else:
             args.append(stack_args)
-
-        # What should we do here ??? (We don't want to crash the remote process)
-        with suppress(Exception):
-            hook(*args)
-
-        # This will enable a "single-step" breakpoint
-        # We cannot reach an other breakpoint before raising Single-Step exception
-        self.ss_hook = proc_hook
-        ctx.Eip -= 1
-        ctx.EFlags |= 0x100  # TRAP_FLAG
-        thread.set_context(ctx)
-        return win32.DBG_CONTINUE
+        return args
 
     def _on_debug_event(self, thread, info):
         """This is internal, but if you were to overload it, return the continuation status"""
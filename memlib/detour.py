@@ -0,0 +1,443 @@
+from . import win32
+from . import utils
+from . import x86
+from .ring import SharedRing
+from .debugger import Hook
+from contextlib import suppress
+import struct
+
+def _jmp(src, dst, x64):
+    """Returns the code of a jmp from src to dst, a jmp rel32 when dst is in reach."""
+    rel = dst - (src + 5)
+    if not x64:
+        return b"\xE9" + struct.pack("<i", (rel + 2 ** 31) % 2 ** 32 - 2 ** 31)
+    if -2 ** 31 <= rel < 2 ** 31:
+        return b"\xE9" + struct.pack("<i", rel)
+    # jmp qword[rip], followed by the address
+    return b"\xFF\x25\x00\x00\x00\x00" + struct.pack("<Q", dst)
+
+
+class InlineHook(object):
+    """
+    A detour of the function at addr: its first instructions are replaced by a
+    jmp to a stub that writes the arguments of the call in the SharedRing of
+    the InlineHooker, runs the moved instructions and jumps back. The target
+    never waits for Python, the hook is called when the hooker polls the ring.
+
+    The moved instructions are relocated (relative calls, jumps and rip
+    relative operands), but a prologue containing short branches or VEX
+    instructions can't be moved and raises x86.DecodeError.
+
+    The prologue is patched with the threads of the process suspended, a
+    thread stopped inside the replaced instructions is moved to their copy in
+    the stub, which has the same layout.
+
+    Properties:
+        - proc
+        - addr
+        - hook
+        - id
+        - stub
+        - enabled
+    """
+
+    def __init__(self, hooker, addr, hook, id):
+        self.proc = hooker.proc
+        self.addr = addr
+        self.hook = hook
+        self.id = id
+        self.enabled = False
+
+        x64 = hooker.x64
+        log_code, self._fields = hooker._log_code(hook, id)
+        code = self.proc.read(addr, "32s")
+        self.stub = hooker._allocate(len(log_code) + len(code) + 14, addr)
+        jmp = _jmp(addr, self.stub, x64)
+        moved, length = x86.relocate(code, addr, self.stub + len(log_code), len(jmp), x64)
+        back = _jmp(self.stub + len(log_code) + len(moved), addr + length, x64)
+
+        stub_code = log_code + moved + back
+        self.proc.write(self.stub, stub_code)
+        self.proc.flush(self.stub, len(stub_code))
+        self.inst = code[:length]
+        self.patch = jmp + b"\x90" * (length - len(jmp))
+        self._moved = self.stub + len(log_code)
+
+    def __del__(self):
+        if self.enabled:
+            self.disable()
+
+    def __repr__(self):
+        return "<InlineHook %08X in Process %d>" % (self.addr, self.proc.id)
+
+    def enable(self):
+        self.enabled = True
+        self._write_prologue(self.patch, True)
+
+    def disable(self):
+        self.enabled = False
+        self._write_prologue(self.inst, False)
+
+    def _write_prologue(self, code, move_threads):
+        """Writes code over the prologue while the threads are suspended."""
+        registry = self.proc.thread_registry
+        registry.refresh()
+        with registry.suspended() as threads:
+            if move_threads:
+                # A thread at addr runs the jmp, the ones past it continue in the moved copy.
+                self._move_threads(threads, self.addr + 1, self.addr + len(code), self._moved - self.addr)
+            self.proc.write(self.addr, code)
+            self.proc.flush(self.addr, len(code))
+
+    def _move_threads(self, threads, start, end, delta):
+        """Adds delta to the instruction pointer of the threads which are in [start, end)."""
+        for thread in threads:
+            try:
+                context = thread.context(win32.CONTEXT_CONTROL, reuse=True)
+                if win32.PROCESS_IS_64_BITS and start <= context.Rip < end:
+                    context.Rip += delta
+                elif not win32.PROCESS_IS_64_BITS and start <= context.Eip < end:
+                    context.Eip += delta
+                else:
+                    continue
+                thread.set_context(context)
+            except win32.Win32Exception:
+                # The thread exited since it was suspended.
+                continue
+
+    def arguments(self, payload):
+        """Returns the list of the arguments of a call logged in payload."""
+        args = list()
+        for st, offset in self._fields:
+            values = st.unpack_from(payload, offset)
+            args.append(values[0] if len(values) == 1 else values)
+        return args
+
+
+class InlineHooker(object):
+    """
+    Hooks functions of a process with detours (InlineHook) instead of
+    breakpoints: the hooked threads don't stop, the arguments of the calls are
+    written in a SharedRing mapped in both processes and the hooks are called
+    from poll or run with the Hook declarations of ProcessDebugger.
+
+    e.g.
+    hooker = InlineHooker(proc)
+    hooker.add_hook(sleep_address, OnSleep)
+    hooker.run()
+
+    A call is dropped (and counted in ring.dropped) when the ring is full.
+    The exceptions raised by the hooks don't stop the polling, they are counted.
+
+    Properties:
+        - proc
+        - hooks
+        - ring
+        - x64
+        - errors (hook calls which raised)
+        - last_error ((hook, exception) of the last hook call which raised)
+    """
+
+    '''
+        log_x86:
+            pushfd
+            pushad
+            mov ebp, RING
+        retry:
+            mov eax, dword[ebp+0x40]        ; head
+            mov edx, dword[ebp+0x44]
+            mov esi, eax
+            and esi, MASK                   ; offset of the record
+            xor edi, edi                    ; padding
+            lea ecx, [esi+NEED]
+            cmp ecx, CAP
+            jbe reserve
+            mov edi, CAP
+            sub edi, esi
+        reserve:
+            lea ecx, [eax+edi+NEED]
+            sub ecx, dword[ebp+0x80]        ; tail
+            cmp ecx, CAP
+            ja full
+            lea ebx, [edi+NEED]
+            add ebx, eax
+            mov ecx, edx
+            adc ecx, 0
+            lock cmpxchg8b qword[ebp+0x40]
+            jnz retry
+            test edi, edi
+            jz write
+            mov dword[ebp+esi+0xC4], 0xFFFFFFFF
+            mov dword[ebp+esi+0xC0], edi
+            xor esi, esi
+        write:
+            lea edi, [ebp+esi+0xC0]
+            mov eax, dword[esp+0x18]        ; ecx
+            mov dword[edi+8], eax
+            mov eax, dword[esp+0x14]        ; edx
+            mov dword[edi+0xC], eax
+            mov edx, edi
+            lea esi, [esp+0x28]             ; arguments on the stack
+            add edi, 0x10
+            mov ecx, COUNT
+            cld
+            rep movsd
+            mov dword[edx+4], TYPE
+            mov dword[edx], SIZE            ; commits the record
+            jmp done
+        full:
+            lock inc dword[ebp+8]
+        done:
+            popad
+            popfd
+    '''
+    _log_x86_code = b"\x9C\x60\xBD\x01\x00\xAD\xDE\x8B\x45\x40\x8B\x55\x44\x89\xC6\x81\xE6\x02\x00\xAD\xDE\x31\xFF\x8D\x8E\x04\x00\xAD\xDE\x81\xF9\x03\x00\xAD\xDE\x76\x07\xBF\x03\x00\xAD\xDE\x29\xF7\x8D\x8C\x38\x04\x00\xAD\xDE\x2B\x8D\x80\x00\x00\x00\x81\xF9\x03\x00\xAD\xDE\x77\x61\x8D\x9F\x04\x00\xAD\xDE\x01\xC3\x89\xD1\x83\xD1\x00\xF0\x0F\xC7\x4D\x40\x75\xB2\x85\xFF\x74\x14\xC7\x84\x35\xC4\x00\x00\x00\xFF\xFF\xFF\xFF\x89\xBC\x35\xC0\x00\x00\x00\x31\xF6\x8D\xBC\x35\xC0\x00\x00\x00\x8B\x44\x24\x18\x89\x47\x08\x8B\x44\x24\x14\x89\x47\x0C\x89\xFA\x8D\x74\x24\x28\x83\xC7\x10\xB9\x05\x00\xAD\xDE\xFC\xF3\xA5\xC7\x42\x04\x06\x00\xAD\xDE\xC7\x02\x07\x00\xAD\xDE\xEB\x04\xF0\xFF\x45\x08\x61\x9D"
+    '''
+        log_x64:
+            pushfq
+            push rax
+            push rcx
+            push rdx
+            push rsi
+            push rdi
+            push r8
+            push r9
+            push r10
+            mov r10, RING
+        retry:
+            mov rax, qword[r10+0x40]        ; head
+            mov esi, eax
+            and esi, MASK                   ; offset of the record
+            xor edi, edi                    ; padding
+            lea edx, [esi+NEED]
+            cmp edx, CAP
+            jbe reserve
+            mov edi, CAP
+            sub edi, esi
+        reserve:
+            lea rdx, [rax+rdi+NEED]
+            mov rcx, rdx
+            sub rcx, qword[r10+0x80]        ; tail
+            cmp rcx, CAP
+            ja full
+            lock cmpxchg qword[r10+0x40], rdx
+            jnz retry
+            test edi, edi
+            jz write
+            mov dword[r10+rsi+0xC4], 0xFFFFFFFF
+            mov dword[r10+rsi+0xC0], edi
+            xor esi, esi
+        write:
+            lea rdi, [r10+rsi+0xC0]
+            mov rax, qword[rsp+0x30]        ; rcx
+            mov qword[rdi+0x08], rax
+            mov rax, qword[rsp+0x28]        ; rdx
+            mov qword[rdi+0x10], rax
+            mov rax, qword[rsp+0x10]        ; r8
+            mov qword[rdi+0x18], rax
+            mov rax, qword[rsp+0x08]        ; r9
+            mov qword[rdi+0x20], rax
+            movq qword[rdi+0x28], xmm0
+            movq qword[rdi+0x30], xmm1
+            movq qword[rdi+0x38], xmm2
+            movq qword[rdi+0x40], xmm3
+            mov rdx, rdi
+            lea rsi, [rsp+0x70]             ; arguments on the stack, after the shadow space
+            add rdi, 0x48
+            mov ecx, COUNT
+            cld
+            rep movsq
+            mov dword[rdx+4], TYPE
+            mov dword[rdx], SIZE            ; commits the record
+            jmp done
+        full:
+            lock inc qword[r10+8]
+        done:
+            pop r10
+            pop r9
+            pop r8
+            pop rdi
+            pop rsi
+            pop rdx
+            pop rcx
+            pop rax
+            popfq
+    '''
+    _log_x64_code = b"\x9C\x50\x51\x52\x56\x57\x41\x50\x41\x51\x41\x52\x49\xBA\x01\x00\xAD\xDE\xEF\xBE\xAD\xDE\x49\x8B\x42\x40\x89\xC6\x81\xE6\x02\x00\xAD\xDE\x31\xFF\x67\x8D\x96\x04\x00\xAD\x5E\x81\xFA\x03\x00\xAD\x5E\x76\x07\xBF\x03\x00\xAD\x5E\x29\xF7\x48\x8D\x94\x38\x04\x00\xAD\x5E\x48\x89\xD1\x49\x2B\x8A\x80\x00\x00\x00\x48\x81\xF9\x03\x00\xAD\x5E\x0F\x87\x86\x00\x00\x00\xF0\x49\x0F\xB1\x52\x40\x75\xB5\x85\xFF\x74\x16\x41\xC7\x84\x32\xC4\x00\x00\x00\xFF\xFF\xFF\xFF\x41\x89\xBC\x32\xC0\x00\x00\x00\x31\xF6\x49\x8D\xBC\x32\xC0\x00\x00\x00\x48\x8B\x44\x24\x30\x48\x89\x47\x08\x48\x8B\x44\x24\x28\x48\x89\x47\x10\x48\x8B\x44\x24\x10\x48\x89\x47\x18\x48\x8B\x44\x24\x08\x48\x89\x47\x20\x66\x0F\xD6\x47\x28\x66\x0F\xD6\x4F\x30\x66\x0F\xD6\x57\x38\x66\x0F\xD6\x5F\x40\x48\x89\xFA\x48\x8D\x74\x24\x70\x48\x83\xC7\x48\xB9\x05\x00\xAD\x5E\xFC\xF3\x48\xA5\xC7\x42\x04\x06\x00\xAD\xDE\xC7\x02\x07\x00\xAD\xDE\xEB\x05\xF0\x49\xFF\x42\x08\x41\x5A\x41\x59\x41\x58\x5F\x5E\x5A\x59\x58\x9D"
+
+    # Placeholders of the constants in the code, imm32 (x64 ones are sign extended)
+    _RING_X86 = 0xDEAD0001
+    _RING_X64 = 0xDEADBEEFDEAD0001
+    _MASK = 0xDEAD0002
+    _CAP_X86, _CAP_X64 = 0xDEAD0003, 0x5EAD0003
+    _NEED_X86, _NEED_X64 = 0xDEAD0004, 0x5EAD0004
+    _COUNT_X86, _COUNT_X64 = 0xDEAD0005, 0x5EAD0005
+    _TYPE = 0xDEAD0006
+    _SIZE = 0xDEAD0007
+
+    _ARENA_SIZE = 0x10000
+
+    def __init__(self, proc, ring_size=0x100000):
+        self.proc = proc
+        self.hooks = dict()
+        self.x64 = win32.PROCESS_IS_64_BITS
+        self._ids = dict()
+        self._next_id = 0
+        self._arenas = list()   # [base, offset, end]
+        self.errors = 0
+        self.last_error = None
+        self.ring = None
+
+        self.buffer = proc.mapshared(SharedRing.size_for(ring_size))
+        self.ring = SharedRing.create(self.buffer)
+
+    def __del__(self):
+        self.close()
+
+    def __repr__(self):
+        return "<InlineHooker for Process %d>" % self.proc.id
+
+    def _log_code(self, hook, id):
+        """
+        Returns the code writing the arguments of hook in the ring, and the list
+        of (struct, offset in the payload) of the arguments.
+        """
+        codes = [utils.get_ctype_string(argtype) for argtype in hook.argtypes]
+        fields = list()
+        if self.x64:
+            # rcx, rdx, r8, r9, xmm0-3, then the stack
+            for i, code in enumerate(codes):
+                if i < 4:
+                    offset = 0x20 + 8 * i if code in ("f", "d") else 8 * i
+                else:
+                    offset = 0x40 + 8 * (i - 4)
+                fields.append((utils.get_struct(code), offset))
+            count = max(len(codes) - 4, 0)
+            size = 8 + 0x40 + 8 * count
+        else:
+            # ecx, edx, then the stack
+            registers = 0
+            if hook.callconv == Hook._fastcall:
+                registers = min(len(codes), 2)
+            elif hook.callconv == Hook._thiscall:
+                registers = min(len(codes), 1)
+            offset = 8
+            for i, code in enumerate(codes):
+                st = utils.get_struct(code)
+                if i < registers:
+                    fields.append((st, 4 * i))
+                else:
+                    fields.append((st, offset))
+                    offset += (st.size + 3) & ~3
+            count = (offset - 8) // 4
+            size = 8 + offset
+
+        need = (size + 7) & ~7
+        if need > self.ring.capacity:
+            raise ValueError("The arguments of the hook don't fit in the ring.")
+
+        ring = self.buffer.base_remote
+        if self.x64:
+            code = InlineHooker._log_x64_code.replace(struct.pack("<Q", InlineHooker._RING_X64), struct.pack("<Q", ring))
+            constants = ((InlineHooker._CAP_X64, self.ring.capacity), (InlineHooker._NEED_X64, need),
+                (InlineHooker._COUNT_X64, count))
+        else:
+            code = InlineHooker._log_x86_code.replace(struct.pack("<I", InlineHooker._RING_X86), struct.pack("<I", ring))
+            constants = ((InlineHooker._CAP_X86, self.ring.capacity), (InlineHooker._NEED_X86, need),
+                (InlineHooker._COUNT_X86, count))
+        constants += ((InlineHooker._MASK, self.ring.capacity - 1), (InlineHooker._TYPE, id),
+            (InlineHooker._SIZE, size))
+        for placeholder, value in constants:
+            code = code.replace(struct.pack("<I", placeholder), struct.pack("<I", value))
+        return code, fields
+
+    def _in_reach(self, addr, near):
+        return not self.x64 or abs(addr - near) < 2 ** 31 - InlineHooker._ARENA_SIZE
+
+    def _near_region(self, near):
+        """Returns the address of a free range of the arena size closest to near, or None."""
+        size = InlineHooker._ARENA_SIZE
+        best = None
+        for region in self.proc.regions(state=win32.MEM_FREE):
+            # Allocations are aligned on 64K.
+            start = (region.base + 0xFFFF) & ~0xFFFF
+            end = (region.end - size) & ~0xFFFF
+            if start > end or start == 0:
+                continue
+            addr = start if start >= near else min(end, near & ~0xFFFF)
+            if not self._in_reach(addr, near):
+                continue
+            if best is None or abs(addr - near) < abs(best - near):
+                best = addr
+        return best
+
+    def _allocate(self, size, near):
+        """Returns the remote address of size bytes of code, near the address near if possible."""
+        size = (size + 0xF) & ~0xF
+        for arena in self._arenas:
+            if arena[1] + size <= arena[2] and self._in_reach(arena[0], near):
+                addr = arena[1]
+                arena[1] += size
+                return addr
+
+        base = None
+        if self.x64:
+            with suppress(Exception):
+                base = self.proc.mmap(InlineHooker._ARENA_SIZE, self._near_region(near))
+        if base is None:
+            # The detour will take the 14 bytes jmp.
+            base = self.proc.mmap(InlineHooker._ARENA_SIZE)
+        self._arenas.append([base, base + size, base + InlineHooker._ARENA_SIZE])
+        return base
+
+    def add_hook(self, addr, hook):
+        """Detours the function at addr to hook (a Hook) and returns the InlineHook."""
+        self.remove_hook(addr)
+        inline_hook = InlineHook(self, addr, hook, self._next_id)
+        self._next_id += 1
+        self.hooks[addr] = inline_hook
+        self._ids[inline_hook.id] = inline_hook
+        inline_hook.enable()
+        return inline_hook
+
+    def remove_hook(self, addr):
+        inline_hook = self.hooks.pop(addr, None)
+        if inline_hook is None:
+            return
+        inline_hook.disable()
+        # The calls already logged are still dispatched.
+
+    def poll(self, max_count=None, timeout=0):
+        """
+        Calls the hooks of the logged calls, at most max_count of them, waiting
+        at most timeout seconds (forever if None) for the first one. Returns
+        the number of calls read.
+        """
+        records = self.ring.get(max_count, timeout)
+        for id, payload in records:
+            inline_hook = self._ids.get(id, None)
+            if inline_hook is None:
+                continue
+            try:
+                inline_hook.hook(*inline_hook.arguments(payload))
+            except Exception as e:
+                self.errors += 1
+                self.last_error = (inline_hook.hook, e)
+        return len(records)
+
+    def run(self, **kw):
+        frequency = kw.pop("frequency", 0.1)
+        while self.hooks:
+            self.poll(timeout=frequency)
+
+    def close(self):
+        """Removes the detours and dispatches the calls left in the ring."""
+        if self.ring is None:
+            return
+        for addr in list(self.hooks):
+            with suppress(Exception):
+                self.remove_hook(addr)
+        self.poll()
+        # The stubs stay mapped: a thread may still be running one of them.
+        self._arenas = list()
+        self.ring = None
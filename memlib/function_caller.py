@@ -1,137 +1,856 @@
 from . import win32
 from ctypes.wintypes import *
 import ctypes as c
+import asyncio
+import struct
+import threading
+import time
 
 class CallBuffer(object):
 
     def __init__(self, *data):
         self.data = b''.join(data)
 
+def _struct_code(argtype):
+    """Returns the struct format of a simple ctypes type, None if it isn't one."""
+    code = getattr(argtype, "_type_", None)
+    if not isinstance(code, str) or code not in "bBhHiIlLqQfd?P":
+        return None
+    if code in "fd?":
+        return code
+    code = {1: "b", 2: "h", 4: "i", 8: "q"}[c.sizeof(argtype)]
+    return code if argtype._type_ in "bhilq" else code.upper()
+
+
+def _x64_stub_code(address, args, float_return):
+    """
+    Compiles a Microsoft x64 stub calling address with the frame in rcx.
+    args is the list of (offset in the frame, is float) of the arguments.
+
+        push rbp
+        mov rbp, rsp
+        push rsi
+        sub rsp, 8
+        mov rsi, rcx
+        sub rsp, <shadow space and stack arguments, 16 bytes aligned>
+        mov rax, qword[rsi+<offset>]        ; for the arguments after the 4th
+        mov qword[rsp+<8*i>], rax
+        mov rcx|rdx|r8|r9, qword[rsi+<offset>]  or  movq xmm0-3, qword[rsi+<offset>]
+        mov rax, <address>
+        call rax
+        movq rax, xmm0                      ; for float return values
+        lea rsp, [rbp-8]
+        pop rsi
+        pop rbp
+        ret
+    """
+    code = b"\x55\x48\x89\xE5\x56\x48\x83\xEC\x08\x48\x89\xCE"
+    code += b"\x48\x81\xEC" + struct.pack("<i", (max(len(args), 4) * 8 + 0xF) & ~0xF)
+    for i, (offset, _) in enumerate(args[4:], 4):
+        code += b"\x48\x8B\x86" + struct.pack("<i", offset)
+        code += b"\x48\x89\x84\x24" + struct.pack("<i", 8 * i)
+    registers = (b"\x48\x8B\x8E", b"\x48\x8B\x96", b"\x4C\x8B\x86", b"\x4C\x8B\x8E")
+    for i, (offset, is_float) in enumerate(args[:4]):
+        if is_float:
+            code += b"\xF3\x0F\x7E" + bytes([0x86 | i << 3]) + struct.pack("<i", offset)
+        else:
+            code += registers[i] + struct.pack("<i", offset)
+    code += b"\x48\xB8" + struct.pack("<Q", address) + b"\xFF\xD0"
+    if float_return:
+        code += b"\x66\x48\x0F\x7E\xC0"
+    return code + b"\x48\x8D\x65\xF8\x5E\x5D\xC3"
+
+
+def _x86_stub_code(address, pushed, ecx, edx, float_return):
+    """
+    Compiles a x86 stdcall stub calling address with the frame as argument.
+    pushed is the list of the offsets of the dwords passed on the stack, ecx and
+    edx the offsets of the register arguments (or None). float_return is None,
+    'f' or 'd', a double is stored at the start of the frame.
+
+        push ebp
+        mov ebp, esp
+        push esi
+        mov esi, dword[ebp+8]
+        push dword[esi+<offset>]            ; for the pushed dwords, last first
+        mov ecx, dword[esi+<offset>]
+        mov edx, dword[esi+<offset>]
+        mov eax, <address>
+        call eax
+        push eax                            ; 'f': st0 as the float in eax
+        fstp dword[esp]
+        pop eax
+        fstp qword[esi]                     ; 'd': st0 in the frame
+        lea esp, [ebp-4]
+        pop esi
+        pop ebp
+        ret 4
+    """
+    code = b"\x55\x89\xE5\x56\x8B\x75\x08"
+    for offset in reversed(pushed):
+        code += b"\xFF\xB6" + struct.pack("<i", offset)
+    if ecx is not None:
+        code += b"\x8B\x8E" + struct.pack("<i", ecx)
+    if edx is not None:
+        code += b"\x8B\x96" + struct.pack("<i", edx)
+    code += b"\xB8" + struct.pack("<I", address) + b"\xFF\xD0"
+    if float_return == "f":
+        code += b"\x50\xD9\x1C\x24\x58"
+    elif float_return == "d":
+        code += b"\xDD\x1E"
+    return code + b"\x8D\x65\xFC\x5E\x5D\xC2\x04\x00"
+
+
+class CallStub(object):
+    """
+    The remote stub compiled for a function and its signature.
+
+    The stub has the address of the function baked in and loads the arguments
+    from a frame laid out by a struct.Struct, so the frame of a call is written
+    with one pack_into. Every argument takes a pointer sized slot (doubles and
+    structures take more on x86). A CallBuffer argument is replaced by the
+    address of its data, copied after the frame.
+
+    convention is 'stdcall', 'fastcall' or 'x64', restype the ctypes type of
+    the return value, floats included.
+
+    Properties:
+        - convention
+        - address
+        - argtypes
+        - restype
+        - struct
+        - code
+        - remote (address of the code in the process, set by ProcessCaller.compile)
+    """
+
+    def __init__(self, convention, address, argtypes, restype=None):
+        self.convention = convention
+        self.address = address
+        self.argtypes = tuple(argtypes)
+        self.restype = restype
+        self.remote = None
+
+        ptr = 8 if convention == "x64" else 4
+        fmt = "<"
+        args = list()
+        self._buffers = list()
+        self._converted = list()
+        offset = 0
+        for i, v in enumerate(self.argtypes):
+            if v is CallBuffer:
+                code, size = ("Q" if ptr == 8 else "I"), ptr
+                self._buffers.append(i)
+            else:
+                size = c.sizeof(v)
+                code = _struct_code(v)
+                if code is None:
+                    code = "%ds" % size
+                    self._converted.append(i)
+            if ptr == 8 and size > 8:
+                raise TypeError("Arguments of more than 8 bytes are passed by reference on x64.")
+            span = -(-size // ptr) * ptr
+            fmt += code + "x" * (span - size)
+            args.append((offset, span, code in "fd"))
+            offset += span
+        if offset < 8:
+            # Room for a double return value on x86.
+            fmt += "x" * (8 - offset)
+        self.struct = struct.Struct(fmt)
+
+        float_return = _struct_code(restype) if restype is not None else None
+        if float_return not in ("f", "d"):
+            float_return = None
+        self.result_in_frame = float_return == "d" and ptr == 4
+        if float_return is not None:
+            self._result = struct.Struct("<" + float_return)
+        else:
+            self._result = struct.Struct("<Q" if ptr == 8 else "<I")
+
+        if convention == "x64":
+            self.code = _x64_stub_code(address, [(offset, is_float) for offset, _, is_float in args], float_return)
+        elif convention in ("stdcall", "fastcall"):
+            registers = list()
+            if convention == "fastcall":
+                # The first two integer arguments that fit in a register go in ecx and edx.
+                registers = [offset for offset, span, is_float in args if span == 4 and not is_float][:2]
+            pushed = [offset + dword for offset, span, _ in args if offset not in registers for dword in range(0, span, 4)]
+            registers += [None] * (2 - len(registers))
+            self.code = _x86_stub_code(address, pushed, registers[0], registers[1], float_return)
+        else:
+            raise ValueError("Unknown calling convention %r." % convention)
+
+    def __repr__(self):
+        return "<CallStub %s 0x%08x (%s)>" % (self.convention, self.address,
+            ", ".join(getattr(v, "__name__", str(v)) for v in self.argtypes))
+
+    def prepare(self, args):
+        """
+        Returns (values, buffers, size) of a call with args: the values to pack (the
+        call buffers are packed once placed), the list of (index, CallBuffer or None,
+        data) of the call buffers and the number of bytes the call takes.
+        """
+        if len(args) != len(self.argtypes):
+            raise TypeError("The function takes %d arguments (%d given)." % (len(self.argtypes), len(args)))
+        if not self._buffers and not self._converted:
+            return args, (), self.struct.size
+
+        values = list(args)
+        for i in self._converted:
+            # Instances of the type are passed as they are, tuples are its fields or items.
+            value = args[i]
+            if not isinstance(value, self.argtypes[i]):
+                value = self.argtypes[i](*value) if isinstance(value, tuple) else self.argtypes[i](value)
+            values[i] = bytes(value)
+        buffers = list()
+        size = self.struct.size
+        for i in self._buffers:
+            arg = args[i]
+            if isinstance(arg, CallBuffer):
+                data = arg.data
+            else:
+                data = b''.join(arg)
+                arg = None
+            buffers.append((i, arg, data))
+            values[i] = 0
+            size += (len(data) + 7) & ~7
+        return values, buffers, size
+
+    def coerce(self, values):
+        """Converts the values struct couldn't pack with their ctypes type."""
+        values = list(values)
+        for i, v in enumerate(self.argtypes):
+            if v is CallBuffer or i in self._converted:
+                continue
+            values[i] = v(values[i]).value or 0
+        return values
+
+    def decode(self, buffer, offset):
+        """Returns the return value stored at offset."""
+        value = self._result.unpack_from(buffer, offset)[0]
+        if self.restype is not None and self._result.format not in ("<f", "<d"):
+            value = self.restype(value).value
+        return value
+
+
 class ProcessCaller(object):
+    """
+    Calls functions of a process from a worker thread living in it.
+
+    A single remote thread is created with the caller, it waits on an event for
+    commands posted in a ring of slots in a SharedMemBuffer, runs them and signals
+    another event when they are done. A call is then a few writes in shared memory
+    and a SetEvent instead of a CreateRemoteThread.
+
+    Layout of the shared buffer (every field is 8 bytes wide, for both bitnesses):
+        0x00 head       u32, number of commands posted (written by the caller)
+        0x04 tail       u32, number of commands done (written by the worker)
+        0x08 stop       u32, the worker exits when it is set and the ring is empty
+        0x10 cmd_event  event signaled when commands are posted
+        0x18 done_event event signaled when a command is done
+        0x20 address of WaitForSingleObject
+        0x28 address of SetEvent
+        0x40 ring of _RING_SIZE slots of 0x20 bytes:
+            0x00 stub, 0x08 frame, 0x10 result, 0x18 seq u32, 0x1C done u32
+    A command calls stub(frame), the CallStub compiled for the function loads its
+    arguments from the frame, calls it and returns its result. The worker copies
+    seq into done once the result is stored.
+    The frames and the CallBuffer's of the calls are allocated in the frame pool
+    (from 0x1000 to the end of the buffer) and freed once their results are
+    collected, so calls can be posted from many threads without overlapping.
+
+    Calls return a CallFuture, so many calls can be posted before waiting for them.
+    The calls of a CallBatch are posted as call lists run by the batch stub.
+
+    Properties:
+        - process
+        - stack
+        - worker
+    """
 
     '''
-      stdcall:
-            push ebp
-            mov ebp, esp
-            mov esp, dword[esp+8]
-            pop eax
-            call eax
+        worker_x86:
+            push ebx
+            push esi
+            mov ebx, dword[esp+0xC]
+        wait_loop:
+            mov eax, dword[ebx+4]
+            cmp eax, dword[ebx]
+            jne run
+            cmp dword[ebx+8], 0
+            jne done
+            push -1
+            push dword[ebx+0x10]
+            call dword[ebx+0x20]
+            jmp wait_loop
+        run:
+            and eax, 0x3F
+            shl eax, 5
+            lea esi, [ebx+eax+0x40]
+            push dword[esi+8]
+            call dword[esi]
+            mov dword[esi+0x10], eax
+            mov eax, dword[esi+0x18]
+            mov dword[esi+0x1C], eax
+            inc dword[ebx+4]
+            push dword[ebx+0x18]
+            call dword[ebx+0x28]
+            jmp wait_loop
+        done:
+            pop esi
+            pop ebx
             xor eax, eax
-            mov esp, ebp
-            pop ebp
-            ret 4   
+            ret 4
+    '''
+    _worker_x86_code = b"\x53\x56\x8B\x5C\x24\x0C\x8B\x43\x04\x3B\x03\x75\x10\x83\x7B\x08\x00\x75\x2D\x6A\xFF\xFF\x73\x10\xFF\x53\x20\xEB\xE9\x83\xE0\x3F\xC1\xE0\x05\x8D\x74\x03\x40\xFF\x76\x08\xFF\x16\x89\x46\x10\x8B\x46\x18\x89\x46\x1C\xFF\x43\x04\xFF\x73\x18\xFF\x53\x28\xEB\xC6\x5E\x5B\x31\xC0\xC2\x04\x00"
+    '''
+        worker_x64:
+            push rbx
+            push rsi
+            sub rsp, 0x28
+            mov rbx, rcx
+        wait_loop:
+            mov eax, dword[rbx+4]
+            cmp eax, dword[rbx]
+            jne run
+            cmp dword[rbx+8], 0
+            jne done
+            mov rcx, qword[rbx+0x10]
+            mov edx, -1
+            call qword[rbx+0x20]
+            jmp wait_loop
+        run:
+            and eax, 0x3F
+            shl eax, 5
+            lea rsi, [rbx+rax+0x40]
+            mov rcx, qword[rsi+8]
+            call qword[rsi]
+            mov qword[rsi+0x10], rax
+            mov eax, dword[rsi+0x18]
+            mov dword[rsi+0x1C], eax
+            inc dword[rbx+4]
+            mov rcx, qword[rbx+0x18]
+            call qword[rbx+0x28]
+            jmp wait_loop
+        done:
+            add rsp, 0x28
+            pop rsi
+            pop rbx
+            xor eax, eax
+            ret
     '''
-    _stdcall_code = b"\x55\x89\xE5\x8B\x64\x24\x08\x58\xFF\xD0\x31\xC0\x89\xEC\x5D\xC2\x04\x00"
+    _worker_x64_code = b"\x53\x56\x48\x83\xEC\x28\x48\x89\xCB\x8B\x43\x04\x3B\x03\x75\x14\x83\x7B\x08\x00\x75\x35\x48\x8B\x4B\x10\xBA\xFF\xFF\xFF\xFF\xFF\x53\x20\xEB\xE5\x83\xE0\x3F\xC1\xE0\x05\x48\x8D\x74\x03\x40\x48\x8B\x4E\x08\xFF\x16\x48\x89\x46\x10\x8B\x46\x18\x89\x46\x1C\xFF\x43\x04\x48\x8B\x4B\x18\xFF\x53\x28\xEB\xBE\x48\x83\xC4\x28\x5E\x5B\x31\xC0\xC3"
     '''
-        fastcall:
+        batch_x86:
             push ebp
             mov ebp, esp
-            mov esp, dword[esp+8]
-            pop eax
-            pop ecx
-            pop edx
-            call eax
-            xor eax, eax
-            mov esp, ebp
+            push esi
+            push edi
+            mov esi, dword[ebp+8]
+            mov edi, dword[esi]
+            add esi, 4
+        next_call:
+            test edi, edi
+            jz done
+            push dword[esi+4]
+            call dword[esi]
+            mov dword[esi+8], eax
+            add esi, 12
+            dec edi
+            jmp next_call
+        done:
+            mov eax, dword[ebp+8]
+            mov eax, dword[eax]
+            pop edi
+            pop esi
             pop ebp
-            ret 4 
+            ret 4
     '''
-    _fastcall_code = b"\x55\x89\xE5\x8B\x64\x24\x08\x58\x59\x5A\xFF\xD0\x31\xC0\x89\xEC\x5D\xC2\x04\x00"
+    _batch_x86_code = b"\x55\x89\xE5\x56\x57\x8B\x75\x08\x8B\x3E\x83\xC6\x04\x85\xFF\x74\x0E\xFF\x76\x04\xFF\x16\x89\x46\x08\x83\xC6\x0C\x4F\xEB\xEE\x8B\x45\x08\x8B\x00\x5F\x5E\x5D\xC2\x04\x00"
     '''
-        x64call:
-            push rbp
-            mov rbp, rsp
-            mov rsp, rcx
-            pop rax
-            pop rcx
-            pop rdx
-            pop r8
-            pop r9
-            call rax
-            xor rax, rax
-            mov rsp, rbp
-            pop rbp
-            ret 
+        batch_x64:
+            push rsi
+            push rdi
+            push rbx
+            sub rsp, 0x20
+            mov rbx, rcx
+            mov rdi, qword[rcx]
+            lea rsi, [rcx+8]
+        next_call:
+            test rdi, rdi
+            jz done
+            mov rcx, qword[rsi+8]
+            call qword[rsi]
+            mov qword[rsi+0x10], rax
+            add rsi, 0x18
+            dec rdi
+            jmp next_call
+        done:
+            mov rax, qword[rbx]
+            add rsp, 0x20
+            pop rbx
+            pop rdi
+            pop rsi
+            ret
     '''
-    _x64call_code = b"\x55\x48\x89\xE5\x48\x89\xCC\x58\x59\x5A\x41\x58\x41\x59\xFF\xD0\x48\x31\xC0\x48\x89\xEC\x5D\xC3"
+    _batch_x64_code = b"\x56\x57\x53\x48\x83\xEC\x20\x48\x89\xCB\x48\x8B\x39\x48\x8D\x71\x08\x48\x85\xFF\x74\x13\x48\x8B\x4E\x08\xFF\x16\x48\x89\x46\x10\x48\x83\xC6\x18\x48\xFF\xCF\xEB\xE8\x48\x8B\x03\x48\x83\xC4\x20\x5B\x5F\x5E\xC3"
+
+    _HEAD = 0x00
+    _TAIL = 0x04
+    _STOP = 0x08
+    _CMD_EVENT = 0x10
+    _DONE_EVENT = 0x18
+    _RING = 0x40
+    _RING_SIZE = 64     # the workers mask the index with 0x3F
+    _SLOT_SIZE = 0x20
+    _SLOT_RESULT = 0x10
+    _SLOT_DONE = 0x1C
+    _FRAMES = 0x1000    # start of the frame pool
+    _BLOCK_SIZE = 0x40  # granularity of the frame allocator
+    _ARENA_SIZE = 0x10000
+
+    _SPIN_TIME = 0.00005
 
     def __init__(self,proc,stack_size=0x100000):
         self.process = proc
-        self._stdcall = proc.mmap(len(ProcessCaller._stdcall_code) + len(ProcessCaller._fastcall_code) + len(ProcessCaller._x64call_code))
-        self._fastcall = self._stdcall + len(ProcessCaller._stdcall_code)
-        self._x64call = self._fastcall + len(ProcessCaller._fastcall_code)
+        self.worker = None
+        self._ptr = struct.Struct("<Q") if win32.PROCESS_IS_64_BITS else struct.Struct("<I")
+        worker_code = ProcessCaller._worker_x64_code if win32.PROCESS_IS_64_BITS else ProcessCaller._worker_x86_code
+        batch_code = ProcessCaller._batch_x64_code if win32.PROCESS_IS_64_BITS else ProcessCaller._batch_x86_code
 
-        proc.write(self._stdcall, ProcessCaller._stdcall_code)
-        proc.write(self._fastcall, ProcessCaller._fastcall_code)
-        proc.write(self._x64call, ProcessCaller._x64call_code)
+        self._worker = proc.mmap(len(worker_code) + len(batch_code))
+        self._batch = self._worker + len(worker_code)
+        proc.write(self._worker, worker_code + batch_code)
+
+        # CallStub's compiled for the functions called, and the regions holding their code.
+        self._stubs = dict()
+        self._code_regions = list()
+        self._code_offset = self._code_end = 0
 
         self._stack_size = stack_size
         self._stackbuffer = proc.mapshared(stack_size)
-        self.stack = (BYTE * stack_size).from_address(self._stackbuffer.base_local)
+        self.stack = self._stackbuffer.data
+        self._view = self._stackbuffer.view
+
+        self._cmd_event = win32.CreateEventW(None, False, False, None)
+        self._done_event = win32.CreateEventW(None, False, False, None)
+        if not self._cmd_event or not self._done_event:
+            raise win32.Win32Exception()
+        self._remote_cmd_event = self._duplicate(self._cmd_event)
+        self._remote_done_event = self._duplicate(self._done_event)
+
+        # Resolved from the exports of the process' kernel32, a WoW64 process has its own.
+        kernel32 = proc.module("kernel32.dll")
+        struct.pack_into("<IIIIQQQQ", self._view, 0, 0, 0, 0, 0,
+            self._remote_cmd_event,
+            self._remote_done_event,
+            kernel32.get_proc_address("WaitForSingleObject"),
+            kernel32.get_proc_address("SetEvent"))
+
+        self._lock = threading.Lock()
+        self._head = 0
+        # head and tail are stored and loaded whole, struct.pack_into clears the field before packing it.
+        self._counters = self._stackbuffer.cast(c.c_uint32 * 2, ProcessCaller._HEAD)
+        # (futures, frame blocks) of the command of every slot of the ring
+        self._pending = [None] * ProcessCaller._RING_SIZE
+        self._batches = threading.local()
+        # One byte per block of the frame pool, non zero when the block is used.
+        self._blocks = bytearray((stack_size - ProcessCaller._FRAMES) // ProcessCaller._BLOCK_SIZE)
+        self.worker = proc.spawn_thread(self._worker, self._stackbuffer.base_remote)
+        self.worker.resume()
 
     def __del__(self):
-        self.process.unmap(self._stdcall)
+        if self.worker is not None:
+            struct.pack_into("<I", self._view, ProcessCaller._STOP, 1)
+            win32.SetEvent(self._cmd_event)
+            try:
+                self.worker.join(1000)
+            except win32.Win32Exception:
+                self.worker.kill()
+            self.worker = None
+        for handle in (self._remote_cmd_event, self._remote_done_event):
+            win32.DuplicateHandle(self.process.handle, handle, None, None, 0, False, win32.DUPLICATE_CLOSE_SOURCE)
+        win32.CloseHandle(self._cmd_event)
+        win32.CloseHandle(self._done_event)
+        self.process.unmap(self._worker)
+        for region in self._code_regions:
+            self.process.unmap(region)
+        self._counters = None
+        self._view = None
         self._stackbuffer = None
 
-    def x64call(self, address, *argtypes):
+    def _duplicate(self, handle):
+        """Duplicates a local handle in the process and returns its value there."""
+        remote = HANDLE()
+        success = win32.DuplicateHandle(win32.GetCurrentProcess(), handle, self.process.handle,
+            c.byref(remote), 0, False, win32.DUPLICATE_SAME_ACCESS)
+        if not success:
+            raise win32.Win32Exception()
+        return remote.value
+
+    def compile(self, convention, address, argtypes, restype=None):
+        """Returns the CallStub of the function at address, compiled in the process the first time."""
+        key = (convention, address, tuple(argtypes), restype)
+        stub = self._stubs.get(key)
+        if stub is None:
+            stub = CallStub(convention, address, argtypes, restype)
+            stub.remote = self._jit(stub.code)
+            self._stubs[key] = stub
+        return stub
+
+    def _jit(self, code):
+        """Writes code in the code arena of the caller and returns its remote address."""
+        with self._lock:
+            if self._code_offset + len(code) > self._code_end:
+                size = max(ProcessCaller._ARENA_SIZE, len(code))
+                region = self.process.mmap(size)
+                self._code_regions.append(region)
+                self._code_offset = region
+                self._code_end = region + size
+            addr = self._code_offset
+            self._code_offset += (len(code) + 0xF) & ~0xF
+        self.process.write(addr, code)
+        return addr
+
+    def _marshal(self, offset, stub, values, buffers):
+        """
+        Writes the frame of a call at offset in the shared buffer, the data of its call
+        buffers follow the frame. Returns the remote address of the frame and the list
+        of (CallBuffer, offset, size) to read back once the call is done.
+        """
+        remote = self._stackbuffer.base_remote
+        readback = list()
+        if buffers:
+            view = self._view
+            values = list(values)
+            position = offset + stub.struct.size
+            for i, arg, data in buffers:
+                view[position:position + len(data)] = data
+                values[i] = remote + position
+                if arg is not None:
+                    readback.append((arg, position, len(data)))
+                position += (len(data) + 7) & ~7
+        try:
+            stub.struct.pack_into(self._view, offset, *values)
+        except struct.error:
+            # Out of range or non native values, let ctypes convert them like it would.
+            stub.struct.pack_into(self._view, offset, *stub.coerce(values))
+        return remote + offset, readback
+
+    def _alloc(self, size):
+        """
+        Allocates size bytes in the frame pool, waits for calls to complete if it is full.
+        Returns the offset of the allocation and its (first block, block count).
+        """
+        count = -(-size // ProcessCaller._BLOCK_SIZE)
+        if count > len(self._blocks):
+            raise ValueError("The arguments don't fit in a call buffer of %d bytes." % self._stack_size)
+        free = bytes(count)
+        while True:
+            with self._lock:
+                index = self._blocks.find(free)
+                if index < 0:
+                    self._reclaim()
+                    index = self._blocks.find(free)
+                if index >= 0:
+                    self._blocks[index:index + count] = b'\1' * count
+                    return ProcessCaller._FRAMES + index * ProcessCaller._BLOCK_SIZE, (index, count)
+            if not self.worker.alive:
+                raise RuntimeError("The call worker of Process %d exited." % self.process.id)
+            win32.WaitForSingleObject(self._done_event, 1)
+
+    def _free(self, blocks):
+        index, count = blocks
+        with self._lock:
+            self._blocks[index:index + count] = bytes(count)
+
+    def _slot_done(self, slot, seq):
+        return struct.unpack_from("<I", self._view, slot + ProcessCaller._SLOT_DONE)[0] == seq
+
+    def _release(self, index):
+        """Collects the results of the done slot index and frees its frames, called with the lock held."""
+        futures, (block, count) = self._pending[index]
+        for future in futures:
+            future._collect()
+        self._blocks[block:block + count] = bytes(count)
+        self._pending[index] = None
+
+    def _reclaim(self):
+        """Releases every slot whose command is done, called with the lock held."""
+        for index, pending in enumerate(self._pending):
+            if pending is not None and pending[0][0].done():
+                self._release(index)
+
+    def _reserve(self):
+        """Returns the index of the next slot of the ring, None if the ring is full. Called with the lock held."""
+        if (self._head - self._counters[1]) & 0xFFFFFFFF >= ProcessCaller._RING_SIZE:
+            return None
+
+        index = self._head % ProcessCaller._RING_SIZE
+        # The slot is done, keep its results before they are overwritten.
+        if self._pending[index] is not None:
+            self._release(index)
+        return index
+
+    def _post(self, stub, frame, futures, blocks, result_offsets):
+        """Posts a command in the ring, waits for a free slot if it is full. Its frames are freed once its futures are collected."""
+        while True:
+            with self._lock:
+                index = self._reserve()
+                if index is not None:
+                    self._post_at(index, stub, frame, futures, blocks, result_offsets)
+                    return
+            # The ring is full, wait without the lock so the other threads can collect their results.
+            if not self.worker.alive:
+                raise RuntimeError("The call worker of Process %d exited." % self.process.id)
+            win32.WaitForSingleObject(self._done_event, 1)
+
+    def _post_at(self, index, stub, frame, futures, blocks, result_offsets):
+        """Writes a command in the slot index of the ring and signals the worker, called with the lock held."""
+        # seq is never 0, so a slot never used doesn't look done.
+        seq = (self._head + 1) & 0xFFFFFFFF or 1
+        slot = ProcessCaller._RING + index * ProcessCaller._SLOT_SIZE
+        struct.pack_into("<QQQI", self._view, slot, stub, frame, 0, seq)
+        for future, offset in zip(futures, result_offsets):
+            future._index = index
+            future._slot = slot
+            future._result_offset = slot + ProcessCaller._SLOT_RESULT if offset is None else offset
+            future.seq = seq
+        self._pending[index] = (futures, blocks)
+
+        self._head = (self._head + 1) & 0xFFFFFFFF
+        self._counters[0] = self._head
+        win32.SetEvent(self._cmd_event)
+
+    def _call(self, stub, args):
+        """Posts a call to stub in the ring (or queues it in the current batch) and returns its CallFuture."""
+        future = CallFuture(self, stub)
+        values, buffers, size = stub.prepare(args)
+        batch = getattr(self._batches, "current", None)
+        if batch is not None:
+            batch.calls.append((future, stub, values, buffers, size))
+            return future
+
+        # The frame is only used by this call, it is written without holding the lock.
+        offset, blocks = self._alloc(size)
+        try:
+            frame, future._buffers = self._marshal(offset, stub, values, buffers)
+            self._post(stub.remote, frame, [future], blocks, [offset if stub.result_in_frame else None])
+        except Exception:
+            self._free(blocks)
+            raise
+        return future
+
+    def _submit_batch(self, calls):
+        """
+        Posts the calls of a batch as call lists run by the batch stub, the calls
+        are grouped in lists of at most a quarter of the frame pool.
+        A call list is [count, (stub, frame, result) * count] in pointer sized values.
+        """
+        ptr = self._ptr.size
+        limit = len(self._blocks) * ProcessCaller._BLOCK_SIZE // 4
+        i = 0
+        while i < len(calls):
+            # Every call takes its own size and 3 values of the list.
+            size = ptr + calls[i][4] + 3 * ptr
+            count = 1
+            for call in calls[i + 1:]:
+                if size + call[4] + 3 * ptr > limit:
+                    break
+                size += call[4] + 3 * ptr
+                count += 1
+            group = calls[i:i + count]
+
+            offset, blocks = self._alloc(size)
+            try:
+                entries = list()
+                futures = list()
+                results = list()
+                for future, stub, values, buffers, call_size in group:
+                    frame, future._buffers = self._marshal(offset, stub, values, buffers)
+                    results.append(offset if stub.result_in_frame else None)
+                    entries += [stub.remote, frame, 0]
+                    futures.append(future)
+                    offset += call_size
+                self._view[offset:offset + ptr * (1 + len(entries))] = b''.join(
+                    self._ptr.pack(v) for v in [len(group)] + entries)
+                results = [offset + ptr * (3 + 3 * j) if result is None else result for j, result in enumerate(results)]
+                self._post(self._batch, self._stackbuffer.base_remote + offset, futures, blocks, results)
+            except Exception:
+                self._free(blocks)
+                raise
+            i += count
+
+    def _wait(self, future, timeout=None):
+        """Waits until the call of future is done."""
+        spin_end = time.perf_counter() + ProcessCaller._SPIN_TIME
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not future.done():
+            if time.perf_counter() < spin_end:
+                continue
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError("The remote call didn't complete in %r seconds." % timeout)
+            if not self.worker.alive:
+                raise RuntimeError("The call worker of Process %d exited." % self.process.id)
+            win32.WaitForSingleObject(self._done_event, 1)
+
+    def batch(self):
+        """
+        Returns a CallBatch, the calls made in its with block by the current thread
+        are queued and posted together when the block ends.
+        """
+        return CallBatch(self)
+
+    def x64call(self, address, *argtypes, restype=None):
+        stub = self.compile("x64", address, argtypes, restype)
         def _fn(*args):
-            cargs = [LPVOID(address)]
-            offset = 0
-            for i, v in enumerate(argtypes):
-                if v is CallBuffer:
-                    base = offset
-                    d = b''.join(args[i])
-                    offset += len(d)
-                    self.stack[base:offset] = list(d)
-                    cargs.append(LPVOID(self._stackbuffer.base_remote + base))
-                else:
-                    cargs.append(v(args[i]))
-            data = b''.join(cargs)
-            base = self._stack_size - max(len(data),0x38)
-            offset = base + len(data)
-            ptr = self._stackbuffer.base_remote + base
-            self.stack[base:offset] = list(data)
-            self.process.spawn_thread(self._x64call, ptr).resume()
+            return self._call(stub, args)
         return _fn
 
-    def fastcall(self, address, *argtypes):
+    def fastcall(self, address, *argtypes, restype=None):
+        stub = self.compile("fastcall", address, argtypes, restype)
         def _fn(*args):
-            cargs = [LPVOID(address)]
-            offset = 0
-            for i, v in enumerate(argtypes):
-                if v is CallBuffer:
-                    base = offset
-                    d = b''.join(args[i])
-                    offset += len(d)
-                    self.stack[base:offset] = list(d)
-                    cargs.append(LPVOID(self._stackbuffer.base_remote + base))
-                else:
-                    cargs.append(v(args[i]))
-            data = b''.join(cargs)
-            base = self._stack_size - max(len(data),0x38)
-            offset = base + len(data)
-            ptr = self._stackbuffer.base_remote + base
-            self.stack[base:offset] = list(data)
-            self.process.spawn_thread(self._fastcall, ptr).resume()
+            return self._call(stub, args)
         return _fn
 
-    def stdcall(self, address, *argtypes):
+    def stdcall(self, address, *argtypes, restype=None):
+        stub = self.compile("stdcall", address, argtypes, restype)
         def _fn(*args):
-            cargs = [LPVOID(address)]
-            offset = 0
-            for i, v in enumerate(argtypes):
-                if v is CallBuffer:
-                    base = offset
-                    d = b''.join(args[i])
-                    offset += len(d)
-                    self.stack[base:offset] = list(d)
-                    cargs.append(LPVOID(self._stackbuffer.base_remote + base))
-                else:
-                    cargs.append(v(args[i]))
-            data = b''.join(cargs)
-            base = self._stack_size - max(len(data),0x38)
-            offset = base + len(data)
-            ptr = self._stackbuffer.base_remote + base
-            self.stack[base:offset] = list(data)
-            self.process.spawn_thread(self._stdcall, ptr).resume()
-        return _fn
\ No newline at end of file
+            return self._call(stub, args)
+        return _fn
+
+
+class CallFuture(object):
+    """
+    The pending result of a call posted to a ProcessCaller.
+
+    result() waits for the call and returns its return value, converted with the
+    restype of the function (a ctypes type) if it has one. Once the call is
+    done, the CallBuffer's passed to it hold what the function wrote in them.
+    A CallFuture can also be awaited from a coroutine.
+
+    e.g.
+    GetTickCount = proc.stdcall(addr, restype=DWORD)
+    ticks = GetTickCount().result(timeout=1)
+    ticks = await GetTickCount()
+
+    Properties:
+        - caller
+        - stub
+        - seq
+    """
+
+    __slots__ = ("caller", "stub", "seq", "_index", "_slot", "_result_offset", "_buffers", "_collected", "_result")
+
+    def __init__(self, caller, stub):
+        self.caller = caller
+        self.stub = stub
+        self.seq = None
+        self._index = None
+        self._slot = None
+        self._result_offset = None
+        self._buffers = None
+        self._collected = False
+        self._result = None
+
+    def __repr__(self):
+        if self._slot is None:
+            state = "queued"
+        else:
+            state = "done" if self.done() else "pending"
+        return "<CallFuture %s>" % state
+
+    def __await__(self):
+        return self._wait_async().__await__()
+
+    def done(self):
+        """Checks if the call completed."""
+        if self._collected:
+            return True
+        return self._slot is not None and self.caller._slot_done(self._slot, self.seq)
+
+    def result(self, timeout=None):
+        """Waits at most timeout seconds (forever if None) for the call and returns its result."""
+        if not self._collected:
+            if self._slot is None:
+                raise RuntimeError("The call is queued in a batch that wasn't posted yet.")
+            self.caller._wait(self, timeout)
+            with self.caller._lock:
+                # The slot may have been reused (and this future collected) meanwhile.
+                if not self._collected:
+                    self.caller._release(self._index)
+        return self._result
+
+    def _collect(self):
+        """Reads the result and the out buffers, called with the lock of the caller held."""
+        if self._collected:
+            return
+        caller = self.caller
+        value = self.stub.decode(caller._view, self._result_offset)
+        for buffer, offset, size in self._buffers:
+            buffer.data = bytes(caller._view[offset:offset + size])
+        self._result = value
+        self._buffers = None
+        self._collected = True
+
+    async def _wait_async(self):
+        delay = 0
+        while not self.done():
+            await asyncio.sleep(delay)
+            delay = min(delay * 2 or 0.0001, 0.005)
+        return self.result()
+
+
+class CallBatch(object):
+    """
+    Calls queued to be run by the worker of a ProcessCaller in one go.
+
+    In the with block of a batch, the calls made by the current thread return
+    their CallFuture right away and are posted when the block ends. The worker
+    runs them in order with a single command of the ring (one per frame worth of
+    arguments), so a burst of calls costs one signal both ways.
+
+    e.g.
+    with proc.batch() as batch:
+        for packet in packets:
+            conn.send(len(packet), packet)
+    batch.results()
+
+    Properties:
+        - caller
+        - calls
+        - futures
+    """
+
+    def __init__(self, caller):
+        self.caller = caller
+        self.calls = list()
+        self.futures = list()
+        self._previous = None
+
+    def __repr__(self):
+        return "<CallBatch %d queued, %d posted>" % (len(self.calls), len(self.futures))
+
+    def __enter__(self):
+        self._previous = getattr(self.caller._batches, "current", None)
+        self.caller._batches.current = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.caller._batches.current = self._previous
+        self._previous = None
+        if exc_type is None:
+            self.flush()
+        else:
+            self.calls = list()
+
+    def flush(self):
+        """Posts the calls queued so far."""
+        calls, self.calls = self.calls, list()
+        if calls:
+            self.caller._submit_batch(calls)
+            self.futures += [call[0] for call in calls]
+
+    def results(self, timeout=None):
+        """Waits for all the posted calls and returns their results."""
+        return [future.result(timeout) for future in self.futures]
@@ -1,25 +1,36 @@
 from memlib import *
 
 proc = Process.from_name("Gw.exe")
-scan = ProcessScanner(proc)
-
-agent_array_addr  = scan.find(b"\x56\x8B\xF1\x3B\xF0\x72\x04", 0xC)
-agent_array_addr  = proc.read(agent_array_addr, 'P')
-player_id_addr    = proc.read(agent_array_addr + 0x54, 'P')
-target_id_addr    = proc.read(agent_array_addr + 0x500, 'P')
-mouseover_id_addr = proc.read(agent_array_addr + 0x4F4, 'P')
-
-send_packet_addr  = scan.find(b"\x55\x8B\xEC\x83\xEC\x2C\x53\x56\x57\x8B\xF9\x85")
-
-gs_conn_addr      = scan.find(b"\x56\x33\xF6\x3B\xCE\x74\x0E\x56\x33\xD2", -4)
-gs_conn_addr      = proc.read(gs_conn_addr, 'P')
-
-map_id_addr       = scan.find(b"\xB0\x7F\x8D\x55", 0x46)
-map_id_addr       = proc.read(map_id_addr, 'P')
-
-thread_ctx_addr   = scan.find(b"\x8B\x42\x0C\x56\x8B\x35", 6)
-thread_ctx_addr   = proc.read(thread_ctx_addr, 'P')
+with SignatureCache() as cache:
+    scan = ProcessScanner(proc, cache)
+    addrs = scan.find_all({
+        'agent_array': ("56 8B F1 3B F0 72 04", 0xC),
+        'send_packet': "55 8B EC 83 EC 2C 53 56 57 8B F9 85",
+        'gs_conn':     ("56 33 F6 3B CE 74 0E 56 33 D2", -4),
+        'map_id':      ("B0 7F 8D 55", 0x46),
+        'thread_ctx':  ("8B 42 0C 56 8B 35", 6),
+    })
+
+(
+    agent_array_addr,
+    player_id_addr,
+    target_id_addr,
+    mouseover_id_addr,
+    gs_conn_addr,
+    map_id_addr,
+    thread_ctx_addr,
+) = proc.resolve_many([
+    PointerPath(addrs['agent_array'], [0]),
+    PointerPath(addrs['agent_array'], [0x54, 0]),
+    PointerPath(addrs['agent_array'], [0x500, 0]),
+    PointerPath(addrs['agent_array'], [0x4F4, 0]),
+    PointerPath(addrs['gs_conn'], [0]),
+    PointerPath(addrs['map_id'], [0]),
+    PointerPath(addrs['thread_ctx'], [0]),
+])
+
+send_packet_addr  = addrs['send_packet']
 
 
 scan = None
-proc = None
\ No newline at end of file
+proc = None
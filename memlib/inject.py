@@ -6,12 +6,11 @@ def InjectDll(proc, name):
     class InjectionError(RuntimeError):
         pass
         
-    kernel32 = win32.GetModuleHandleA(b"kernel32")
-    if not kernel32:
-        raise win32.Win32Exception()
-    LoadLibraryEx = win32.GetProcAddress(kernel32, b"LoadLibraryA")
+    # Resolved from the exports of the kernel32 of the process, which may not be
+    # mapped at the same address (or have the same bitness) as ours.
+    LoadLibraryEx = proc.module("kernel32.dll").get_proc_address("LoadLibraryA")
     if not LoadLibraryEx:
-        raise win32.Win32Exception()
+        raise InjectionError("LoadLibraryA is not exported by kernel32.dll")
     size = len(name) + 1
     path = proc.mmap(size)
     if not path:
@@ -24,12 +23,9 @@ def InjectDll(proc, name):
     return retval
 
 def EjectDll(proc, handle):
-    kernel32 = win32.GetModuleHandleA(b"kernel32")
-    if not kernel32:
-        raise win32.Win32Exception()
-    FreeLibraryEx = win32.GetProcAddress(kernel32, b"FreeLibraryA")
+    FreeLibraryEx = proc.module("kernel32.dll").get_proc_address("FreeLibrary")
     if not FreeLibraryEx:
-        raise win32.Win32Exception()
+        raise RuntimeError("FreeLibrary is not exported by kernel32.dll")
     thread = proc.spawn_thread(FreeLibraryEx, handle)
     thread.resume()
     retval = thread.join()
@@ -0,0 +1,114 @@
+from ctypes import (
+    Structure,
+    POINTER,
+    c_int,
+    c_ulong,
+    c_void_p,
+    c_size_t,
+    c_ssize_t
+)
+
+import os
+import sys
+import ctypes
+
+from . import win32
+
+pid_t = c_int
+
+# Largest number of iovec a single process_vm_readv/writev call accepts.
+IOV_MAX = 1024
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 0x1000
+
+# Convert the "rwxp" permissions of /proc/<pid>/maps to Win32 page protections,
+# so that callers of Process.page_info don't have to care about the backend.
+_PERMISSIONS_TO_PROTECT = {
+    "---": win32.PAGE_NOACCESS,
+    "r--": win32.PAGE_READONLY,
+    "rw-": win32.PAGE_READWRITE,
+    "-w-": win32.PAGE_READWRITE,
+    "--x": win32.PAGE_EXECUTE,
+    "r-x": win32.PAGE_EXECUTE_READ,
+    "rwx": win32.PAGE_EXECUTE_READWRITE,
+    "-wx": win32.PAGE_EXECUTE_READWRITE,
+}
+
+
+class iovec(Structure):
+    _fields_ = [
+        ("iov_base", c_void_p),
+        ("iov_len", c_size_t),
+    ]
+
+
+class MapsEntry(object):
+    """
+    A line of /proc/<pid>/maps.
+
+    Properties:
+        - start
+        - end
+        - perms
+        - offset
+        - inode
+        - path
+    """
+
+    __slots__ = ("start", "end", "perms", "offset", "inode", "path")
+
+    def __init__(self, start, end, perms, offset, inode, path):
+        self.start = start
+        self.end = end
+        self.perms = perms
+        self.offset = offset
+        self.inode = inode
+        self.path = path
+
+    def __repr__(self):
+        return "<MapsEntry 0x%x-0x%x %s %s>" % (self.start, self.end, self.perms, self.path)
+
+    @property
+    def size(self):
+        return self.end - self.start
+
+    @property
+    def protect(self):
+        """Returns the Win32 page protection equivalent to the permissions."""
+        return _PERMISSIONS_TO_PROTECT[self.perms[:3]]
+
+
+def read_maps(pid):
+    """Returns the MapsEntry's list of a process, sorted by address."""
+    entries = list()
+    with open("/proc/%d/maps" % pid, "r") as f:
+        for line in f:
+            # The path is optional and can contain spaces.
+            fields = line.split(None, 5)
+            start, end = fields[0].split("-")
+            path = fields[5].rstrip("\n") if len(fields) > 5 else ""
+            entries.append(
+                MapsEntry(int(start, 16), int(end, 16), fields[1], int(fields[2], 16), int(fields[4]), path)
+            )
+    return entries
+
+
+if sys.platform.startswith("linux"):
+    libc = ctypes.CDLL(None, use_errno=True)
+
+    process_vm_readv = libc.process_vm_readv
+    process_vm_readv.argtypes = [pid_t, POINTER(iovec), c_ulong, POINTER(iovec), c_ulong, c_ulong]
+    process_vm_readv.restype = c_ssize_t
+    process_vm_writev = libc.process_vm_writev
+    process_vm_writev.argtypes = [pid_t, POINTER(iovec), c_ulong, POINTER(iovec), c_ulong, c_ulong]
+    process_vm_writev.restype = c_ssize_t
+else:
+    libc = None
+
+
+class LinuxException(OSError):
+    """Exception class for Linux runtime errors."""
+
+    def __init__(self, error=None, message=None):
+        error = error or ctypes.get_errno()
+        super(LinuxException, self).__init__(error, message or os.strerror(error))
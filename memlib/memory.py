@@ -1,13 +1,49 @@
 from . import win32
+from . import utils
 import ctypes as c
+import weakref
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class SharedMemBuffer(object):
+    """
+    Memory mapped both in this process and in a remote process.
+
+    The local mapping is exposed without copies: data is a ctypes array over
+    it, view a memoryview, and array/cast/pack_into/unpack_from give typed
+    access at an offset. What is written there is seen right away by the
+    remote process at base_remote + offset, without any ReadProcessMemory.
+    Pass data or view, not the buffer itself, to the functions taking a
+    buffer (memoryview(), numpy.frombuffer(), struct.pack_into, ...).
+
+    close() releases the buffer, the memory is unmapped once the last view of
+    it (from array, cast or memoryview) is released too.
+
+    e.g.
+    mem = proc.mapshared(0x1000)
+    mem.pack_into('II', 0, 1, 2)
+    counters = mem.array('u4', 0x100, 16)
+
+    Properties:
+        - process
+        - size
+        - base_local
+        - base_remote
+        - data
+        - view
+    """
+
     def __init__(self, process, size, name=None):
         self.process = process
         self.base_local = 0
         self.base_remote = 0
         self.size = size
         self.name = name
+        self.data = None
+        self.view = None
 
         self.map_handle = win32.kernel32.CreateFileMappingW(
             -1,
@@ -51,16 +87,113 @@ class SharedMemBuffer(object):
 
         self.base_remote = baddrbuf.value
 
+        # Every view of the buffer keeps data alive, the memory is unmapped when data is freed.
+        self.data = type("SharedMemData", (c.c_ubyte * size,), {}).from_address(self.base_local)
+        self.view = memoryview(self.data).cast("B")
+        weakref.finalize(self.data, _unmap_shared, self.process, self.base_remote, self.base_local, self.map_handle)
+
     def __del__(self):
-        result = win32.ntdll.NtUnmapViewOfSection(
-            self.process.handle,
-            self.base_remote
-        )
+        self.close()
+
+    def close(self):
+        """Releases the buffer, it is unmapped right away if no view of it is left."""
+        if self.view is not None:
+            try:
+                self.view.release()
+            except BufferError:
+                # Buffers taken from view are still alive, the memory stays mapped until they are released.
+                pass
+        self.view = None
+        self.data = None
+
+    def __repr__(self):
+        return "<SharedMemBuffer %d bytes, local 0x%08x, remote 0x%08x>" % (self.size, self.base_local, self.base_remote)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        return self.view[key]
+
+    def __setitem__(self, key, value):
+        self.view[key] = value
+
+    def remote(self, offset=0):
+        """Returns the address of offset in the remote process."""
+        return self.base_remote + offset
 
-        if result:
-            raise RuntimeError("Remote unmapping failed, err ", win32.kernel32.GetLastError(), ', ntstatus', result)
+    def cast(self, ctype, offset=0):
+        """Returns a ctypes instance of type ctype living in the buffer at offset."""
+        return ctype.from_buffer(self.data, offset)
+
+    def array(self, dtype, offset=0, count=-1):
+        """Returns a NumPy array of count items (up to the end if -1) of type dtype living in the buffer at offset."""
+        if numpy is None:
+            raise RuntimeError("NumPy is required to view the buffer as an array.")
+        return numpy.frombuffer(self.data, dtype, count, offset)
+
+    def pack_into(self, fmt, offset, *values):
+        """Packs values in the buffer at offset, see struct.pack_into."""
+        utils.get_struct(fmt).pack_into(self.view, offset, *values)
+
+    def unpack_from(self, fmt, offset=0):
+        """Unpacks values from the buffer at offset, see struct.unpack_from."""
+        return utils.get_struct(fmt).unpack_from(self.view, offset)
+
+def _unmap_shared(process, base_remote, base_local, map_handle):
+    """Unmaps both views of a SharedMemBuffer and closes its mapping, called once data is freed."""
+    errors = list()
+    result = win32.ntdll.NtUnmapViewOfSection(
+        process.handle,
+        c.c_void_p(base_remote)
+    )
+
+    if result:
+        errors.append(("Remote unmapping failed, err ", win32.kernel32.GetLastError(), ', ntstatus', result))
+
+    if not win32.kernel32.UnmapViewOfFile(c.c_void_p(base_local)):
+        errors.append(("Local unmapping failed, err ", win32.kernel32.GetLastError()))
+
+    win32.kernel32.CloseHandle(map_handle)
+    if errors:
+        raise RuntimeError(*errors[0])
+
+
+class MemoryRegion(object):
+    """
+    A range of pages sharing the same attributes in the address space of a process.
+
+    Properties:
+        - base
+        - size
+        - protect (PAGE_*)
+        - state (MEM_COMMIT, MEM_RESERVE or MEM_FREE)
+        - type (MEM_IMAGE, MEM_MAPPED or MEM_PRIVATE)
+    """
+
+    __slots__ = ("base", "size", "protect", "state", "type")
+
+    def __init__(self, base, size, protect, state, type):
+        self.base = base
+        self.size = size
+        self.protect = protect
+        self.state = state
+        self.type = type
+
+    def __repr__(self):
+        return "<MemoryRegion 0x%08x-0x%08x protect 0x%x state 0x%x type 0x%x>" % (
+            self.base, self.end, self.protect, self.state, self.type
+        )
 
-        if not win32.kernel32.MapViewOfFile(self.base_local):
-            raise RuntimeError("Local unmapping failed, err ", win32.kernel32.GetLastError(), ', ntstatus', result)
+    @property
+    def end(self):
+        return self.base + self.size
 
-        win32.kernel32.CloseHandle(self.map_handle)
\ No newline at end of file
+    @property
+    def readable(self):
+        """Checks if the region can be read with Process.read."""
+        if self.state != win32.MEM_COMMIT:
+            return False
+        if self.protect & (win32.PAGE_GUARD | win32.PAGE_NOACCESS):
+            return False
+        return self.protect != 0
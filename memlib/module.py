@@ -1,3 +1,9 @@
+from . import win32
+from .pe import PEFormatError, PEImage
+from bisect import bisect_right
+import threading
+import time
+
 class ProcessModule(object):
     """
     A Win32 process module object.
@@ -9,11 +15,14 @@ class ProcessModule(object):
         - base
         - size
         - file
+        - pe (PEImage of the module in the process memory, parsed on first access)
     """
 
     def __init__(self, handle, process):
         self.handle = handle
         self.pid = process.id
+        self.process = process
+        self._pe = None
 
         # make sure all properties are initialized
         self.name = None
@@ -30,6 +39,37 @@ class ProcessModule(object):
     def __repr__(self):
         return "<ProcessModule %s in Process %d>" % (str(self), self.pid)
 
+    @property
+    def pe(self):
+        if self._pe is None:
+            self._pe = PEImage.from_process(self.process, self.base)
+        return self._pe
+
+    def get_proc_address(self, name):
+        """
+        Returns the address of the function exported by name (or ordinal), the
+        forwarded functions are resolved in their module. None if there is no such export.
+
+        A function forwarded to an API set (api-ms-win-*, ext-ms-*) is looked up
+        in the DLLs which usually host them, then in every loaded module.
+        """
+        exports = self.pe.ordinals if isinstance(name, int) else self.pe.exports
+        target = exports.get(name)
+        if target is None or not isinstance(target, str):
+            return None if target is None else self.base + target
+
+        # Forwarded, e.g. 'NTDLL.RtlAllocateHeap' or 'dll.#12'
+        dll, function = target.rsplit(".", 1)
+        if "." not in dll:
+            dll += ".dll"
+        function = int(function[1:]) if function.startswith("#") else function
+        if dll.lower().startswith(_API_SET_PREFIXES):
+            module = self.process.module_map.get(dll)
+            if module is None:
+                return _api_set_address(self.process, function)
+            return module.get_proc_address(function)
+        return self.process.module(dll).get_proc_address(function)
+
     @classmethod
     def from_MODULEENTRY32(cls, module, process):
         mod = ProcessModule(module.hModule, process)
@@ -37,4 +77,135 @@ class ProcessModule(object):
         mod.base = module.modBaseAddr
         mod.size = module.modBaseSize
         mod.file = module.szExePath.decode("ascii")
-        return mod
\ No newline at end of file
+        return mod
+
+
+_API_SET_PREFIXES = ("api-ms-", "ext-ms-")
+_API_SET_HOSTS = ("kernelbase.dll", "ucrtbase.dll", "ntdll.dll", "kernel32.dll")
+
+
+def _api_set_address(process, function):
+    """
+    Returns the address of the function of an API set contract, exported by its
+    host without forwarding, or None. The API set schema itself isn't read.
+    """
+    if isinstance(function, int):
+        # The ordinals are the ones of the contract, not of its host.
+        return None
+    modules = process.module_map
+    hosts = [module for module in map(modules.get, _API_SET_HOSTS) if module is not None]
+    known = set(id(module) for module in hosts)
+    for module in hosts + [module for module in modules if id(module) not in known]:
+        try:
+            target = module.pe.exports.get(function)
+        except (PEFormatError, win32.Win32Exception, OSError):
+            continue
+        if target is not None and not isinstance(target, str):
+            return module.base + target
+    return None
+
+
+class ModuleMap(object):
+    """
+    The modules of a process sorted by base address, to find the module of an
+    address with a binary search, and indexed by name.
+
+    The map is filled on first use and only refreshed when a lookup misses (at
+    most once every refresh_interval seconds) or after invalidate(), e.g. on
+    the load and unload dll debug events.
+
+    e.g.
+    modules = proc.module_map
+    modules.symbolize(return_address) # 'kernel32.dll+0x1a2b'
+
+    Properties:
+        - proc
+        - main (the module of the executable)
+        - refresh_interval
+    """
+
+    def __init__(self, proc, refresh_interval=1.0):
+        self.proc = proc
+        self.refresh_interval = refresh_interval
+        self.main = None
+        # (bases, modules) sorted by base, swapped as a whole so lookups need no lock.
+        self._sorted = (list(), list())
+        self._names = dict()
+        self._stale = True
+        self._refreshed = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<ModuleMap %d modules of Process %d>" % (len(self._sorted[1]), self.proc.id)
+
+    def __len__(self):
+        self._ensure()
+        return len(self._sorted[1])
+
+    def __iter__(self):
+        self._ensure()
+        return iter(self._sorted[1])
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def invalidate(self):
+        """Marks the map as out of date, it is refreshed by the next lookup."""
+        self._stale = True
+
+    def refresh(self):
+        """Reads the modules of the process again and returns them, the main module first."""
+        modules = self.proc.backend.modules(self.proc)
+        ordered = sorted(modules, key=lambda module: module.base)
+        names = dict()
+        for module in modules:
+            names.setdefault(module.name, module)
+        with self._lock:
+            self.main = modules[0] if modules else None
+            self._sorted = ([module.base for module in ordered], ordered)
+            self._names = names
+            self._stale = False
+            self._refreshed = time.monotonic()
+        return modules
+
+    def _ensure(self):
+        if self._stale:
+            self.refresh()
+
+    def _refresh_on_miss(self):
+        """Refreshes the map after a miss, unless it was refreshed recently. Returns True if it did."""
+        if self._refreshed is not None and time.monotonic() - self._refreshed < self.refresh_interval:
+            return False
+        self.refresh()
+        return True
+
+    def _find(self, addr):
+        bases, modules = self._sorted
+        i = bisect_right(bases, addr) - 1
+        if i >= 0 and addr < modules[i].base + modules[i].size:
+            return modules[i]
+        return None
+
+    def module_at(self, addr):
+        """Returns the ProcessModule containing addr, None if it isn't in a module."""
+        self._ensure()
+        module = self._find(addr)
+        if module is None and self._refresh_on_miss():
+            module = self._find(addr)
+        return module
+
+    def get(self, name):
+        """Returns the ProcessModule named name (case insensitive), None if there is none."""
+        self._ensure()
+        name = name.lower()
+        module = self._names.get(name)
+        if module is None and self._refresh_on_miss():
+            module = self._names.get(name)
+        return module
+
+    def symbolize(self, addr):
+        """Returns addr as 'module+0xoffset', or '0xaddr' if it isn't in a module."""
+        module = self.module_at(addr)
+        if module is None:
+            return "0x%x" % addr
+        return "%s+0x%x" % (module.name, addr - module.base)
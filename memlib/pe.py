@@ -0,0 +1,383 @@
+from . import utils
+from collections import namedtuple
+import mmap
+import struct
+
+PESection = namedtuple("PESection", [
+    "name",             # e.g. '.text'
+    "rva",
+    "size",             # size in memory
+    "raw_offset",       # offset of the data in the file
+    "raw_size",
+    "characteristics",  # IMAGE_SCN_* flags
+])
+
+PEImport = namedtuple("PEImport", [
+    "dll",      # lower case name of the imported dll
+    "name",     # name of the function, None if imported by ordinal
+    "ordinal",  # ordinal if imported by ordinal, else None
+    "iat",      # rva of the entry of the import address table
+])
+
+PETls = namedtuple("PETls", [
+    "start",        # addresses are virtual addresses of the image, see PEImage.base
+    "end",
+    "index",
+    "callbacks",    # list of the addresses of the callbacks
+])
+
+IMAGE_DIRECTORY_ENTRY_EXPORT = 0
+IMAGE_DIRECTORY_ENTRY_IMPORT = 1
+IMAGE_DIRECTORY_ENTRY_TLS = 9
+IMAGE_DIRECTORY_ENTRY_IAT = 12
+
+IMAGE_SCN_MEM_EXECUTE = 0x20000000
+IMAGE_SCN_MEM_READ = 0x40000000
+IMAGE_SCN_MEM_WRITE = 0x80000000
+
+class PEFormatError(RuntimeError):
+    pass
+
+
+class PEImage(object):
+    """
+    A lazy view of a PE image (exe or dll), mapped in a process or read from a file.
+
+    The headers and the sections are parsed when the image is opened, the
+    export, import and TLS directories on their first access, then kept.
+    Addresses are rva's (relative to the base of the image) unless noted.
+
+    e.g.
+    pe = proc.module("kernel32.dll").pe
+    pe.exports["LoadLibraryA"]     # rva
+    pe.section(".text")
+
+    Properties:
+        - base (where the image is mapped, ImageBase for a file)
+        - machine
+        - x64
+        - image_base
+        - entry_point
+        - size_of_image
+        - sections
+        - directories (list of (rva, size))
+        - exports ({name: rva or forwarder 'dll.function'})
+        - ordinals ({ordinal: rva or forwarder})
+        - imports (list of PEImport)
+        - tls (PETls or None)
+    """
+
+    def __init__(self, read, mapped, base=None):
+        """
+        read(offset, size) returns the bytes at offset of the image, or less at its
+        end. mapped tells if the offsets are rva's (an image loaded in memory) or
+        offsets of a file.
+        """
+        self._read_raw = read
+        self._mapped = mapped
+        self._exports = None
+        self._ordinals = None
+        self._imports = None
+        self._tls = None
+        self._parse_headers()
+        self.base = self.image_base if base is None else base
+
+    def __repr__(self):
+        return "<PEImage %s at 0x%x, %d sections>" % ("x64" if self.x64 else "x86", self.base, len(self.sections))
+
+    @classmethod
+    def from_buffer(cls, data, mapped=True, base=None):
+        """Opens the image in data, laid out in memory if mapped or as a file else."""
+        view = memoryview(data).cast("B")
+        return cls(lambda offset, size: view[offset:offset + size], mapped, base)
+
+    @classmethod
+    def from_file(cls, path):
+        """Opens the PE file at path, it is mapped in memory and read on demand."""
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        pe = cls.from_buffer(data, mapped=False)
+        pe._file = data
+        return pe
+
+    @classmethod
+    def from_process(cls, proc, base):
+        """Opens the image mapped at base in proc, every section is read with one read when first needed."""
+        return cls(_RemoteImageReader(proc, base).read, True, base)
+
+    def _parse_headers(self):
+        read = self._read_raw
+        if bytes(read(0, 2)) != b"MZ":
+            raise PEFormatError("No DOS header.")
+        e_lfanew, = struct.unpack("<I", read(0x3C, 4))
+        header = bytes(read(e_lfanew, 0x108))
+        if header[:4] != b"PE\0\0":
+            raise PEFormatError("No PE header.")
+
+        self.machine, count, self.timestamp, _, _, optional_size, self.characteristics = struct.unpack_from("<HHIIIHH", header, 4)
+        optional = e_lfanew + 24
+        magic, = struct.unpack_from("<H", header, 24)
+        if magic == 0x20B:
+            self.x64 = True
+            self.image_base, = struct.unpack_from("<Q", header, 24 + 24)
+            directories = 24 + 112
+        elif magic == 0x10B:
+            self.x64 = False
+            self.image_base, = struct.unpack_from("<I", header, 24 + 28)
+            directories = 24 + 96
+        else:
+            raise PEFormatError("Unknown optional header magic 0x%x." % magic)
+        self.entry_point, = struct.unpack_from("<I", header, 24 + 16)
+        self.size_of_image, self.size_of_headers = struct.unpack_from("<II", header, 24 + 56)
+        self.subsystem, = struct.unpack_from("<H", header, 24 + 68)
+        directory_count, = struct.unpack_from("<I", header, directories - 4)
+
+        directory_count = min(directory_count, 16)
+        self.directories = [struct.unpack_from("<II", header, directories + 8 * i) for i in range(directory_count)]
+        self.directories += [(0, 0)] * (16 - directory_count)
+
+        data = bytes(read(optional + optional_size, 40 * count))
+        if len(data) < 40 * count:
+            raise PEFormatError("Truncated section table.")
+        self.sections = list()
+        for i in range(count):
+            name, size, rva, raw_size, raw_offset = struct.unpack_from("<8sIIII", data, 40 * i)
+            characteristics, = struct.unpack_from("<I", data, 40 * i + 36)
+            name = name.rstrip(b"\0").decode("ascii", "replace")
+            self.sections.append(PESection(name, rva, size or raw_size, raw_offset, raw_size, characteristics))
+
+    def section(self, name):
+        """Returns the first PESection named name, None if there is none."""
+        for section in self.sections:
+            if section.name == name:
+                return section
+        return None
+
+    def section_at(self, rva):
+        """Returns the PESection containing rva, None if it is in none."""
+        for section in self.sections:
+            if section.rva <= rva < section.rva + section.size:
+                return section
+        return None
+
+    def rva_to_offset(self, rva):
+        """Returns the offset of rva in the file, None if it has no data in the file."""
+        if rva < self.size_of_headers:
+            return rva
+        section = self.section_at(rva)
+        if section is None or rva - section.rva >= section.raw_size:
+            return None
+        return rva - section.rva + section.raw_offset
+
+    def read(self, rva, size):
+        """Returns the bytes at rva (zeros for the parts of the image that are not in the file)."""
+        if self._mapped:
+            return bytes(self._read_raw(rva, size))
+        data = b""
+        end = rva + size
+        while rva < end:
+            # Reads up to the end of the headers, of the section or of the gap before the next one.
+            section = self.section_at(rva)
+            if rva < self.size_of_headers:
+                offset, length, raw = rva, self.size_of_headers - rva, self.size_of_headers - rva
+            elif section is not None:
+                offset = section.raw_offset + rva - section.rva
+                length = section.rva + section.size - rva
+                raw = max(section.raw_size - (rva - section.rva), 0)
+            else:
+                following = [section.rva for section in self.sections if section.rva > rva]
+                offset, length, raw = None, min(following or [end]) - rva, 0
+            length = min(length, end - rva)
+            chunk = bytes(self._read_raw(offset, min(raw, length))) if raw else b""
+            data += chunk + bytes(length - len(chunk))
+            rva += length
+        return data
+
+    def read_string(self, rva, max_size=0x1000):
+        """Returns the null terminated ascii string at rva."""
+        data = b""
+        while len(data) < max_size:
+            chunk = self.read(rva + len(data), 0x100)
+            end = chunk.find(b"\0")
+            if end >= 0:
+                return (data + chunk[:end]).decode("ascii", "replace")
+            if not chunk:
+                break
+            data += chunk
+        return data[:max_size].decode("ascii", "replace")
+
+    def directory(self, index):
+        """Returns the (rva, size) of the data directory index (IMAGE_DIRECTORY_ENTRY_*)."""
+        return self.directories[index]
+
+    @property
+    def exports(self):
+        if self._exports is None:
+            self._parse_exports()
+        return self._exports
+
+    @property
+    def ordinals(self):
+        if self._ordinals is None:
+            self._parse_exports()
+        return self._ordinals
+
+    def _parse_exports(self):
+        exports = dict()
+        ordinals = dict()
+        rva, size = self.directory(IMAGE_DIRECTORY_ENTRY_EXPORT)
+        if rva:
+            header = self.read(rva, 40)
+            base, function_count, name_count, functions, names, name_ordinals = struct.unpack_from("<IIIIII", header, 16)
+            functions = struct.unpack("<%dI" % function_count, self.read(functions, 4 * function_count))
+            names = struct.unpack("<%dI" % name_count, self.read(names, 4 * name_count))
+            name_ordinals = struct.unpack("<%dH" % name_count, self.read(name_ordinals, 2 * name_count))
+
+            # An address inside the export directory is the name of a forwarded function.
+            targets = [self.read_string(function) if rva <= function < rva + size else function for function in functions]
+            for i, target in enumerate(targets):
+                if functions[i]:
+                    ordinals[base + i] = target
+            for name, index in zip(names, name_ordinals):
+                if index < function_count:
+                    exports[self.read_string(name)] = targets[index]
+        self._exports = exports
+        self._ordinals = ordinals
+
+    @property
+    def imports(self):
+        if self._imports is None:
+            self._imports = self._parse_imports()
+        return self._imports
+
+    def _parse_imports(self):
+        imports = list()
+        rva, size = self.directory(IMAGE_DIRECTORY_ENTRY_IMPORT)
+        if not rva:
+            return imports
+        thunk = struct.Struct("<Q" if self.x64 else "<I")
+        ordinal_flag = 1 << (thunk.size * 8 - 1)
+
+        while True:
+            lookup, _, _, name, iat = struct.unpack("<IIIII", self.read(rva, 20))
+            if not name and not iat:
+                break
+            rva += 20
+            dll = self.read_string(name).lower()
+            # Without lookup table, the IAT of a file still has the unbound values.
+            table = lookup or iat
+            index = 0
+            while True:
+                value, = thunk.unpack(self.read(table + index * thunk.size, thunk.size))
+                if not value:
+                    break
+                entry = iat + index * thunk.size
+                if value & ordinal_flag:
+                    imports.append(PEImport(dll, None, value & 0xFFFF, entry))
+                else:
+                    # Skips the hint
+                    imports.append(PEImport(dll, self.read_string((value & 0x7FFFFFFF) + 2), None, entry))
+                index += 1
+        return imports
+
+    def import_address(self, dll, name):
+        """Returns the rva of the IAT entry of the function name (or ordinal) imported from dll, None if it isn't imported."""
+        dll = dll.lower()
+        for entry in self.imports:
+            if entry.dll == dll and (entry.name == name or entry.ordinal == name):
+                return entry.iat
+        return None
+
+    @property
+    def tls(self):
+        if self._tls is None:
+            self._tls = self._parse_tls()
+        return self._tls or None
+
+    def _parse_tls(self):
+        rva, size = self.directory(IMAGE_DIRECTORY_ENTRY_TLS)
+        if not rva:
+            return False
+        ptr = struct.Struct("<Q" if self.x64 else "<I")
+        start, end, index, callbacks = struct.unpack("<4" + ptr.format[1:], self.read(rva, 4 * ptr.size))
+        addresses = list()
+        if callbacks:
+            offset = callbacks - self.base
+            while len(addresses) < 0x100:
+                address, = ptr.unpack(self.read(offset + len(addresses) * ptr.size, ptr.size))
+                if not address:
+                    break
+                addresses.append(address)
+        return PETls(start, end, index, addresses)
+
+    def close(self):
+        """Unmaps the file of an image opened with from_file."""
+        data = getattr(self, "_file", None)
+        if data is not None:
+            self._read_raw = None
+            self._file = None
+            data.close()
+
+
+class _RemoteImageReader(object):
+    """Reads an image in a process, a whole section at a time, the sections are kept."""
+
+    def __init__(self, proc, base):
+        self.proc = proc
+        self.base = base
+        self._chunks = list()  # (rva, bytes)
+        self._headers = None
+        self._sections = None
+
+    def _load(self, rva, size):
+        buffer = utils.create_buffer(size)
+        self.proc.read_into(self.base + rva, buffer, size)
+        data = bytes(buffer)
+        self._chunks.append((rva, data))
+        return data
+
+    def read(self, rva, size):
+        data = self._read_chunk(rva, size)
+        while len(data) < size:
+            # The range crosses the end of a chunk, the rest is in the next section.
+            rest = self._read_chunk(rva + len(data), size - len(data), sections_only=True)
+            if not rest:
+                break
+            data += rest
+        return data
+
+    def _read_chunk(self, rva, size, sections_only=False):
+        """Returns the bytes at rva up to the end of the chunk containing it."""
+        for start, data in self._chunks:
+            if start <= rva < start + len(data):
+                return data[rva - start:rva - start + size]
+
+        if self._headers is None:
+            # The first read is the header page, it gives the section table.
+            self._headers = self._load(0, 0x1000)
+            self._sections = _section_spans(self._headers)
+            return self._read_chunk(rva, size, sections_only)
+
+        for start, end in self._sections:
+            if start <= rva < end:
+                data = self._load(start, end - start)
+                return data[rva - start:rva - start + size]
+        if sections_only:
+            return b""
+        return self._load(rva, size)
+
+
+def _section_spans(headers):
+    """Returns the (start, end) rva's of the sections described in the headers, page aligned."""
+    try:
+        e_lfanew, = struct.unpack_from("<I", headers, 0x3C)
+        count, = struct.unpack_from("<H", headers, e_lfanew + 6)
+        optional_size, = struct.unpack_from("<H", headers, e_lfanew + 20)
+        table = e_lfanew + 24 + optional_size
+        spans = list()
+        for i in range(count):
+            size, rva, raw_size = struct.unpack_from("<III", headers, table + 40 * i + 8)
+            spans.append((rva, rva + ((size or raw_size) + 0xFFF & ~0xFFF)))
+        return spans
+    except struct.error:
+        return list()
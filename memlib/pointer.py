@@ -0,0 +1,126 @@
+from . import win32
+
+import time
+
+
+class PointerPath(object):
+    """
+    A chain of pointers starting at base.
+
+    Every offset dereferences the current address as a pointer and adds the
+    offset to it, the resolved address is the result of the last one:
+        PointerPath(addr, [0x54, 0x10]) == proc.read(proc.read(addr, 'P') + 0x54, 'P') + 0x10
+
+    If format is given, resolving the path reads the value at the resolved
+    address with that format instead.
+
+    Properties:
+        - base
+        - offsets
+        - format
+    """
+
+    __slots__ = ("base", "offsets", "format")
+
+    def __init__(self, base, offsets=(), format=None):
+        self.base = base
+        self.offsets = tuple(offsets)
+        self.format = format
+
+    def __eq__(self, other):
+        return (self.base, self.offsets, self.format) == (other.base, other.offsets, other.format)
+
+    def __hash__(self):
+        return hash((self.base, self.offsets, self.format))
+
+    def __repr__(self):
+        offsets = ", ".join("0x%x" % off for off in self.offsets)
+        return "<PointerPath 0x%08x [%s] %r>" % (self.base, offsets, self.format)
+
+
+class PointerResolver(object):
+    """
+    Resolves many PointerPath's at once.
+
+    The paths are walked level by level and every pointer of a level is read
+    with a single Process.read_many, a pointer shared by several paths (same
+    address) is read once. A path going through a null pointer resolves to None.
+
+    With a ttl (in seconds), the addresses resolved for every prefix of the
+    paths are cached, so only the pointers older than ttl are read again. The
+    expired entries are dropped at most once every ttl seconds.
+    """
+
+    def __init__(self, proc, ttl=None):
+        self.proc = proc
+        self.ttl = ttl
+        self._cache = dict()
+        self._next_purge = 0
+
+    def __repr__(self):
+        return "<PointerResolver for Process %d>" % self.proc.id
+
+    def invalidate(self):
+        """Drops every cached level."""
+        self._cache.clear()
+
+    def _purge(self, now):
+        """Drops the expired entries of the cache."""
+        self._cache = {key: entry for key, entry in self._cache.items() if entry[1] > now}
+        self._next_purge = now + self.ttl
+
+    def _read_many(self, items):
+        try:
+            return self.proc.read_many(items)
+        except (win32.Win32Exception, OSError):
+            # One of the pointers is dangling, find which one without failing the others.
+            values = list()
+            for addr, format in items:
+                try:
+                    values.append(self.proc.read(addr, format))
+                except (win32.Win32Exception, OSError):
+                    values.append(None)
+            return values
+
+    def resolve(self, path):
+        """Returns the resolved address (or value) of path."""
+        return self.resolve_many([path])[0]
+
+    def resolve_many(self, paths):
+        """Returns the list of the resolved addresses (or values) of paths."""
+        now = time.monotonic()
+        if self.ttl is not None and now >= self._next_purge:
+            self._purge(now)
+        current = [path.base for path in paths]
+        depth = max([len(path.offsets) for path in paths] or [0])
+
+        for level in range(depth):
+            pending = dict()
+            for i, path in enumerate(paths):
+                if level >= len(path.offsets) or current[i] is None:
+                    continue
+                key = (path.base, path.offsets[: level + 1])
+                if self.ttl is not None:
+                    entry = self._cache.get(key)
+                    if entry is not None and entry[1] > now:
+                        current[i] = entry[0]
+                        continue
+                pending.setdefault(current[i], list()).append((i, key))
+
+            if not pending:
+                continue
+
+            addrs = list(pending)
+            pointers = self._read_many([(addr, "P") for addr in addrs])
+            for addr, pointer in zip(addrs, pointers):
+                for i, key in pending[addr]:
+                    current[i] = pointer + paths[i].offsets[level] if pointer else None
+                    if self.ttl is not None:
+                        self._cache[key] = (current[i], now + self.ttl)
+
+        reads = [i for i, path in enumerate(paths) if path.format and current[i] is not None]
+        if reads:
+            values = self._read_many([(current[i], paths[i].format) for i in reads])
+            for i, value in zip(reads, values):
+                current[i] = value
+        return current
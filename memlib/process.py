@@ -4,9 +4,11 @@ from ctypes import (
     byref,
     sizeof
 )
+import os
 import struct
+import threading
 from ctypes.wintypes import *
-from .thread import ProcessThread
+from .thread import ProcessThread, ThreadRegistry
 
 from .memory import (
     SharedMemBuffer
@@ -17,9 +19,23 @@ from .function_caller import (
 )
 
 from .module import (
+    ModuleMap,
     ProcessModule
 )
 
+from .backend import (
+    UnsupportedOperation,
+    open_backend
+)
+
+from .pointer import (
+    PointerResolver
+)
+
+from .value_scan import (
+    ValueScan
+)
+
 
 class ModuleNotFoundError(RuntimeError):
     pass
@@ -29,26 +45,34 @@ class ProcessNotFoundError(RuntimeError):
 
 class Process(object):
     """
-    An object to interact with a Win32 remote process.
+    An object to interact with a remote process.
+
+    The memory accesses go through a MemoryBackend, by default the one of the
+    current platform (see backend.open_backend).
 
     Properties:
         - id
+        - backend
         - handle
         - name
         - threads
         - modules
     """
 
-    def __init__(self, pid, right=win32.PROCESS_ALL_ACCESS):
+    def __init__(self, pid, right=win32.PROCESS_ALL_ACCESS, backend=None):
         self.id = pid
-        self.handle = win32.OpenProcess(right, False, pid)
+        self.backend = backend or open_backend(pid, right)
+        self.handle = self.backend.handle
 
         self._fncaller = None
-        if not self.handle:
-            raise Win32Exception()
+        self._resolver = None
+        self._thread_registry = None
+        self._module_map = None
+        self._read_buffers = threading.local()
+        self._gather_buffers = threading.local()
 
     def __del__(self):
-        win32.CloseHandle(self.handle)
+        self.backend.close()
 
     def __eq__(self, other):
         return self.id == other.id
@@ -61,16 +85,22 @@ class Process(object):
         """Returns the name of the process."""
         return self.module().name
 
+    def _require_win32(self, operation):
+        if os.name != "nt":
+            raise UnsupportedOperation("%s uses the Win32 API, it isn't supported on this platform." % operation)
+
     def kill(self, code=0):
         """Terminates the Process with the given exit code."""
+        self._require_win32("Process.kill")
         success = win32.TerminateProcess(self.handle, code)
         if not success:
             raise win32.Win32Exception()
 
     def join(self, timeout=win32.INFINITE):
         """Wait until the Process terminates and Returns exit code"""
+        self._require_win32("Process.join")
         reason = win32.WaitForSingleObject(self.handle, timeout)
-        if reason != _WAIT_OBJECT_0:
+        if reason != win32.WAIT_OBJECT_0:
             raise RuntimeError("Thread has been terminated prematurely.")
         code = DWORD()
         success = win32.GetExitCodeProcess(self.handle, byref(code))
@@ -80,118 +110,201 @@ class Process(object):
 
     def flush(self, addr=None, size=0):
         """Flush the instruction cache for the process"""
-        win32.FlushInstructionCache(self.handle, addr, size)
+        self.backend.flush(addr, size)
 
     def write(self, addr, *data):
         """Writes in remote process at the given address the data."""
         binary = b"".join(data)
-        success = win32.WriteProcessMemory(self.handle, addr, binary, len(binary), None)
-        if not success:
-            raise win32.Win32Exception()
+        self.backend.write(addr, binary)
 
     def read(self, addr, format="I"):
         """Reads in remote process at given address and return the given format."""
-        size = struct.calcsize(format)
-        buffer = utils.create_buffer(size)
-        success = win32.ReadProcessMemory(self.handle, addr, byref(buffer), size, None)
-        if not success:
-            raise win32.Win32Exception()
-        t = struct.unpack(format, buffer)
+        st = utils.get_struct(format)
+        size = st.size
+        if size <= 0x100:
+            buffer = self._get_read_buffer(size)
+        else:
+            # Big reads (e.g. a whole section) would stay alive in the per-thread buffers.
+            buffer = utils.create_buffer(size)
+        self.backend.read_into(addr, buffer, size)
+        t = st.unpack_from(buffer)
         if len(t) == 1:
             return t[0]
         return t
 
+    def read_into(self, addr, buffer, size=None):
+        """
+        Reads in remote process at given address directly into buffer and returns it.
+
+        buffer is a ctypes object or a writable bytes-like object (bytearray,
+        memoryview, ...) and is filled entirely by default. No copy is made.
+        """
+        if size is None:
+            size = memoryview(buffer).nbytes
+        self.backend.read_into(addr, buffer, size)
+        return buffer
+
+    def read_struct(self, addr, type):
+        """Reads in remote process at given address an instance of the ctypes type."""
+        return self.read_into(addr, type(), sizeof(type))
+
+    def _get_read_buffer(self, size):
+        """Returns the reusable read buffer of exactly size bytes of the calling thread."""
+        buffers = self._read_buffers.__dict__
+        buffer = buffers.get(size)
+        if buffer is None:
+            buffer = buffers[size] = utils.create_buffer(size)
+        return buffer
+
+    def _get_gather_buffer(self, size):
+        """Returns the reusable read_many buffer of the calling thread, grown to at least size bytes."""
+        buffer = getattr(self._gather_buffers, "buffer", None)
+        if buffer is None or len(buffer) < size:
+            capacity = 0x100
+            while capacity < size:
+                capacity <<= 1
+            buffer = utils.create_buffer(capacity)
+            self._gather_buffers.buffer = buffer
+        return buffer
+
+    def read_many(self, items, max_gap=0x800):
+        """
+        Reads a list of (addr, format) and returns the list of values, like read does.
+
+        Ranges closer than max_gap bytes are coalesced and all the ranges are read
+        with a single backend.readv into the reusable buffer of the process.
+        max_gap must stay below the page size, the gaps are read too.
+        """
+        items = [(addr, utils.get_struct(format)) for addr, format in items]
+        order = sorted(range(len(items)), key=lambda i: items[i][0])
+
+        ranges = list()
+        location = [None] * len(items)
+        for i in order:
+            addr, st = items[i]
+            end = addr + st.size
+            if ranges and addr <= ranges[-1][1] + max_gap:
+                last = ranges[-1]
+                last[1] = max(last[1], end)
+            else:
+                ranges.append([addr, end])
+            location[i] = (len(ranges) - 1, addr - ranges[-1][0])
+
+        offsets = list()
+        total = 0
+        for start, end in ranges:
+            offsets.append(total)
+            total += end - start
+
+        buffer = self._get_gather_buffer(total)
+        self.backend.readv([(start, end - start) for start, end in ranges], buffer)
+
+        values = list()
+        for (addr, st), (index, delta) in zip(items, location):
+            t = st.unpack_from(buffer, offsets[index] + delta)
+            values.append(t[0] if len(t) == 1 else t)
+        return values
+
+    def resolve(self, path):
+        """Returns the address (or value) a PointerPath resolves to."""
+        return self.resolve_many([path])[0]
+
+    def resolve_many(self, paths):
+        """Resolves many PointerPath's, reading each pointer level of all the paths at once."""
+        if self._resolver is None:
+            self._resolver = PointerResolver(self)
+        return self._resolver.resolve_many(paths)
+
     def mmap(self, size, addr=None):
         """Allocates memory from the unmanaged memory of the process by using the specified number of bytes."""
-        right = 0x40  # PAGE_EXECUTE_READWRITE
-        flags = 0x1000 | 0x2000  # MEM_COMMIT | MEM_RESERVE
-        memory = win32.VirtualAllocEx(self.handle, addr, size, flags, right)
-        if not memory:
-            raise win32.Win32Exception()
-        return memory
+        return self.backend.alloc(size, addr, win32.PAGE_EXECUTE_READWRITE)
 
     def unmap(self, addr):
         """Releases memory previously allocated from the unmanaged memory of the process."""
-        flags = 0x8000  # MEM_RELEASE
-        win32.VirtualFreeEx(self.handle, addr, 0, flags)
+        self.backend.free(addr)
 
     def mapshared(self, size):
+        self._require_win32("Process.mapshared")
         return SharedMemBuffer(self, size)
 
+    @property
+    def thread_registry(self):
+        """Returns the ThreadRegistry of the process, the thread handles are opened once."""
+        if self._thread_registry is None:
+            self._require_win32("The thread registry")
+            self._thread_registry = ThreadRegistry(self)
+        return self._thread_registry
+
     @property
     def threads(self):
         """Returns the ProcessThread's list of the process."""
-        buffer = win32.THREADENTRY32()
-        snap = win32.CreateToolhelp32Snapshot(_TH32CS_SNAPTHREAD, self.id)
-        if not snap:
-            raise win32.Win32Exception()
-
-        _threads = list()
-        while win32.Thread32Next(snap, byref(buffer)):
-            if buffer.th32OwnerProcessID == self.id:
-                _threads.append(ProcessThread(buffer.th32ThreadID, self))
+        return self.thread_registry.refresh()
 
-        win32.CloseHandle(snap)
-        return _threads
+    @property
+    def module_map(self):
+        """Returns the ModuleMap of the process, a cached index of its modules."""
+        if self._module_map is None:
+            self._module_map = ModuleMap(self)
+        return self._module_map
 
     @property
     def modules(self):
         """Returns the ProcessModule's list of the process."""
-        buffer = win32.MODULEENTRY32()
-        snapshot = win32.CreateToolhelp32Snapshot(
-            win32.TH32CS_SNAPMODULE | win32.TH32CS_SNAPMODULE32, self.id
-        )
-        if not snapshot:
-            raise Win32Exception()
-
-        _modules = list()
-        while win32.Module32Next(snapshot, byref(buffer)):
-            _modules.append(ProcessModule.from_MODULEENTRY32(buffer, self))
-
-        win32.CloseHandle(snapshot)
-        return _modules
+        return self.module_map.refresh()
 
     def module(self, name=None):
         """Return a ProcessModule's instance of a given module's name."""
-        buffer = win32.MODULEENTRY32()
-        snapshot = win32.CreateToolhelp32Snapshot(
-            win32.TH32CS_SNAPMODULE | win32.TH32CS_SNAPMODULE32, self.id
-        )
-        if not snapshot:
-            raise win32.Win32Exception()
-
         if name == None:
-            rv = win32.Module32First(
-                snapshot, byref(buffer)
-            )  # can this even fail if we were able to open the snapshot ?
-            win32.CloseHandle(snapshot)
-            return ProcessModule.from_MODULEENTRY32(buffer, self)
-
-        name = name.encode("ascii")
-        while win32.Module32Next(snapshot, byref(buffer)):
-            if buffer.szModule == name:
-                win32.CloseHandle(snapshot)
-                return ProcessModule.from_MODULEENTRY32(buffer, self)
+            self.module_map._ensure()
+            module = self.module_map.main
+        else:
+            module = self.module_map.get(name)
+        if module is None:
+            raise ModuleNotFoundError("No process module with the given name was found.")
+        return module
 
-        raise ModuleNotFoundError("No process module with the given name was found.")
+    def module_at(self, addr):
+        """Returns the ProcessModule containing addr, None if it isn't in a module."""
+        return self.module_map.module_at(addr)
 
     def is_x64(self):
-        m = self.module()
-        new_header_offset = self.read(m.base + 0x3C, "H")
-        machine = self.read(m.base + new_header_offset + 0x4, "H")
-        return machine == 0x8664
+        self._require_win32("Process.is_x64")
+        return self.module().pe.machine == 0x8664
 
     def page_info(self, addr):
         """Returns (size, access right) about a range of pages in the virtual address space of a process."""
-        if not win32.PROCESS_IS_64_BITS:
-            buffer = win32.MEMORY_BASIC_INFORMATION()
-        else:
-            buffer = win32.MEMORY_BASIC_INFORMATION64()
-        win32.VirtualQueryEx(self.handle, addr, byref(buffer), sizeof(buffer))
-        return buffer.RegionSize, buffer.Protect
+        return self.backend.query(addr)
+
+    def regions(self, protect=None, type=None, state=win32.MEM_COMMIT):
+        """
+        Yields the MemoryRegion's of the address space of the process.
+
+        protect and type are masks of PAGE_* and MEM_* values, a region is kept if
+        it has one of the bits. state is compared exactly, None disables a filter.
+        e.g. proc.regions(protect=PAGE_EXECUTE_READ | PAGE_EXECUTE_READWRITE, type=MEM_IMAGE)
+        """
+        for region in self.backend.regions():
+            if state is not None and region.state != state:
+                continue
+            if protect is not None and not (region.protect & protect):
+                continue
+            if type is not None and not (region.type & type):
+                continue
+            yield region
+
+    def scan_value(self, value, dtype, regions=None, aligned=True, tolerance=None):
+        """
+        Searches a typed value in the memory of the process and returns the ValueScan
+        of the candidates, e.g. proc.scan_value(1234, 'i4').
+
+        value is a number, a (low, high) range or None for an unknown initial value,
+        see ValueScan.scan.
+        """
+        return ValueScan.scan(self, value, dtype, regions, aligned, tolerance)
 
     def spawn_thread(self, entry, param=None):
         """Spawns a thread in a suspended state and returns his ProcessThread."""
+        self._require_win32("Process.spawn_thread")
         id = DWORD()
         handle = win32.CreateRemoteThread(self.handle, 0, 0, entry, param, 4, byref(id))
         if not handle:
@@ -200,23 +313,29 @@ class Process(object):
 
     # caller methods for convenience
     
-    def x64call(self, address, *argtypes):
+    def x64call(self, address, *argtypes, restype=None):
         assert win32.PROCESS_IS_64_BITS
         if self._fncaller is None:
             self._fncaller = ProcessCaller(self)
-        return self._fncaller.x64call(address, *argtypes)
+        return self._fncaller.x64call(address, *argtypes, restype=restype)
 
-    def fastcall(self, address, *argtypes):
+    def fastcall(self, address, *argtypes, restype=None):
         assert not win32.PROCESS_IS_64_BITS
         if self._fncaller is None:
             self._fncaller = ProcessCaller(self)
-        return self._fncaller.fastcall(address, *argtypes)
+        return self._fncaller.fastcall(address, *argtypes, restype=restype)
 
-    def stdcall(self, address, *argtypes):
+    def stdcall(self, address, *argtypes, restype=None):
         assert not win32.PROCESS_IS_64_BITS
         if self._fncaller is None:
             self._fncaller = ProcessCaller(self)
-        return self._fncaller.stdcall(address, *argtypes)
+        return self._fncaller.stdcall(address, *argtypes, restype=restype)
+
+    def batch(self):
+        """Returns a CallBatch of the function caller of the process, see ProcessCaller.batch."""
+        if self._fncaller is None:
+            self._fncaller = ProcessCaller(self)
+        return self._fncaller.batch()
 
     @classmethod
     def from_name(cls, name):
@@ -1,23 +1,191 @@
+from . import utils
+from operator import itemgetter
 
+import re
+import struct
 
-class RemoteClass(object):
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-    class Field(object):
 
-        def __init__(self, offset, fmt, **kw):
-            self.offset = offset
-            self.fmt = fmt
-            self.inst = None
-            self.cast = kw.pop('cast', None)
+def format_to_dtype(fmt):
+    """
+    Converts a struct format of one or many values of the same type to a NumPy dtype.
 
+    e.g. 'I' -> uint32, 'ff' -> (float32, 2), '3s' -> S3, '>H' -> big-endian uint16
+    """
+    if numpy is None:
+        raise RuntimeError("NumPy is required to build dtypes.")
+    # struct's native and standard orders are both the native byte order.
+    order, codes = "=", fmt
+    if fmt[:1] in ("@", "=", "<", ">", "!"):
+        order = {"<": "<", ">": ">", "!": ">"}.get(fmt[0], "=")
+        codes = fmt[1:]
+    items = list()
+    for count, code in re.findall(r"(\d*)([a-zA-Z?])", codes):
+        count = int(count) if count else 1
+        if code == "x":
+            raise ValueError("Padding is not supported in a field format: %r" % fmt)
+        if code in "sp":
+            items.append(("S%d" % count, 1))
+        elif code == "c":
+            items.append(("S1", count))
+        else:
+            items.append((order + code, count))
+    kinds = set(kind for kind, _ in items)
+    if len(kinds) != 1:
+        raise ValueError("Fields of mixed types can't be converted to a dtype: %r" % fmt)
+    kind = kinds.pop()
+    count = sum(count for _, count in items)
+    if count == 1:
+        return numpy.dtype(kind)
+    return numpy.dtype((kind, count))
 
-        def __get__(self, inst, *_):
-            val = inst.read(self.offset, self.fmt)
 
-            if self.cast:
-                return self.cast(inst, val)
-            return val
+class RemoteField(object):
 
+    def __init__(self, offset, fmt, **kw):
+        self.offset = offset
+        self.fmt = fmt
+        self.inst = None
+        self.cast = kw.pop('cast', None)
+        self.struct = utils.get_struct(fmt)
+        # Number of values the format unpacks to, a single one is returned unwrapped.
+        self.count = len(self.struct.unpack(bytes(self.struct.size)))
+
+
+    def __get__(self, inst, *_):
+        if inst is None:
+            return self
+        val = inst.read(self.offset, self.fmt)
+
+        if self.cast:
+            return self.cast(inst, val)
+        return val
+
+    def decode(self, inst, values):
+        """Returns the value of the field from its slice of the unpacked values."""
+        val = values[0] if self.count == 1 else tuple(values)
+        if self.cast:
+            return self.cast(inst, val)
+        return val
+
+
+def snapshot_type(name, attrs):
+    """
+    Returns a tuple subclass whose items are also readable by attribute, like a
+    namedtuple but accepting any identifier (e.g. '_pad' or '_vtable').
+    """
+    namespace = {
+        "__slots__": (),
+        "_fields": tuple(attrs),
+        "__new__": lambda cls, *values: tuple.__new__(cls, values),
+        "__repr__": lambda self: "%s(%s)" % (name, ", ".join(
+            "%s=%r" % item for item in zip(self._fields, self)
+        )),
+        "_asdict": lambda self: dict(zip(self._fields, self)),
+    }
+    for index, attr in enumerate(attrs):
+        namespace[attr] = property(itemgetter(index))
+    return type(name, (tuple,), namespace)
+
+
+class RemoteClassType(type):
+    """
+    Metaclass of RemoteClass, compiles the layout of the Field's when a class is defined.
+
+    The layout is the span [_layout_start, _layout_end) covered by all the fields
+    relative to the base of an instance and, when the fields can be expressed as
+    one native format, the single struct.Struct used to decode that span.
+
+    Subclasses get empty __slots__ unless they declare theirs, e.g.
+    __slots__ = ('__dict__',) to keep setting arbitrary instance attributes.
+    """
+
+    def __new__(mcls, name, bases, namespace, **kw):
+        slots = namespace.setdefault("__slots__", ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        for slot in slots:
+            inherited = [getattr(base, slot, None) for base in bases]
+            if any(isinstance(value, RemoteField) for value in [namespace.get(slot)] + inherited):
+                # The slot would replace the descriptor of the field.
+                raise TypeError("%s.%s is a Field, it can't also be in __slots__." % (name, slot))
+        cls = super(RemoteClassType, mcls).__new__(mcls, name, bases, namespace, **kw)
+
+        fields = dict()
+        for klass in reversed(cls.__mro__):
+            for attr, value in vars(klass).items():
+                if isinstance(value, RemoteField):
+                    fields[attr] = value
+        cls._fields = sorted(fields.items(), key=lambda item: item[1].offset)
+        cls._compile_layout()
+        return cls
+
+    def _compile_layout(cls):
+        fields = cls._fields
+        cls._snapshot_type = snapshot_type(cls.__name__ + "Snapshot", [attr for attr, _ in fields])
+        if not fields:
+            cls._layout_start = cls._layout_end = 0
+            cls._layout = None
+            return
+
+        # Natively aligned formats are aligned relative to the start of the span.
+        start = fields[0][1].offset & ~7
+        cls._layout_start = start
+        cls._layout_end = max(field.offset + field.struct.size for _, field in fields)
+
+        # Build "<padding><fmt>..." and check the alignment didn't move any field.
+        fmt = ""
+        position = start
+        for _, field in fields:
+            if field.fmt[:1] in ("@", "=", "<", ">", "!"):
+                # A byte order prefix only applies to a whole format, decode field by field.
+                fmt = None
+                break
+            if field.offset < position:
+                # Overlapping fields (unions) can't be decoded with one format.
+                fmt = None
+                break
+            if field.offset > position:
+                fmt += "%dx" % (field.offset - position)
+            fmt += field.fmt
+            position = field.offset + field.struct.size
+            if struct.calcsize(fmt) != position - start:
+                fmt = None
+                break
+        cls._layout = utils.get_struct(fmt) if fmt is not None else None
+
+    @property
+    def layout_size(cls):
+        """Returns the number of bytes read by a snapshot."""
+        return cls._layout_end - cls._layout_start
+
+    def dtype(cls, stride=None):
+        """Returns the NumPy structured dtype of a record of stride bytes (by default, up to the last field)."""
+        fields = cls._fields
+        return numpy.dtype({
+            "names": [attr for attr, _ in fields],
+            "formats": [format_to_dtype(field.fmt) for _, field in fields],
+            "offsets": [field.offset for _, field in fields],
+            "itemsize": stride or cls._layout_end,
+        })
+
+    def read_array(cls, proc, base, count, stride=None):
+        """
+        Reads count contiguous records of stride bytes at base with one Process.read
+        and returns them as a NumPy structured array, see RemoteArray.
+        """
+        return RemoteArray(cls, proc, base, count, stride).read()
+
+
+class RemoteClass(object, metaclass=RemoteClassType):
+
+    Field = RemoteField
+
+    __slots__ = ('proc', 'base')
 
     def __init__(self, proc, base):
         self.proc = proc
@@ -26,6 +194,87 @@ class RemoteClass(object):
     def read(self, offset, fmt):
          return self.proc.read(self.base + offset, fmt)
 
+    def snapshot(self):
+        """Reads the whole layout once and returns a tuple with the value of every field, also readable by name."""
+        cls = type(self)
+        buffer = bytearray(cls.layout_size)
+        self.proc.read_into(self.base + cls._layout_start, buffer)
+        return cls._decode(self, buffer, 0)
+
+    @classmethod
+    def snapshot_all(cls, proc, bases):
+        """Returns the snapshots of the instances at every base, all read with one backend.readv."""
+        bases = list(bases)
+        size = cls.layout_size
+        buffer = proc._get_gather_buffer(size * len(bases))
+        proc.backend.readv([(base + cls._layout_start, size) for base in bases], buffer)
+        view = memoryview(buffer).cast("B")
+        return [cls._decode(cls(proc, base), view, i * size) for i, base in enumerate(bases)]
+
+    @classmethod
+    def _decode(cls, inst, buffer, offset):
+        fields = cls._fields
+        if cls._layout is not None:
+            values = cls._layout.unpack_from(buffer, offset)
+            decoded = list()
+            index = 0
+            for _, field in fields:
+                decoded.append(field.decode(inst, values[index : index + field.count]))
+                index += field.count
+        else:
+            decoded = [
+                field.decode(inst, field.struct.unpack_from(buffer, offset + field.offset - cls._layout_start))
+                for _, field in fields
+            ]
+        return cls._snapshot_type(*decoded)
+
+
+class RemoteArray(object):
+    """
+    A contiguous array of count instances of a RemoteClass, stride bytes apart.
+
+    Indexing returns the RemoteClass instances, read() returns the whole table
+    as a NumPy structured array whose fields are the RemoteClass fields. The
+    casts of the fields are not applied to the array.
+    """
+
+    __slots__ = ('type', 'proc', 'base', 'count', 'stride', 'dtype')
+
+    def __init__(self, type, proc, base, count, stride=None):
+        self.type = type
+        self.proc = proc
+        self.base = base
+        self.count = count
+        self.stride = stride or type._layout_end
+        self.dtype = None
+
+    def __repr__(self):
+        return "<RemoteArray %s[%d] at 0x%08x>" % (self.type.__name__, self.count, self.base)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("RemoteArray index out of range")
+        return self.type(self.proc, self.base + index * self.stride)
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self.type(self.proc, self.base + index * self.stride)
+
+    def read(self):
+        """Reads the whole table at once and returns it as a NumPy structured array."""
+        if numpy is None:
+            raise RuntimeError("NumPy is required to read a RemoteArray.")
+        if self.dtype is None:
+            self.dtype = self.type.dtype(self.stride)
+        raw = numpy.empty(self.count * self.stride, numpy.uint8)
+        self.proc.read_into(self.base, raw)
+        return raw.view(self.dtype)
+
 
 class TestClass(RemoteClass):
 
@@ -36,4 +285,4 @@ class TestClass(RemoteClass):
 
 if __name__ == '__main__':
     import code
-    code.interact(local=locals())
\ No newline at end of file
+    code.interact(local=locals())
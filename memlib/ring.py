@@ -0,0 +1,204 @@
+from . import utils
+import struct
+import time
+
+class SharedRing(object):
+    """
+    A ring of variable size records in shared memory, written by one or many
+    producers (e.g. an injected DLL or hooks) and read by one consumer.
+
+    The ring can live in a SharedMemBuffer, a mmap or any writable buffer, so
+    the consumer reads the records straight from its local mapping.
+
+    Layout (little endian, offsets from the start of the ring):
+        0x00 magic      u32, 'RNG1'
+        0x04 capacity   u32, bytes of data, a power of two
+        0x08 dropped    u64, records dropped by the producers because the ring was full
+        0x40 head       u64, bytes reserved by the producers since the creation
+        0x80 tail       u64, bytes consumed since the creation
+        0xC0 data       capacity bytes
+    A record starts at a multiple of 8 of the data, head & (capacity - 1):
+        0x00 size       u32, 8 + size of the payload, 0 until the record is committed
+        0x04 type       u32, free for the producers, 0xFFFFFFFF for padding
+        0x08 payload
+    and takes size rounded up to 8 bytes. A record never wraps: when it doesn't
+    fit before the end of the data, the producer fills the end with a padding
+    record (size = bytes left, type = 0xFFFFFFFF) and writes it at the start.
+
+    A producer reserves its bytes by moving head with a compare and swap (lock
+    cmpxchg), the reservation includes the padding:
+        do {
+            pos = head; off = pos & (capacity - 1);
+            need = (8 + len + 7) & ~7;
+            pad = off + need > capacity ? capacity - off : 0;
+            if (pos + pad + need - tail > capacity) { atomic_inc(dropped); return; }
+        } while (!cas(&head, pos, pos + pad + need));
+        if (pad) { data[off].type = 0xFFFFFFFF; store_release(&data[off].size, pad); }
+        copy the payload at (pos + pad) & (capacity - 1) + 8, write type,
+        store_release(&size, 8 + len)
+    The consumer reads the committed records from tail, zeroes their bytes, so
+    that the size of the next records read 0 until they are committed, then
+    moves tail.
+
+    SharedRing.put is a single producer (no compare and swap from Python), get
+    the consumer. With a record format, the payloads are unpacked with it.
+
+    Properties:
+        - capacity
+        - record
+        - offset
+    """
+
+    MAGIC = 0x31474E52  # 'RNG1'
+    PADDING = 0xFFFFFFFF
+    HEADER_SIZE = 0xC0
+
+    _DROPPED = 0x08
+    _HEAD = 0x40
+    _TAIL = 0x80
+
+    def __init__(self, buffer, offset=0, record=None):
+        """Attaches to the ring created at offset of buffer."""
+        self.buffer = buffer
+        self.offset = offset
+        self.record = utils.get_struct(record) if record is not None else None
+        self._view = buffer.view if hasattr(buffer, "view") else memoryview(buffer).cast("B")
+
+        magic, capacity = struct.unpack_from("<II", self._view, offset)
+        if magic != SharedRing.MAGIC:
+            raise ValueError("No SharedRing at offset 0x%x of the buffer." % offset)
+        self.capacity = capacity
+        self._mask = capacity - 1
+        self._data = offset + SharedRing.HEADER_SIZE
+        self._zeros = memoryview(bytes(capacity))
+
+    def __repr__(self):
+        return "<SharedRing %d bytes, %d pending>" % (self.capacity, len(self))
+
+    def __len__(self):
+        """Returns the number of bytes reserved and not consumed yet."""
+        return self._load(SharedRing._HEAD) - self._load(SharedRing._TAIL)
+
+    @classmethod
+    def create(cls, buffer, offset=0, size=None, record=None):
+        """
+        Creates an empty ring at offset of buffer, using at most size bytes (by
+        default, up to the end of the buffer) and returns it.
+        """
+        view = buffer.view if hasattr(buffer, "view") else memoryview(buffer).cast("B")
+        if size is None:
+            size = len(view) - offset
+        capacity = 1 << max((size - SharedRing.HEADER_SIZE).bit_length() - 1, 0)
+        if capacity < 8:
+            raise ValueError("%d bytes are too small for a SharedRing." % size)
+
+        view[offset:offset + SharedRing.HEADER_SIZE + capacity] = bytes(SharedRing.HEADER_SIZE + capacity)
+        struct.pack_into("<II", view, offset, SharedRing.MAGIC, capacity)
+        return cls(buffer, offset, record)
+
+    @staticmethod
+    def size_for(capacity):
+        """Returns the number of bytes taken by a ring of capacity bytes of data."""
+        return SharedRing.HEADER_SIZE + capacity
+
+    @property
+    def dropped(self):
+        """Returns the number of records the producers dropped because the ring was full."""
+        return self._load(SharedRing._DROPPED)
+
+    def _load(self, field):
+        return struct.unpack_from("<Q", self._view, self.offset + field)[0]
+
+    def _store(self, field, value):
+        struct.pack_into("<Q", self._view, self.offset + field, value)
+
+    def put(self, data, type=0):
+        """
+        Writes a record with payload data (bytes-like, or the values of the record
+        format as a tuple). Returns False, and counts the record as dropped, if
+        the ring is full. Only one producer may call put.
+        """
+        if self.record is not None and isinstance(data, tuple):
+            data = self.record.pack(*data)
+        view = self._view
+        size = 8 + len(data)
+        need = (size + 7) & ~7
+        if need > self.capacity:
+            raise ValueError("A record of %d bytes doesn't fit in the ring." % len(data))
+
+        pos = self._load(SharedRing._HEAD)
+        off = pos & self._mask
+        pad = self.capacity - off if off + need > self.capacity else 0
+        if pos + pad + need - self._load(SharedRing._TAIL) > self.capacity:
+            self._store(SharedRing._DROPPED, self.dropped + 1)
+            return False
+        self._store(SharedRing._HEAD, pos + pad + need)
+
+        if pad:
+            struct.pack_into("<II", view, self._data + off, pad, SharedRing.PADDING)
+        start = self._data + ((pos + pad) & self._mask)
+        view[start + 8:start + size] = data
+        struct.pack_into("<I", view, start + 4, type)
+        # The size commits the record, it is written last.
+        struct.pack_into("<I", view, start, size)
+        return True
+
+    def get(self, max_count=None, timeout=0):
+        """
+        Consumes the committed records, at most max_count of them, and returns the
+        list of their (type, payload). Waits at most timeout seconds (forever if
+        None) for the first one.
+        """
+        records = self._get(max_count)
+        if records or timeout == 0:
+            return records
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0
+        while not records:
+            if deadline is not None and time.monotonic() > deadline:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2 or 0.00001, 0.001)
+            records = self._get(max_count)
+        return records
+
+    def _get(self, max_count):
+        view = self._view
+        data = self._data
+        head = self._load(SharedRing._HEAD)
+        tail = self._load(SharedRing._TAIL)
+        unpack = self.record.unpack_from if self.record is not None else None
+
+        records = list()
+        pos = tail
+        while pos < head and (max_count is None or len(records) < max_count):
+            off = data + (pos & self._mask)
+            size, type = struct.unpack_from("<II", view, off)
+            if size == 0:
+                # Reserved, but not committed yet.
+                break
+            if type != SharedRing.PADDING:
+                if unpack is not None:
+                    records.append((type, unpack(view, off + 8)))
+                else:
+                    records.append((type, bytes(view[off + 8:off + size])))
+            pos += (size + 7) & ~7
+
+        if pos != tail:
+            # Clear the consumed bytes before giving them back to the producers.
+            start = tail & self._mask
+            end = start + (pos - tail)
+            if end > self.capacity:
+                view[data + start:data + self.capacity] = self._zeros[:self.capacity - start]
+                view[data:data + end - self.capacity] = self._zeros[:end - self.capacity]
+            else:
+                view[data + start:data + end] = self._zeros[:end - start]
+            self._store(SharedRing._TAIL, pos)
+        return records
+
+    def __iter__(self):
+        """Yields the records as they come, forever."""
+        while True:
+            for record in self.get(timeout=None):
+                yield record
@@ -1,25 +1,527 @@
+from concurrent.futures import ThreadPoolExecutor
+from . import win32
+from . import x86
+from .pe import PEFormatError
+
+import os
+import json
+import struct
+import hashlib
+import tempfile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Signature(object):
+    """
+    A compiled byte signature.
+
+    The pattern is either exact bytes or an IDA-style string where "??" (or "?")
+    is a wildcard byte, e.g. "56 8B F1 ?? ?? 72 04". The signature is split in
+    literal segments and the longest one is used as anchor, so a search is a
+    bytes.find of the anchor followed by a check of the other segments.
+
+    Properties:
+        - pattern
+        - offset
+        - size
+        - segments (list of (offset, bytes))
+        - literals (list of (offset, byte) of every byte which isn't a wildcard)
+    """
+
+    def __init__(self, pattern, offset=0):
+        self.pattern = pattern
+        self.offset = offset
+
+        if isinstance(pattern, str):
+            tokens = pattern.split()
+            mask = [not tok.startswith("?") for tok in tokens]
+            data = bytes(int(tok, 16) if keep else 0 for tok, keep in zip(tokens, mask))
+        else:
+            data = bytes(pattern)
+            mask = [True] * len(data)
+
+        self.size = len(data)
+        self.literals = [(i, data[i]) for i, keep in enumerate(mask) if keep]
+        self.segments = list()
+        start = None
+        for i, keep in enumerate(mask + [False]):
+            if keep and start is None:
+                start = i
+            elif not keep and start is not None:
+                self.segments.append((start, data[start:i]))
+                start = None
+
+        if not self.segments:
+            raise ValueError("The signature %r doesn't contain any literal byte." % (pattern,))
+
+        self.anchor_offset, self.anchor = max(self.segments, key=lambda seg: len(seg[1]))
+
+    def __repr__(self):
+        return "<Signature %r, offset %d>" % (self.pattern, self.offset)
+
+    def __str__(self):
+        """Returns the signature as an IDA-style string."""
+        tokens = ["??"] * self.size
+        for off, seg in self.segments:
+            tokens[off : off + len(seg)] = ["%02X" % b for b in seg]
+        return " ".join(tokens)
+
+    def match(self, buffer, start):
+        """Checks if the signature matches buffer at index start."""
+        if start < 0 or start + self.size > len(buffer):
+            return False
+        for off, seg in self.segments:
+            if not buffer.startswith(seg, start + off):
+                return False
+        return True
+
+    def search(self, buffer, start=0):
+        """Returns the index of the first match in buffer, or -1."""
+        pos = buffer.find(self.anchor, start + self.anchor_offset)
+        while pos != -1:
+            if self.match(buffer, pos - self.anchor_offset):
+                return pos - self.anchor_offset
+            pos = buffer.find(self.anchor, pos + 1)
+        return -1
+
+
+def compile_signatures(signatures):
+    """
+    Compiles a table of signatures.
+
+    signatures maps a name to a pattern, a (pattern, offset) tuple or a Signature.
+    """
+    compiled = dict()
+    for name, sig in signatures.items():
+        if isinstance(sig, Signature):
+            compiled[name] = sig
+        elif isinstance(sig, tuple):
+            compiled[name] = Signature(*sig)
+        else:
+            compiled[name] = Signature(sig)
+    return compiled
+
+
+def scan_buffer(buffer, signatures, chunk_size=0x400000):
+    """
+    Resolves a table of compiled signatures over buffer.
+
+    Returns a dict mapping the name of the signatures found to the index of
+    their first match (without the signature's offset).
+
+    With NumPy, the candidates of a signature are the positions of its literal
+    byte which is the rarest in buffer (estimated on a sample). buffer is
+    walked in chunks of chunk_size bytes: the positions of the rarest bytes of
+    all the signatures are found in one vectorized pass over the chunk and
+    sorted by byte once, then the other literal bytes are checked on the
+    candidates of each signature, rarest first. The time is bounded by
+    O(len(buffer) + candidates * literal bytes) and the memory by the chunk size.
+    """
+    if numpy is None or not signatures:
+        return _find_anchors(buffer, signatures)
+
+    data = numpy.frombuffer(buffer, numpy.uint8)
+    counts = numpy.bincount(data[::max(len(data) >> 20, 1)], minlength=256)
+    pending = list()
+    for name, sig in signatures.items():
+        literals = sorted(sig.literals, key=lambda literal: counts[literal[1]])
+        pending.append((name, sig, literals))
+
+    results = dict()
+    for start in range(0, len(data), chunk_size):
+        selected = numpy.zeros(256, numpy.bool_)
+        selected[[literals[0][1] for _, _, literals in pending]] = True
+        chunk = data[start:start + chunk_size]
+        positions = numpy.flatnonzero(selected[chunk])
+        values = chunk[positions]
+        # Grouped by byte, the positions of each byte stay in order.
+        order = numpy.argsort(values, kind="stable")
+        values = values[order]
+        positions = positions[order] + start
+        bounds = numpy.searchsorted(values, numpy.arange(257))
+
+        for name, sig, literals in pending:
+            byte = literals[0][1]
+            starts = positions[bounds[byte]:bounds[byte + 1]] - literals[0][0]
+            starts = starts[(starts >= 0) & (starts <= len(data) - sig.size)]
+            for offset, value in literals[1:]:
+                if not len(starts):
+                    break
+                starts = starts[data[starts + offset] == value]
+            if len(starts):
+                results[name] = int(starts[0])
+        pending = [item for item in pending if item[0] not in results]
+        if not pending:
+            break
+    return results
+
+
+def _find_anchors(buffer, signatures):
+    """
+    scan_buffer without NumPy, signatures sharing the same anchor are resolved
+    together, so each distinct anchor is searched once with bytes.find.
+    """
+    by_anchor = dict()
+    for name, sig in signatures.items():
+        by_anchor.setdefault(sig.anchor, list()).append((name, sig))
+
+    results = dict()
+    for anchor, pending in by_anchor.items():
+        pos = buffer.find(anchor)
+        while pos != -1 and pending:
+            for name, sig in list(pending):
+                start = pos - sig.anchor_offset
+                if sig.match(buffer, start):
+                    results[name] = start
+                    pending.remove((name, sig))
+            pos = buffer.find(anchor, pos + 1)
+    return results
+
+
+def module_fingerprint(proc, module):
+    """
+    Returns a string identifying the binary of a loaded module.
+
+    For a PE image it is the TimeDateStamp and CheckSum of the headers, for
+    anything else a hash of the first page of the image.
+    """
+    if proc.read(module.base, "2s") == b"MZ":
+        nt_headers = module.base + proc.read(module.base + 0x3C, "I")
+        timestamp = proc.read(nt_headers + 0x8, "I")
+        checksum = proc.read(nt_headers + 0x58, "I")
+        return "%08x%08x" % (timestamp, checksum)
+    header = proc.read(module.base, "%ds" % min(module.size, 0x1000))
+    return hashlib.sha1(header).hexdigest()
+
+
+class SignatureCache(object):
+    """
+    On-disk cache of resolved signatures.
+
+    The results are stored relative to the module base under a key made of the
+    module name, size and fingerprint, so a rebuilt binary never hits the cache.
+    The new results are only written by flush or close, e.g.
+
+    with SignatureCache() as cache:
+        addrs = ProcessScanner(proc, cache).find_all(signatures)
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(os.path.expanduser("~"), ".cache", "memlib", "signatures.json")
+        self.path = path
+        self._entries = None
+        self._dirty = False
+
+    def __repr__(self):
+        return "<SignatureCache %s>" % self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            try:
+                with open(self.path, "r") as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = dict()
+        return self._entries
+
+    def key(self, proc, module):
+        """Returns the cache key of a loaded module."""
+        return "%s|%x|%s" % (module.name, module.size, module_fingerprint(proc, module))
+
+    def get(self, key, name, sig):
+        """Returns the offset cached for the signature, or None."""
+        entry = self.entries.get(key, dict()).get(str(name))
+        if entry is None or entry[0] != str(sig) or entry[1] != sig.offset:
+            return None
+        return entry[2]
+
+    def put(self, key, name, sig, rva):
+        """Records the offset of the signature, dropping the entries of older builds of the module."""
+        # module name|size|fingerprint, optionally followed by the section
+        module_name, build = key.split("|", 1)[0], key.split("|")[1:3]
+        for other in list(self.entries):
+            if other.split("|", 1)[0] == module_name and other.split("|")[1:3] != build:
+                del self.entries[other]
+        self.entries.setdefault(key, dict())[str(name)] = [str(sig), sig.offset, rva]
+        self._dirty = True
+
+    def flush(self):
+        """Writes the cache to its file if it changed, the file is replaced atomically."""
+        if not self._dirty:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        f = tempfile.NamedTemporaryFile("w", dir=directory or None, suffix=".tmp", delete=False)
+        try:
+            with f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(f.name, self.path)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+        self._dirty = False
+
+    def close(self):
+        """Writes the pending results, see flush."""
+        self.flush()
+
 
 class ProcessScanner(object):
     """
-    Class used to scan remote process's code section.
+    Class used to scan the sections of a module of a remote process, by default
+    the .text section of the main module.
+
+    Every section is read with one read when it is first scanned, and the
+    results are kept per section. If a SignatureCache is given, results of
+    find_all are looked up in it before scanning and the sections are only
+    read on a miss, the new results are written when the cache is flushed.
+
+    e.g.
+    scan = ProcessScanner(proc, sections=(".text", ".rdata"))
+    scan.find_reference("8B 0D ?? ?? ?? ?? 85 C9", read="P")
+
+    Properties:
+        - proc
+        - module
+        - sections (list of (name, address, size))
+        - base (address of the first section)
+        - x64
     """
 
-    def __init__(self, proc):
+    def __init__(self, proc, cache=None, module=None, sections=(".text",)):
         self.proc = proc
-        self.module = proc.module()
+        if module is None:
+            module = proc.module()
+        elif isinstance(module, str):
+            module = proc.module(module)
+        self.module = module
         if not self.module:
             raise RuntimeError("Couldn't find default module")
-        # Very hacky but that will do it for now
-        self.base = self.module.base + 0x1000
-        size, _ = proc.page_info(self.base)
-        self.buffer = proc.read(self.base, "%ds" % size)
+        self.cache = cache
+        self._cache_key = None
+        self._buffers = dict()
+        self._results = dict()   # {section: {signature: index or -1}}
+
+        try:
+            pe = self.module.pe
+        except PEFormatError:
+            pe = None
+        if pe is not None:
+            self.x64 = pe.x64
+            self.sections = list()
+            for name in sections:
+                section = pe.section(name)
+                if section is None:
+                    raise RuntimeError("No section %s in %s." % (name, self.module.name))
+                self.sections.append((name, self.module.base + section.rva, section.size))
+        else:
+            # Not a PE image, scan the region following the first page.
+            self.x64 = win32.PROCESS_IS_64_BITS
+            size, _ = self.proc.page_info(self.module.base + 0x1000)
+            self.sections = [("", self.module.base + 0x1000, size)]
+        self.base = self.sections[0][1]
+
+    @property
+    def buffer(self):
+        return self.section_buffer(self.sections[0][0])
+
+    def section_buffer(self, name):
+        """Returns the bytes of the section name, read on first use."""
+        data = self._buffers.get(name)
+        if data is None:
+            for section, addr, size in self.sections:
+                if section == name:
+                    data = self._buffers[name] = self.proc.read(addr, "%ds" % size)
+                    break
+            else:
+                raise RuntimeError("The section %s isn't scanned." % name)
+        return data
 
     def find(self, pattern, offset=0):
         """Returns address of the pattern if found."""
-        match = self.buffer.find(pattern)
-        if not match:
-            raise RuntimeError("Couldn't find the pattern.")
-        return self.base + match + offset
+        sig = Signature(pattern, offset)
+        return self.find_all({str(sig): sig})[str(sig)]
+
+    def find_all(self, signatures):
+        """
+        Returns a dict with the address of every signature of the table, the
+        sections are searched in order.
+
+        e.g.
+        scan.find_all({
+            'send_packet': "55 8B EC 83 EC 2C 53 56 57 8B F9 85",
+            'map_id': ("B0 7F 8D 55", 0x46),
+        })
+        """
+        signatures = compile_signatures(signatures)
+        results = dict()
+        pending = dict(signatures)
+
+        if self.cache is not None:
+            if self._cache_key is None:
+                self._cache_key = self.cache.key(self.proc, self.module)
+            for section, addr, size in self.sections:
+                cache_key = "%s|%s" % (self._cache_key, section)
+                for name, sig in list(pending.items()):
+                    rva = self.cache.get(cache_key, name, sig)
+                    if rva is not None:
+                        results[name] = self.module.base + rva
+                        del pending[name]
+
+        for section, addr, size in self.sections:
+            if not pending:
+                break
+            known = self._results.setdefault(section, dict())
+            unknown = {name: sig for name, sig in pending.items() if (str(sig), sig.offset) not in known}
+            if unknown:
+                found = scan_buffer(self.section_buffer(section), unknown)
+                for name, sig in unknown.items():
+                    known[(str(sig), sig.offset)] = found.get(name, -1)
+
+            found = list()
+            for name, sig in list(pending.items()):
+                index = known[(str(sig), sig.offset)]
+                if index != -1:
+                    results[name] = addr + index + sig.offset
+                    found.append(name)
+                    del pending[name]
+            if self.cache is not None and found:
+                cache_key = "%s|%s" % (self._cache_key, section)
+                for name in found:
+                    self.cache.put(cache_key, name, signatures[name], results[name] - self.module.base)
+
+        if pending:
+            raise RuntimeError("Couldn't find the patterns: %s." % ", ".join(map(str, pending)))
+        return results
+
+    def _code_at(self, addr):
+        """Returns (bytes, offset of addr in them) for the decoding of the instruction at addr."""
+        for section, start, size in self.sections:
+            if start <= addr < start + size:
+                return self.section_buffer(section), addr - start
+        return self.proc.read(addr, "16s"), 0
+
+    def operand(self, addr):
+        """
+        Returns the address referenced by the instruction at addr: the target of a
+        relative jmp or call, of a [rip+disp32] operand, the address of a memory
+        operand without base register ([disp32] or [index*scale+disp32]) or a
+        pointer size immediate.
+        """
+        code, offset = self._code_at(addr)
+        insn = x86.decode(code, offset, addr, self.x64)
+        if insn.branch is not None:
+            return insn.branch
+        if insn.rip_relative:
+            return x86.rip_target(insn, code, offset)
+        if insn.disp is not None and insn.disp[1] == 4 and code[offset + insn.modrm] >> 6 == 0:
+            # With mod 0, a disp32 is only encoded when there's no base register.
+            disp = struct.unpack_from("<i", code, offset + insn.disp[0])[0]
+            return disp & (0xFFFFFFFFFFFFFFFF if self.x64 else 0xFFFFFFFF)
+        if insn.imm is not None and insn.imm[1] == (8 if self.x64 else 4):
+            return int.from_bytes(code[offset + insn.imm[0]:offset + insn.imm[0] + insn.imm[1]], "little")
+        raise RuntimeError("The instruction at 0x%x doesn't reference an address." % addr)
+
+    def find_reference(self, pattern, offset=0, read=None):
+        """
+        Finds the pattern and returns the address referenced by the instruction at
+        its offset (see operand), or the value read there with the format read.
+
+        e.g. scan.find_reference("A1 ?? ?? ?? ?? 85 C0", read="P")
+        """
+        target = self.operand(self.find(pattern, offset))
+        if read is not None:
+            return self.proc.read(target, read)
+        return target
+
+    def __repr__(self):
+        return "<Scanner 0x%08x for Process %d>" % (id(self), self.proc.id)
+
+
+def iter_chunks(regions, chunk_size, overlap=0):
+    """
+    Splits regions in (addr, size) chunks of at most chunk_size + overlap bytes.
+
+    Consecutive chunks of a region share overlap bytes, so a pattern of up to
+    overlap + 1 bytes crossing a chunk boundary is entirely inside one chunk.
+    """
+    for region in regions:
+        addr = region.base
+        end = region.base + region.size
+        while addr < end:
+            size = min(chunk_size + overlap, end - addr)
+            yield addr, size
+            if addr + size >= end:
+                break
+            addr += chunk_size
+
+
+class RegionScanner(object):
+    """
+    Class used to scan whole regions of a remote process, by default every
+    readable committed region of its address space.
+
+    Regions are read in chunks of chunk_size bytes which are scanned on a
+    thread pool, the reads don't hold the GIL.
+    """
+
+    def __init__(self, proc, regions=None, chunk_size=0x100000, workers=None):
+        self.proc = proc
+        if regions is None:
+            regions = proc.regions()
+        self.regions = [region for region in regions if region.readable]
+        self.chunk_size = chunk_size
+        self.workers = workers
+
+    def _scan_chunk(self, addr, size, signatures):
+        try:
+            buffer = self.proc.backend.read(addr, size)
+        except (win32.Win32Exception, OSError):
+            # The region may have been released or protected since it was listed,
+            # the LinuxException of the Linux backend is an OSError.
+            return dict()
+        return {name: addr + index for name, index in scan_buffer(buffer, signatures).items()}
+
+    def scan(self, signatures):
+        """Returns a dict mapping the name of the signatures found to the lowest address they match."""
+        overlap = max(sig.size for sig in signatures.values()) - 1 if signatures else 0
+        results = dict()
+        with ThreadPoolExecutor(self.workers) as pool:
+            futures = [
+                pool.submit(self._scan_chunk, addr, size, signatures)
+                for addr, size in iter_chunks(self.regions, self.chunk_size, overlap)
+            ]
+            for future in futures:
+                for name, addr in future.result().items():
+                    if name not in results or addr < results[name]:
+                        results[name] = addr
+        return results
+
+    def find(self, pattern, offset=0):
+        """Returns the lowest address of the pattern if found."""
+        return self.find_all({None: (pattern, offset)})[None]
+
+    def find_all(self, signatures):
+        """Same as ProcessScanner.find_all, but over all the regions of the scanner."""
+        signatures = compile_signatures(signatures)
+        found = self.scan(signatures)
+        missing = [name for name in signatures if name not in found]
+        if missing:
+            raise RuntimeError("Couldn't find the patterns: %s." % ", ".join(map(str, missing)))
+        return {name: addr + signatures[name].offset for name, addr in found.items()}
 
     def __repr__(self):
-        return "<Scanner 0x%08x for Process %d>" % (id(self), self.proc.id)
\ No newline at end of file
+        return "<RegionScanner 0x%08x for Process %d>" % (id(self), self.proc.id)
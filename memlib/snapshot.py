@@ -0,0 +1,280 @@
+from . import win32
+
+import zlib
+import mmap
+import tempfile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import xxhash
+    _page_hash = xxhash.xxh64_intdigest
+except ImportError:
+    _page_hash = zlib.crc32
+
+
+class MemorySnapshot(object):
+    """
+    A capture of some regions of a process, used to find what changed between two captures.
+
+    Every page of the regions gets a hash (xxhash when available, crc32 else),
+    so a diff only looks at the pages whose hash changed. The data itself is
+    kept in an anonymous temporary file mapped in memory (unless keep_data is
+    False), so GB-sized captures are bounded by the page cache, not the heap.
+
+    e.g.
+    old = MemorySnapshot.capture(proc)
+    ...
+    new = MemorySnapshot.capture(proc, old.regions)
+    addrs = new.compare(old, 'i4', 'increased')
+
+    Properties:
+        - regions
+        - page_size
+        - hashes
+        - valid
+    """
+
+    # Comparisons of compare(), called with (new values, old values).
+    _ops = {
+        "changed": lambda new, old: new != old,
+        "unchanged": lambda new, old: new == old,
+        "increased": lambda new, old: new > old,
+        "decreased": lambda new, old: new < old,
+    }
+
+    def __init__(self, regions, page_size):
+        if numpy is None:
+            raise RuntimeError("NumPy is required to use MemorySnapshot.")
+        self.regions = list(regions)
+        self.page_size = page_size
+
+        # (base, size, data offset, first page index) of every region
+        self._layout = list()
+        offset = 0
+        pages = 0
+        for region in self.regions:
+            self._layout.append((region.base, region.size, offset, pages))
+            offset += region.size
+            pages += -(-region.size // page_size)
+        self.size = offset
+
+        self.hashes = numpy.zeros(pages, numpy.uint64)
+        self.valid = numpy.zeros(pages, numpy.bool_)
+        self._file = None
+        self._data = None
+
+    def __del__(self):
+        self.close()
+
+    def __repr__(self):
+        return "<MemorySnapshot %d regions, %d bytes>" % (len(self.regions), self.size)
+
+    def close(self):
+        """Releases the captured data."""
+        if self._data is not None:
+            try:
+                self._data.close()
+            except BufferError:
+                # Arrays still look at the data, it is released with the last of them.
+                pass
+            self._data = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @classmethod
+    def capture(cls, proc, regions=None, page_size=0x1000, chunk_size=0x100000, keep_data=True):
+        """
+        Captures regions of proc, by default every readable committed region.
+
+        Regions are read chunk_size bytes at a time, pages that can't be read are
+        marked as not valid and are ignored by the diffs.
+        """
+        if regions is None:
+            regions = proc.regions()
+        snapshot = cls([region for region in regions if region.readable], page_size)
+
+        if keep_data and snapshot.size:
+            snapshot._file = tempfile.TemporaryFile()
+            snapshot._file.truncate(snapshot.size)
+            snapshot._data = mmap.mmap(snapshot._file.fileno(), snapshot.size)
+            store = memoryview(snapshot._data)
+        else:
+            store = None
+        chunk_size = max(chunk_size - chunk_size % page_size, page_size)
+        chunk = None if keep_data else memoryview(bytearray(chunk_size))
+
+        for base, size, offset, first_page in snapshot._layout:
+            for start in range(0, size, chunk_size):
+                length = min(chunk_size, size - start)
+                if store is not None:
+                    view = store[offset + start : offset + start + length]
+                else:
+                    view = chunk[:length]
+                try:
+                    proc.read_into(base + start, view)
+                except (win32.Win32Exception, OSError):
+                    view.release()
+                    continue
+                page = first_page + start // page_size
+                for pos in range(0, length, page_size):
+                    snapshot.hashes[page] = _page_hash(view[pos : pos + page_size])
+                    snapshot.valid[page] = True
+                    page += 1
+                view.release()
+
+        if store is not None:
+            store.release()
+        return snapshot
+
+    def _check_layout(self, other):
+        if self._layout != other._layout or self.page_size != other.page_size:
+            raise ValueError("The snapshots don't cover the same regions.")
+
+    def _changed_mask(self, other):
+        self._check_layout(other)
+        return (self.hashes != other.hashes) & self.valid & other.valid
+
+    def changed_pages(self, other):
+        """Returns the addresses of the pages that changed since the snapshot other."""
+        mask = self._changed_mask(other)
+        addrs = list()
+        for base, size, offset, first_page in self._layout:
+            count = -(-size // self.page_size)
+            indices = numpy.flatnonzero(mask[first_page : first_page + count])
+            addrs.append(base + indices.astype(numpy.uint64) * self.page_size)
+        if not addrs:
+            return numpy.zeros(0, numpy.uint64)
+        return numpy.concatenate(addrs)
+
+    def _runs(self, mask, max_size, around=None):
+        """
+        Yields (addr, size, data offset, preceded, followed) of the runs of
+        consecutive pages selected by mask, split in pieces of at most max_size
+        bytes. preceded is True for the first piece of a run when the page before
+        it is selected by around, followed is True when the bytes after the piece
+        are the next piece of the run or a page selected by around.
+        """
+        page_size = self.page_size
+        for base, size, offset, first_page in self._layout:
+            count = -(-size // page_size)
+            selected = numpy.concatenate(([False], mask[first_page : first_page + count], [False]))
+            edges = numpy.flatnonzero(selected[1:] != selected[:-1])
+            for first, last in zip(edges[::2], edges[1::2]):
+                start = int(first) * page_size
+                end = min(int(last) * page_size, size)
+                before = around is not None and first > 0 and bool(around[first_page + first - 1])
+                after = around is not None and last < count and bool(around[first_page + last])
+                for piece in range(start, end, max_size):
+                    length = min(max_size, end - piece)
+                    followed = after if piece + length == end else True
+                    yield base + piece, length, offset + piece, before and piece == start, followed
+
+    def _values(self, mask, around, dtype, aligned, chunk_size):
+        """
+        Yields, for every piece of the runs of pages selected by mask, the list of
+        (addr, data offset, count) of the arrays of values of type dtype starting
+        in it, one per byte shift if not aligned. The values may end in the pages selected by around and, when not
+        aligned, start in them as long as they overlap the run.
+        """
+        itemsize = dtype.itemsize
+        shifts = [0] if aligned else range(itemsize)
+        for addr, length, offset, preceded, followed in self._runs(mask, chunk_size, around):
+            if preceded and not aligned:
+                addr -= itemsize - 1
+                offset -= itemsize - 1
+                length += itemsize - 1
+            extended = length + itemsize - 1 if followed else length
+            arrays = list()
+            for shift in shifts:
+                count = min((extended - shift) // itemsize, -(-(length - shift) // itemsize))
+                if count > 0:
+                    arrays.append((addr + shift, offset + shift, count))
+            yield arrays
+
+    def _unchanged_mask(self, other):
+        self._check_layout(other)
+        return (self.hashes == other.hashes) & self.valid & other.valid
+
+    def unchanged_ranges(self, other, pages=None):
+        """
+        Returns the (addr, size) ranges of the pages whose hash is the same in the
+        snapshot other (and selected by the mask pages), every value entirely
+        inside one of them is unchanged.
+        """
+        same = self._unchanged_mask(other)
+        if pages is not None:
+            same &= pages
+        return [(addr, length) for addr, length, _, _, _ in self._runs(same, self.size or 1)]
+
+    def iter_compare(self, other, dtype, op="changed", aligned=True, chunk_size=0x1000000, pages=None):
+        """
+        Yields arrays of the addresses whose value of type dtype satisfies op since the snapshot other.
+
+        op is one of "changed", "unchanged", "increased", "decreased" or a function
+        (new, old) -> mask working on NumPy arrays. Values are taken at every
+        multiple of the dtype's size if aligned, at every byte else. pages is a
+        mask of the pages to look at, the values must be entirely inside them.
+
+        For "changed", "increased" and "decreased" only the values overlapping the
+        pages whose hash changed are compared. "unchanged" and functions look at
+        every valid page, the ranges of unchanged_ranges are cheaper to keep when
+        most of the values didn't change.
+        """
+        changed_only = op in ("changed", "increased", "decreased")
+        return self._compare_pages(other, dtype, self._ops.get(op, op), aligned, chunk_size, pages, changed_only)
+
+    def _compare_pages(self, other, dtype, compare, aligned, chunk_size, pages, changed_only):
+        """iter_compare on the pages that changed if changed_only, on all the valid pages else."""
+        if self._data is None or other._data is None:
+            raise RuntimeError("Both snapshots must keep their data to compare values.")
+        dtype = numpy.dtype(dtype)
+
+        changed = self._changed_mask(other)
+        # Values overlapping a changed page may start or end in the valid pages around it.
+        around = self.valid & other.valid
+        if not changed_only:
+            changed = around
+        if pages is not None:
+            changed = changed & pages
+            around = around & pages
+
+        new_data = numpy.frombuffer(self._data, numpy.uint8)
+        old_data = numpy.frombuffer(other._data, numpy.uint8)
+        for arrays in self._values(changed, around, dtype, aligned, chunk_size):
+            found = list()
+            for addr, offset, count in arrays:
+                new = new_data[offset : offset + count * dtype.itemsize].view(dtype)
+                old = old_data[offset : offset + count * dtype.itemsize].view(dtype)
+                indices = numpy.flatnonzero(compare(new, old))
+                found.append(addr + indices.astype(numpy.uint64) * dtype.itemsize)
+            if found:
+                yield numpy.sort(numpy.concatenate(found))
+
+    def iter_select(self, dtype, select, aligned=True, pages=None, chunk_size=0x1000000):
+        """
+        Yields (addresses, values) arrays of the values of type dtype for which
+        select(values) -> mask is True, in the valid pages (selected by pages).
+        """
+        if self._data is None:
+            raise RuntimeError("The snapshot must keep its data to select values.")
+        dtype = numpy.dtype(dtype)
+        mask = self.valid if pages is None else self.valid & pages
+        data = numpy.frombuffer(self._data, numpy.uint8)
+        for arrays in self._values(mask, None, dtype, aligned, chunk_size):
+            for addr, offset, count in arrays:
+                values = data[offset : offset + count * dtype.itemsize].view(dtype)
+                indices = numpy.flatnonzero(select(values))
+                if len(indices):
+                    yield addr + indices.astype(numpy.uint64) * dtype.itemsize, values[indices]
+
+    def compare(self, other, dtype, op="changed", aligned=True):
+        """Same as iter_compare, but returns a single sorted array of addresses."""
+        arrays = list(self.iter_compare(other, dtype, op, aligned))
+        if not arrays:
+            return numpy.zeros(0, numpy.uint64)
+        return numpy.sort(numpy.concatenate(arrays))
@@ -1,4 +1,6 @@
 from . import win32
+from ctypes import byref
+import threading
 
 class ProcessThread(object):
     """
@@ -19,9 +21,12 @@ class ProcessThread(object):
         self.handle = handle or win32.OpenThread(win32.THREAD_ALL_ACCESS, False, id)
         if not self.handle:
             raise win32.Win32Exception()
+        self._context = None
 
     def __del__(self):
-        win32.CloseHandle(self.handle)
+        # No handle if OpenThread failed in __init__.
+        if getattr(self, "handle", None):
+            win32.CloseHandle(self.handle)
 
     def __eq__(self, other):
         return self.id == other.id
@@ -67,9 +72,22 @@ class ProcessThread(object):
             raise win32.Win32Exception()
         return code.value
 
-    def context(self, flags=win32.CONTEXT_FULL):
-        """Retrieves the context of the ProcessThread."""
-        context = win32.CONTEXT()
+    def context(self, flags=win32.CONTEXT_FULL, reuse=False):
+        """
+        Retrieves the context of the ProcessThread, a CONTEXT64 from a 64 bits
+        Python (the flags are the same). With reuse, the CONTEXT of the thread is
+        filled and returned instead of a new one, it is overwritten by the next call.
+        """
+        context_type = win32.CONTEXT
+        if win32.PROCESS_IS_64_BITS:
+            context_type = win32.CONTEXT64
+            flags = flags & ~win32.CONTEXT_i386 | win32.CONTEXT_AMD64
+        if reuse:
+            if self._context is None:
+                self._context = context_type()
+            context = self._context
+        else:
+            context = context_type()
         context.ContextFlags = flags
         success = win32.GetThreadContext(self.handle, win32.byref(context))
         if not success:
@@ -93,4 +111,141 @@ class ProcessThread(object):
         # NTSUCCESS are positive signed 32 bytes integers [0 - 0x7fffffff]
         if ntstatus < 0:
             raise win32.Win32Exception()
-        return info.TebBaseAddress
\ No newline at end of file
+        return info.TebBaseAddress
+
+
+class ThreadRegistry(object):
+    """
+    The ProcessThread's of a process, opened once and kept until they exit.
+
+    refresh() diffs a Toolhelp snapshot with the known threads, so only the new
+    threads are opened. A debugger can keep it up to date without snapshots
+    with add() and remove() on its create and exit thread events.
+
+    e.g.
+    with proc.thread_registry.suspended() as threads:
+        contexts = [thread.context(reuse=True) for thread in threads]
+
+    Properties:
+        - pid
+    """
+
+    def __init__(self, process):
+        self.process = process
+        self.pid = process.id
+        self._threads = dict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<ThreadRegistry %d threads in Process %d>" % (len(self._threads), self.pid)
+
+    def __len__(self):
+        return len(self._threads)
+
+    def __iter__(self):
+        with self._lock:
+            threads = list(self._threads.values())
+        return iter(threads)
+
+    def __contains__(self, id):
+        return id in self._threads
+
+    def _snapshot(self):
+        """Returns the ids of the threads of the process."""
+        buffer = win32.THREADENTRY32()
+        snap = win32.CreateToolhelp32Snapshot(win32.TH32CS_SNAPTHREAD, self.pid)
+        if not snap:
+            raise win32.Win32Exception()
+
+        ids = list()
+        success = win32.Thread32First(snap, byref(buffer))
+        while success:
+            if buffer.th32OwnerProcessID == self.pid:
+                ids.append(buffer.th32ThreadID)
+            success = win32.Thread32Next(snap, byref(buffer))
+
+        win32.CloseHandle(snap)
+        return ids
+
+    def refresh(self):
+        """Opens the new threads, forgets the ones which exited and returns the list of threads."""
+        ids = self._snapshot()
+        with self._lock:
+            alive = set(ids)
+            for id in [id for id in self._threads if id not in alive]:
+                del self._threads[id]
+            threads = list()
+            for id in ids:
+                thread = self._threads.get(id)
+                if thread is None:
+                    try:
+                        thread = self._threads[id] = ProcessThread(id, self.process)
+                    except win32.Win32Exception:
+                        # Exited since the snapshot.
+                        continue
+                threads.append(thread)
+        return threads
+
+    def get(self, id):
+        """Returns the ProcessThread of id, opening it if it isn't known yet."""
+        thread = self._threads.get(id)
+        if thread is None:
+            with self._lock:
+                thread = self._threads.get(id)
+                if thread is None:
+                    thread = self._threads[id] = ProcessThread(id, self.process)
+        return thread
+
+    def add(self, id, handle=None):
+        """Registers a new thread, handle is owned by the ProcessThread if given."""
+        with self._lock:
+            thread = self._threads[id] = ProcessThread(id, self.process, handle)
+        return thread
+
+    def remove(self, id):
+        """Forgets a thread which exited."""
+        with self._lock:
+            self._threads.pop(id, None)
+
+    def clear(self):
+        with self._lock:
+            self._threads.clear()
+
+    def suspend_all(self, exclude=None):
+        """Suspends the known threads, but exclude (a thread id), and returns them."""
+        suspended = list()
+        for thread in self:
+            if thread.id == exclude:
+                continue
+            try:
+                thread.suspend()
+            except win32.Win32Exception:
+                continue
+            suspended.append(thread)
+        return suspended
+
+    def resume_all(self, threads):
+        for thread in threads:
+            try:
+                thread.resume()
+            except win32.Win32Exception:
+                pass
+
+    def suspended(self, exclude=None):
+        """Context manager suspending the known threads, returns the list of the suspended ones."""
+        return _Suspended(self, exclude)
+
+
+class _Suspended(object):
+
+    def __init__(self, registry, exclude):
+        self.registry = registry
+        self.exclude = exclude
+        self.threads = None
+
+    def __enter__(self):
+        self.threads = self.registry.suspend_all(self.exclude)
+        return self.threads
+
+    def __exit__(self, *exc):
+        self.registry.resume_all(self.threads)
@@ -2,11 +2,19 @@ from ctypes import (
     c_char as CHAR
 )
 
+import struct
+import functools
+
 def create_buffer(size):
     """Create a ctypes buffer of a given size."""
     buftype = CHAR * size
     return buftype()
 
+@functools.lru_cache(maxsize=256)
+def get_struct(format):
+    """Returns the compiled struct.Struct of a format, shared by every caller."""
+    return struct.Struct(format)
+
 def get_ctype_string(type):
     """Returns the type string to be used with unpack/pack"""
     from ctypes import _SimpleCData
@@ -0,0 +1,248 @@
+from . import utils
+from .scanner import iter_chunks
+from .snapshot import MemorySnapshot
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _predicate(dtype, value, tolerance):
+    """Returns the function values -> mask selecting value (a number or a (low, high) range)."""
+    if isinstance(value, tuple):
+        low, high = (numpy.asarray(v, dtype) for v in value)
+        return lambda values: (values >= low) & (values <= high)
+    value = numpy.asarray(value, dtype)
+    if tolerance is not None:
+        def select(values):
+            # inf and nan are never close to anything, no need to warn about them.
+            with numpy.errstate(invalid="ignore", over="ignore"):
+                return numpy.abs(values - value) <= tolerance
+        return select
+    return lambda values: values == value
+
+
+class ValueScan(object):
+    """
+    Candidates of a search of typed values in a process, e.g. "all the int32 == 1234".
+
+    The candidates are a sorted NumPy array of addresses and the NumPy array of
+    their values at the last scan. A scan with an unknown initial value keeps a
+    MemorySnapshot of the regions and a mask of its pages instead: every value
+    inside them is a candidate. Rescans by "unchanged" only narrow the mask,
+    the values of the pages that changed become regular candidates.
+
+    e.g.
+    scan = proc.scan_value(100, 'i4')
+    ... health goes down ...
+    scan.rescan(op='decreased')
+    scan.rescan(93)
+    scan.addresses
+
+    Properties:
+        - proc
+        - dtype
+        - aligned
+        - addresses
+        - values
+    """
+
+    _ops = MemorySnapshot._ops
+
+    def __init__(self, proc, dtype, aligned=True):
+        if numpy is None:
+            raise RuntimeError("NumPy is required to scan values.")
+        self.proc = proc
+        self.dtype = numpy.dtype(dtype)
+        self.aligned = aligned
+        self.addresses = numpy.zeros(0, numpy.uint64)
+        self.values = numpy.zeros(0, self.dtype)
+        self.snapshot = None
+        self.pages = None
+        self.regions = None
+
+    def __repr__(self):
+        if self.snapshot is not None:
+            return "<ValueScan %s, unknown initial value, %d candidates>" % (self.dtype, len(self))
+        return "<ValueScan %s, %d candidates>" % (self.dtype, len(self.addresses))
+
+    def __len__(self):
+        count = len(self.addresses)
+        if self.snapshot is not None:
+            # Every value entirely inside the runs of candidate pages.
+            itemsize = self.dtype.itemsize
+            for _, size, _, _, _ in self.snapshot._runs(self.pages, self.snapshot.size or 1):
+                count += size // itemsize if self.aligned else max(size - itemsize + 1, 0)
+        return count
+
+    @classmethod
+    def scan(cls, proc, value, dtype, regions=None, aligned=True, tolerance=None, chunk_size=0x100000):
+        """
+        Searches value in the regions of proc (by default every readable committed region).
+
+        value is a number, a (low, high) range (bounds included) or None for an
+        unknown initial value. tolerance is the maximum distance to value, for floats.
+        """
+        self = cls(proc, dtype, aligned)
+        if regions is None:
+            regions = proc.regions()
+        self.regions = [region for region in regions if region.readable]
+
+        if value is None:
+            self.snapshot = MemorySnapshot.capture(proc, self.regions, chunk_size=chunk_size)
+            self.pages = self.snapshot.valid.copy()
+            return self
+
+        select = _predicate(self.dtype, value, tolerance)
+        itemsize = self.dtype.itemsize
+        shifts = [0] if aligned else range(itemsize)
+        overlap = 0 if aligned else itemsize - 1
+        chunk_size -= chunk_size % itemsize
+
+        buffer = bytearray(chunk_size + overlap)
+        addresses = list()
+        values = list()
+        for addr, size in iter_chunks(self.regions, chunk_size, overlap):
+            view = memoryview(buffer)[:size]
+            try:
+                proc.read_into(addr, view)
+            except Exception:
+                continue
+            finally:
+                view.release()
+            data = numpy.frombuffer(buffer, numpy.uint8, size)
+            for shift in shifts:
+                # Values starting in the overlap are found by the next chunk.
+                count = min((size - shift) // itemsize, -(-(min(size, chunk_size) - shift) // itemsize))
+                if count <= 0:
+                    continue
+                chunk = data[shift : shift + count * itemsize].view(self.dtype)
+                indices = numpy.flatnonzero(select(chunk))
+                addresses.append(addr + shift + indices.astype(numpy.uint64) * itemsize)
+                values.append(chunk[indices])
+
+        self._set(addresses, values)
+        return self
+
+    def _set(self, addresses, values):
+        if addresses:
+            addresses = numpy.concatenate(addresses)
+            values = numpy.concatenate(values)
+            order = numpy.argsort(addresses, kind="stable")
+            self.addresses = addresses[order]
+            self.values = values[order]
+        else:
+            self.addresses = numpy.zeros(0, numpy.uint64)
+            self.values = numpy.zeros(0, self.dtype)
+
+    def read(self, page_size=0x1000):
+        """
+        Reads the current values of all the candidates with one gather read.
+
+        Returns (values, valid), valid is False for candidates that can't be read anymore.
+        """
+        addresses = self.addresses
+        itemsize = self.dtype.itemsize
+        if not len(addresses):
+            return numpy.zeros(0, self.dtype), numpy.zeros(0, numpy.bool_)
+
+        first = addresses // page_size
+        last = (addresses + (itemsize - 1)) // page_size
+        pages = numpy.unique(numpy.concatenate((first, last)))
+
+        # Consecutive pages are read as one range, the pages are back to back in the buffer.
+        breaks = numpy.flatnonzero(numpy.diff(pages) != 1) + 1
+        starts = numpy.concatenate(([0], breaks))
+        ends = numpy.concatenate((breaks, [len(pages)]))
+        ranges = [(int(pages[s]) * page_size, int(e - s) * page_size) for s, e in zip(starts, ends)]
+
+        buffer = utils.create_buffer(len(pages) * page_size)
+        data = numpy.frombuffer(buffer, numpy.uint8)
+        page_valid = numpy.ones(len(pages), numpy.bool_)
+        try:
+            self.proc.backend.readv(ranges, buffer)
+        except Exception:
+            # Some pages are gone, read the ranges one by one to find which.
+            view = memoryview(buffer).cast("B")
+            for s, e, (addr, size) in zip(starts, ends, ranges):
+                try:
+                    self.proc.read_into(addr, view[s * page_size : e * page_size])
+                except Exception:
+                    page_valid[s:e] = False
+
+        index = numpy.searchsorted(pages, first)
+        offsets = index.astype(numpy.int64) * page_size + (addresses % page_size).astype(numpy.int64)
+        gathered = data[offsets[:, None] + numpy.arange(itemsize)]
+        values = gathered.reshape(-1).view(self.dtype)
+        valid = page_valid[index] & page_valid[numpy.searchsorted(pages, last)]
+        return values, valid
+
+    def rescan(self, value=None, op=None, tolerance=None):
+        """
+        Narrows the candidates to the ones whose current value matches.
+
+        value is a number or a (low, high) range, like for scan. op compares the
+        current value to the one of the previous scan and is one of "changed",
+        "unchanged", "increased", "decreased" or a function (new, old) -> mask.
+        Returns the number of candidates left, see __len__.
+        """
+        if self.snapshot is not None:
+            return self._rescan_unknown(value, op, tolerance)
+
+        values, valid = self.read()
+        mask = valid
+        if value is not None:
+            mask &= _predicate(self.dtype, value, tolerance)(values)
+        if op is not None:
+            mask &= self._ops.get(op, op)(values, self.values)
+        self.addresses = self.addresses[mask]
+        self.values = values[mask]
+        return len(self.addresses)
+
+    def _rescan_unknown(self, value, op, tolerance):
+        if value is None and op is None:
+            raise ValueError("A value or an op is required to rescan.")
+        old = self.snapshot
+        new = MemorySnapshot.capture(self.proc, old.regions)
+        select = None if value is None else _predicate(self.dtype, value, tolerance)
+
+        # The candidates found in the pages that changed before.
+        addresses = list()
+        if len(self.addresses):
+            values, valid = self.read()
+            if op is not None:
+                valid &= self._ops.get(op, op)(values, self.values)
+            addresses.append(self.addresses[valid])
+
+        if op is None:
+            # Nothing to compare to, search the value in the candidate pages.
+            found = new.iter_select(self.dtype, select, self.aligned, self.pages)
+            addresses.extend(addrs for addrs, _ in found)
+        else:
+            # The values of the pages that didn't change are handled below for "unchanged".
+            compare = self._ops.get(op, op)
+            addresses.extend(new._compare_pages(old, self.dtype, compare, self.aligned, 0x1000000, self.pages, True))
+
+        if op == "unchanged":
+            same = new._unchanged_mask(old) & self.pages
+            if value is None:
+                # Still unknown, keep the pages that didn't change.
+                self.snapshot = new
+                self.pages = same
+            else:
+                found = new.iter_select(self.dtype, select, self.aligned, same)
+                addresses.extend(addrs for addrs, _ in found)
+        old.close()
+        if self.snapshot is not new:
+            new.close()
+            self.snapshot = None
+            self.pages = None
+
+        self._set(addresses, [numpy.zeros(len(a), self.dtype) for a in addresses])
+        self.values, valid = self.read()
+        if select is not None:
+            valid &= select(self.values)
+        self.addresses = self.addresses[valid]
+        self.values = self.values[valid]
+        return len(self)
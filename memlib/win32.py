@@ -78,6 +78,9 @@ CONTEXT_FLOATING_POINT = 0x00010008  # 387 state
 CONTEXT_DEBUG_REGISTERS = 0x00010010  # DB 0-3,6,7
 CONTEXT_EXTENDED_REGISTERS = 0x00010020  # cpu specific extensions
 CONTEXT_FULL = CONTEXT_CONTROL | CONTEXT_INTEGER | CONTEXT_SEGMENTS
+# The x64 flags have the same low bits as the i386 ones above.
+CONTEXT_i386 = 0x00010000
+CONTEXT_AMD64 = 0x00100000
 
 EXCEPTION_DATATYPE_MISALIGNMENT = 0x80000002
 EXCEPTION_BREAKPOINT = 0x80000003
@@ -127,6 +130,9 @@ WAIT_ABANDONED = 0x00000080
 WAIT_TIMEOUT = 0x00000102
 WAIT_FAILED = 0xFFFFFFFF
 
+DUPLICATE_CLOSE_SOURCE = 0x00000001
+DUPLICATE_SAME_ACCESS = 0x00000002
+
 MAX_PATH = 260
 
 EXCEPTION_DEBUG_EVENT = 1
@@ -142,9 +148,26 @@ RIP_EVENT = 9
 DBG_CONTINUE = 0x00010002
 DBG_EXCEPTION_NOT_HANDLED = 0x80010001
 
-# Make kernel32 independant of windll which may be unpredictable.
-kernel32 = ctypes.WinDLL("kernel32.dll")
-ntdll = ctypes.WinDLL("ntdll.dll")
+PAGE_NOACCESS = 0x01
+PAGE_READONLY = 0x02
+PAGE_READWRITE = 0x04
+PAGE_WRITECOPY = 0x08
+PAGE_EXECUTE = 0x10
+PAGE_EXECUTE_READ = 0x20
+PAGE_EXECUTE_READWRITE = 0x40
+PAGE_EXECUTE_WRITECOPY = 0x80
+PAGE_GUARD = 0x100
+PAGE_NOCACHE = 0x200
+PAGE_WRITECOMBINE = 0x400
+
+MEM_COMMIT = 0x00001000
+MEM_RESERVE = 0x00002000
+MEM_DECOMMIT = 0x00004000
+MEM_RELEASE = 0x00008000
+MEM_FREE = 0x00010000
+MEM_PRIVATE = 0x00020000
+MEM_MAPPED = 0x00040000
+MEM_IMAGE = 0x01000000
 
 
 class MODULEENTRY32(Structure):
@@ -270,6 +293,57 @@ class CONTEXT(Structure):
     ]
 
 
+class CONTEXT64(Structure):
+    _fields_ = [
+        ("P1Home", ULONGLONG),
+        ("P2Home", ULONGLONG),
+        ("P3Home", ULONGLONG),
+        ("P4Home", ULONGLONG),
+        ("P5Home", ULONGLONG),
+        ("P6Home", ULONGLONG),
+        ("ContextFlags", DWORD),
+        ("MxCsr", DWORD),
+        ("SegCs", WORD),
+        ("SegDs", WORD),
+        ("SegEs", WORD),
+        ("SegFs", WORD),
+        ("SegGs", WORD),
+        ("SegSs", WORD),
+        ("EFlags", DWORD),
+        ("Dr0", ULONGLONG),
+        ("Dr1", ULONGLONG),
+        ("Dr2", ULONGLONG),
+        ("Dr3", ULONGLONG),
+        ("Dr6", ULONGLONG),
+        ("Dr7", ULONGLONG),
+        ("Rax", ULONGLONG),
+        ("Rcx", ULONGLONG),
+        ("Rdx", ULONGLONG),
+        ("Rbx", ULONGLONG),
+        ("Rsp", ULONGLONG),
+        ("Rbp", ULONGLONG),
+        ("Rsi", ULONGLONG),
+        ("Rdi", ULONGLONG),
+        ("R8", ULONGLONG),
+        ("R9", ULONGLONG),
+        ("R10", ULONGLONG),
+        ("R11", ULONGLONG),
+        ("R12", ULONGLONG),
+        ("R13", ULONGLONG),
+        ("R14", ULONGLONG),
+        ("R15", ULONGLONG),
+        ("Rip", ULONGLONG),
+        ("FltSave", BYTE * 512),
+        ("VectorRegister", ULONGLONG * 52),
+        ("VectorControl", ULONGLONG),
+        ("DebugControl", ULONGLONG),
+        ("LastBranchToRip", ULONGLONG),
+        ("LastBranchFromRip", ULONGLONG),
+        ("LastExceptionToRip", ULONGLONG),
+        ("LastExceptionFromRip", ULONGLONG),
+    ]
+
+
 class EXCEPTION_DEBUG_INFO(Structure):
     EXCEPTION_MAXIMUM_PARAMETERS = 15
     _fields_ = [
@@ -379,174 +453,200 @@ class THREAD_BASIC_INFORMATION(Structure):
     ]
 
 
-CloseHandle = kernel32.CloseHandle
-CloseHandle.argtypes = [HANDLE]
-CloseHandle.restype = BOOL
-DuplicateHandle = kernel32.DuplicateHandle
-DuplicateHandle.argtypes = [
-    HANDLE,
-    HANDLE,
-    HANDLE,
-    POINTER(HANDLE),
-    DWORD,
-    BOOL,
-    DWORD,
-]
-DuplicateHandle.restype = BOOL
-GetLastError = kernel32.GetLastError
-GetLastError.argtypes = []
-GetLastError.restype = DWORD
-WaitForSingleObject = kernel32.WaitForSingleObject
-
-kernel32.MapViewOfFile.restype = LPVOID
-
-OpenProcess = kernel32.OpenProcess
-OpenProcess.argtypes = [DWORD, BOOL, DWORD]
-OpenProcess.restype = HANDLE
-TerminateProcess = kernel32.TerminateProcess
-TerminateProcess.argtypes = [HANDLE, UINT]
-TerminateProcess.restype = BOOL
-
-OpenThread = kernel32.OpenThread
-OpenThread.argtypes = [DWORD, BOOL, DWORD]
-OpenThread.restype = HANDLE
-GetThreadId = kernel32.GetThreadId
-GetThreadId.argtypes = [HANDLE]
-GetThreadId.restype = DWORD
-ResumeThread = kernel32.ResumeThread
-ResumeThread.argtypes = [HANDLE]
-ResumeThread.restype = DWORD
-SuspendThread = kernel32.SuspendThread
-SuspendThread.argtypes = [HANDLE]
-SuspendThread.restype = DWORD
-CreateRemoteThread = kernel32.CreateRemoteThread
-CreateRemoteThread.argtypes = [
-    HANDLE,
-    LPVOID,
-    SIZE_T,
-    LPVOID,
-    LPVOID,
-    DWORD,
-    POINTER(DWORD),
-]
-CreateRemoteThread.restype = HANDLE
-TerminateThread = kernel32.TerminateThread
-TerminateThread.argtypes = [HANDLE, DWORD]
-TerminateThread.restype = BOOL
-GetExitCodeThread = kernel32.GetExitCodeThread
-GetExitCodeThread.argtypes = [HANDLE, POINTER(DWORD)]
-GetExitCodeThread.restype = BOOL
-GetExitCodeProcess = kernel32.GetExitCodeProcess
-GetExitCodeProcess.argtypes = [HANDLE, POINTER(DWORD)]
-GetExitCodeProcess.restype = BOOL
-GetThreadContext = kernel32.GetThreadContext
-GetThreadContext.argtypes = [HANDLE, POINTER(CONTEXT)]
-GetThreadContext.restype = BOOL
-SetThreadContext = kernel32.SetThreadContext
-SetThreadContext.argtypes = [HANDLE, POINTER(CONTEXT)]
-SetThreadContext.restype = BOOL
-
-VirtualAllocEx = kernel32.VirtualAllocEx
-VirtualAllocEx.argtypes = [HANDLE, LPVOID, SIZE_T, DWORD, DWORD]
-VirtualAllocEx.restype = LPVOID
-VirtualFreeEx = kernel32.VirtualFreeEx
-VirtualFreeEx.argtypes = [HANDLE, LPVOID, SIZE_T, DWORD]
-VirtualFreeEx.restype = BOOL
-VirtualProtectEx = kernel32.VirtualProtectEx
-VirtualProtectEx.argtypes = [HANDLE, LPVOID, SIZE_T, DWORD, POINTER(DWORD)]
-VirtualProtectEx.restype = BOOL
-VirtualQueryEx = kernel32.VirtualQueryEx
-VirtualQueryEx.argtypes = [HANDLE, LPVOID, LPVOID, SIZE_T]
-VirtualQueryEx.restype = SIZE_T
-ReadProcessMemory = kernel32.ReadProcessMemory
-ReadProcessMemory.argtypes = [HANDLE, LPVOID, LPVOID, SIZE_T, POINTER(SIZE_T)]
-ReadProcessMemory.restype = BOOL
-WriteProcessMemory = kernel32.WriteProcessMemory
-WriteProcessMemory.argtypes = [HANDLE, LPVOID, LPVOID, SIZE_T, POINTER(SIZE_T)]
-FlushInstructionCache = kernel32.FlushInstructionCache
-FlushInstructionCache.argtypes = [HANDLE, LPVOID, SIZE_T]
-FlushInstructionCache.restype = BOOL
-
-CreateToolhelp32Snapshot = kernel32.CreateToolhelp32Snapshot
-CreateToolhelp32Snapshot.argtypes = [DWORD, DWORD]
-CreateToolhelp32Snapshot.restype = HANDLE
-Module32First = kernel32.Module32First
-Module32First.argtypes = [HANDLE, POINTER(MODULEENTRY32)]
-Module32First.restype = BOOL
-Module32Next = kernel32.Module32Next
-Module32Next.argtypes = [HANDLE, POINTER(MODULEENTRY32)]
-Module32Next.restype = BOOL
-Process32First = kernel32.Process32First
-Process32First.argtypes = [HANDLE, POINTER(PROCESSENTRY32)]
-Process32First.restype = BOOL
-Process32Next = kernel32.Process32Next
-Process32Next.argtypes = [HANDLE, POINTER(PROCESSENTRY32)]
-Process32Next.restype = BOOL
-Thread32First = kernel32.Thread32First
-Thread32First.argtypes = [HANDLE, POINTER(THREADENTRY32)]
-Thread32First.restype = BOOL
-Thread32Next = kernel32.Thread32Next
-Thread32Next.argtypes = [HANDLE, POINTER(THREADENTRY32)]
-Thread32Next.restype = BOOL
-
-DebugSetProcessKillOnExit = kernel32.DebugSetProcessKillOnExit
-DebugSetProcessKillOnExit.argtypes = [BOOL]
-DebugSetProcessKillOnExit.restype = BOOL
-DebugActiveProcess = kernel32.DebugActiveProcess
-DebugActiveProcess.argtypes = [DWORD]
-DebugActiveProcess.restype = BOOL
-DebugActiveProcessStop = kernel32.DebugActiveProcessStop
-DebugActiveProcessStop.argtypes = [DWORD]
-DebugActiveProcessStop.restype = BOOL
-WaitForDebugEvent = kernel32.WaitForDebugEvent
-WaitForDebugEvent.argtypes = [POINTER(DEBUG_EVENT), DWORD]
-WaitForDebugEvent.restype = BOOL
-ContinueDebugEvent = kernel32.ContinueDebugEvent
-ContinueDebugEvent.argtypes = [DWORD, DWORD, DWORD]
-ContinueDebugEvent.restype = BOOL
-
-FormatMessageW = kernel32.FormatMessageW
-FormatMessageW.argtypes = [
-    DWORD,
-    LPVOID,
-    DWORD,
-    DWORD,
-    LPWSTR,
-    DWORD,
-]  # How do we specify va_list ?
-FormatMessageW.restype = DWORD
-LoadLibraryA = kernel32.LoadLibraryA
-LoadLibraryA.argtypes = [LPSTR]
-LoadLibraryA.restype = HMODULE
-LoadLibraryW = kernel32.LoadLibraryW
-LoadLibraryW.argtypes = [LPWSTR]
-LoadLibraryW.restype = HMODULE
-GetProcAddress = kernel32.GetProcAddress
-GetProcAddress.argtypes = [HMODULE, LPSTR]
-GetProcAddress.restype = LPVOID
-GetModuleHandleA = kernel32.GetModuleHandleA
-GetModuleHandleA.argtypes = [LPSTR]
-GetModuleHandleA.restype = HMODULE
-GetModuleHandleW = kernel32.GetModuleHandleW
-GetModuleHandleW.argtypes = [LPWSTR]
-GetModuleHandleW.restype = HMODULE
-
-NtQueryInformationThread = ntdll.NtQueryInformationThread
-NtQueryInformationThread.argtypes = [HANDLE, DWORD, PVOID, ULONG, POINTER(ULONG)]
-NtQueryInformationThread.restype = NTSTATUS
+# Make kernel32 independant of windll which may be unpredictable.
+# The bindings only exist on Windows, so that the rest of the package (and the
+# non Win32 backends) can still be imported elsewhere.
+if os.name == "nt":
+    kernel32 = ctypes.WinDLL("kernel32.dll")
+    ntdll = ctypes.WinDLL("ntdll.dll")
+
+    CloseHandle = kernel32.CloseHandle
+    CloseHandle.argtypes = [HANDLE]
+    CloseHandle.restype = BOOL
+    DuplicateHandle = kernel32.DuplicateHandle
+    DuplicateHandle.argtypes = [
+        HANDLE,
+        HANDLE,
+        HANDLE,
+        POINTER(HANDLE),
+        DWORD,
+        BOOL,
+        DWORD,
+    ]
+    DuplicateHandle.restype = BOOL
+    GetLastError = kernel32.GetLastError
+    GetLastError.argtypes = []
+    GetLastError.restype = DWORD
+    WaitForSingleObject = kernel32.WaitForSingleObject
+    WaitForSingleObject.argtypes = [HANDLE, DWORD]
+    WaitForSingleObject.restype = DWORD
+    CreateEventW = kernel32.CreateEventW
+    CreateEventW.argtypes = [LPVOID, BOOL, BOOL, LPCWSTR]
+    CreateEventW.restype = HANDLE
+    SetEvent = kernel32.SetEvent
+    SetEvent.argtypes = [HANDLE]
+    SetEvent.restype = BOOL
+    ResetEvent = kernel32.ResetEvent
+    ResetEvent.argtypes = [HANDLE]
+    ResetEvent.restype = BOOL
+    GetCurrentProcess = kernel32.GetCurrentProcess
+    GetCurrentProcess.argtypes = []
+    GetCurrentProcess.restype = HANDLE
+
+    kernel32.MapViewOfFile.restype = LPVOID
+
+    OpenProcess = kernel32.OpenProcess
+    OpenProcess.argtypes = [DWORD, BOOL, DWORD]
+    OpenProcess.restype = HANDLE
+    TerminateProcess = kernel32.TerminateProcess
+    TerminateProcess.argtypes = [HANDLE, UINT]
+    TerminateProcess.restype = BOOL
+
+    OpenThread = kernel32.OpenThread
+    OpenThread.argtypes = [DWORD, BOOL, DWORD]
+    OpenThread.restype = HANDLE
+    GetThreadId = kernel32.GetThreadId
+    GetThreadId.argtypes = [HANDLE]
+    GetThreadId.restype = DWORD
+    ResumeThread = kernel32.ResumeThread
+    ResumeThread.argtypes = [HANDLE]
+    ResumeThread.restype = DWORD
+    SuspendThread = kernel32.SuspendThread
+    SuspendThread.argtypes = [HANDLE]
+    SuspendThread.restype = DWORD
+    CreateRemoteThread = kernel32.CreateRemoteThread
+    CreateRemoteThread.argtypes = [
+        HANDLE,
+        LPVOID,
+        SIZE_T,
+        LPVOID,
+        LPVOID,
+        DWORD,
+        POINTER(DWORD),
+    ]
+    CreateRemoteThread.restype = HANDLE
+    TerminateThread = kernel32.TerminateThread
+    TerminateThread.argtypes = [HANDLE, DWORD]
+    TerminateThread.restype = BOOL
+    GetExitCodeThread = kernel32.GetExitCodeThread
+    GetExitCodeThread.argtypes = [HANDLE, POINTER(DWORD)]
+    GetExitCodeThread.restype = BOOL
+    GetExitCodeProcess = kernel32.GetExitCodeProcess
+    GetExitCodeProcess.argtypes = [HANDLE, POINTER(DWORD)]
+    GetExitCodeProcess.restype = BOOL
+    GetThreadContext = kernel32.GetThreadContext
+    GetThreadContext.argtypes = [HANDLE, POINTER(CONTEXT)]
+    GetThreadContext.restype = BOOL
+    SetThreadContext = kernel32.SetThreadContext
+    SetThreadContext.argtypes = [HANDLE, POINTER(CONTEXT)]
+    SetThreadContext.restype = BOOL
+
+    VirtualAllocEx = kernel32.VirtualAllocEx
+    VirtualAllocEx.argtypes = [HANDLE, LPVOID, SIZE_T, DWORD, DWORD]
+    VirtualAllocEx.restype = LPVOID
+    VirtualFreeEx = kernel32.VirtualFreeEx
+    VirtualFreeEx.argtypes = [HANDLE, LPVOID, SIZE_T, DWORD]
+    VirtualFreeEx.restype = BOOL
+    VirtualProtectEx = kernel32.VirtualProtectEx
+    VirtualProtectEx.argtypes = [HANDLE, LPVOID, SIZE_T, DWORD, POINTER(DWORD)]
+    VirtualProtectEx.restype = BOOL
+    VirtualQueryEx = kernel32.VirtualQueryEx
+    VirtualQueryEx.argtypes = [HANDLE, LPVOID, LPVOID, SIZE_T]
+    VirtualQueryEx.restype = SIZE_T
+    ReadProcessMemory = kernel32.ReadProcessMemory
+    ReadProcessMemory.argtypes = [HANDLE, LPVOID, LPVOID, SIZE_T, POINTER(SIZE_T)]
+    ReadProcessMemory.restype = BOOL
+    WriteProcessMemory = kernel32.WriteProcessMemory
+    WriteProcessMemory.argtypes = [HANDLE, LPVOID, LPVOID, SIZE_T, POINTER(SIZE_T)]
+    FlushInstructionCache = kernel32.FlushInstructionCache
+    FlushInstructionCache.argtypes = [HANDLE, LPVOID, SIZE_T]
+    FlushInstructionCache.restype = BOOL
+
+    CreateToolhelp32Snapshot = kernel32.CreateToolhelp32Snapshot
+    CreateToolhelp32Snapshot.argtypes = [DWORD, DWORD]
+    CreateToolhelp32Snapshot.restype = HANDLE
+    Module32First = kernel32.Module32First
+    Module32First.argtypes = [HANDLE, POINTER(MODULEENTRY32)]
+    Module32First.restype = BOOL
+    Module32Next = kernel32.Module32Next
+    Module32Next.argtypes = [HANDLE, POINTER(MODULEENTRY32)]
+    Module32Next.restype = BOOL
+    Process32First = kernel32.Process32First
+    Process32First.argtypes = [HANDLE, POINTER(PROCESSENTRY32)]
+    Process32First.restype = BOOL
+    Process32Next = kernel32.Process32Next
+    Process32Next.argtypes = [HANDLE, POINTER(PROCESSENTRY32)]
+    Process32Next.restype = BOOL
+    Thread32First = kernel32.Thread32First
+    Thread32First.argtypes = [HANDLE, POINTER(THREADENTRY32)]
+    Thread32First.restype = BOOL
+    Thread32Next = kernel32.Thread32Next
+    Thread32Next.argtypes = [HANDLE, POINTER(THREADENTRY32)]
+    Thread32Next.restype = BOOL
+
+    DebugSetProcessKillOnExit = kernel32.DebugSetProcessKillOnExit
+    DebugSetProcessKillOnExit.argtypes = [BOOL]
+    DebugSetProcessKillOnExit.restype = BOOL
+    DebugActiveProcess = kernel32.DebugActiveProcess
+    DebugActiveProcess.argtypes = [DWORD]
+    DebugActiveProcess.restype = BOOL
+    DebugActiveProcessStop = kernel32.DebugActiveProcessStop
+    DebugActiveProcessStop.argtypes = [DWORD]
+    DebugActiveProcessStop.restype = BOOL
+    WaitForDebugEvent = kernel32.WaitForDebugEvent
+    WaitForDebugEvent.argtypes = [POINTER(DEBUG_EVENT), DWORD]
+    WaitForDebugEvent.restype = BOOL
+    ContinueDebugEvent = kernel32.ContinueDebugEvent
+    ContinueDebugEvent.argtypes = [DWORD, DWORD, DWORD]
+    ContinueDebugEvent.restype = BOOL
+
+    FormatMessageW = kernel32.FormatMessageW
+    FormatMessageW.argtypes = [
+        DWORD,
+        LPVOID,
+        DWORD,
+        DWORD,
+        LPWSTR,
+        DWORD,
+    ]  # How do we specify va_list ?
+    FormatMessageW.restype = DWORD
+    LoadLibraryA = kernel32.LoadLibraryA
+    LoadLibraryA.argtypes = [LPSTR]
+    LoadLibraryA.restype = HMODULE
+    LoadLibraryW = kernel32.LoadLibraryW
+    LoadLibraryW.argtypes = [LPWSTR]
+    LoadLibraryW.restype = HMODULE
+    GetProcAddress = kernel32.GetProcAddress
+    GetProcAddress.argtypes = [HMODULE, LPSTR]
+    GetProcAddress.restype = LPVOID
+    GetModuleHandleA = kernel32.GetModuleHandleA
+    GetModuleHandleA.argtypes = [LPSTR]
+    GetModuleHandleA.restype = HMODULE
+    GetModuleHandleW = kernel32.GetModuleHandleW
+    GetModuleHandleW.argtypes = [LPWSTR]
+    GetModuleHandleW.restype = HMODULE
+
+    NtQueryInformationThread = ntdll.NtQueryInformationThread
+    NtQueryInformationThread.argtypes = [HANDLE, DWORD, PVOID, ULONG, POINTER(ULONG)]
+    NtQueryInformationThread.restype = NTSTATUS
+else:
+    kernel32 = None
+    ntdll = None
+
 
 def FormatMessage(error):
     """Format a Win32 error code to the corresponding message. (See MSDN)"""
     size = 256
     while size < 0x10000:  # 0x10000 is the constant choosed in C# standard lib.
         buffer = (WCHAR * size)()
-        result = _FormatMessageW(
+        result = FormatMessageW(
             0x200 | 0x1000 | 0x2000, None, error, 0, byref(buffer), size, None
         )
         if result > 0:
             return buffer[: result - 2]
-        if _GetLastError() != 0x7A:  # ERROR_INSUFFICIENT_BUFFER
+        if GetLastError() != 0x7A:  # ERROR_INSUFFICIENT_BUFFER
             break
+        size *= 2
     return "Unknown error"
 
 
@@ -554,8 +654,8 @@ class Win32Exception(RuntimeError):
     """Exception class for Win32 runtime errors."""
 
     def __init__(self, error=None, message=None):
-        self.error = error or _GetLastError()
-        self.msg = message or _FormatMessage(self.error)
+        self.error = error or GetLastError()
+        self.msg = message or FormatMessage(self.error)
 
     def __str__(self):
         return "%s (0x%08x)" % (self.msg, self.error)
@@ -0,0 +1,214 @@
+from collections import namedtuple
+import struct
+
+Instruction = namedtuple("Instruction", [
+    "address",      # address of the instruction
+    "length",       # length in bytes
+    "opcode",       # opcode, 0x0F-prefixed opcodes are 0x0Fxx, 0x0F38xx or 0x0F3Axx
+    "modrm",        # offset of the ModRM byte in the instruction, or None
+    "disp",         # (offset, size) of the displacement, or None
+    "imm",          # (offset, size) of the immediate, or None
+    "rip_relative", # True if the memory operand is [rip+disp32] (x64)
+    "branch",       # target of a relative jmp/call/jcc, or None
+])
+
+class DecodeError(RuntimeError):
+    """Raised for the instructions the decoder doesn't handle."""
+    pass
+
+_PREFIXES = frozenset([0x26, 0x2E, 0x36, 0x3E, 0x64, 0x65, 0x66, 0x67, 0xF0, 0xF2, 0xF3])
+
+def _ranges(*ranges):
+    codes = set()
+    for r in ranges:
+        if isinstance(r, tuple):
+            codes.update(range(r[0], r[1] + 1))
+        else:
+            codes.add(r)
+    return frozenset(codes)
+
+# One byte opcodes with a ModRM byte
+_MODRM = _ranges(
+    (0x00, 0x03), (0x08, 0x0B), (0x10, 0x13), (0x18, 0x1B), (0x20, 0x23), (0x28, 0x2B),
+    (0x30, 0x33), (0x38, 0x3B), 0x62, 0x63, 0x69, 0x6B, (0x80, 0x8F), 0xC0, 0xC1,
+    0xC4, 0xC5, 0xC6, 0xC7, (0xD0, 0xD3), (0xD8, 0xDF), 0xF6, 0xF7, 0xFE, 0xFF,
+)
+_IMM8 = _ranges(
+    0x04, 0x0C, 0x14, 0x1C, 0x24, 0x2C, 0x34, 0x3C, 0x6A, 0x6B, 0x80, 0x82, 0x83, 0xA8,
+    (0xB0, 0xB7), 0xC0, 0xC1, 0xC6, 0xCD, 0xD4, 0xD5, (0xE4, 0xE7),
+)
+# Immediates of the operand size (2 or 4 bytes)
+_IMMZ = _ranges(0x05, 0x0D, 0x15, 0x1D, 0x25, 0x2D, 0x35, 0x3D, 0x68, 0x69, 0x81, 0xA9, 0xC7)
+_REL8 = _ranges((0x70, 0x7F), (0xE0, 0xE3), 0xEB)
+_REL32 = _ranges(0xE8, 0xE9)
+
+# Two bytes opcodes (0x0F xx) without a ModRM byte
+_0F_NO_MODRM = _ranges(
+    0x05, 0x06, 0x07, 0x08, 0x09, 0x0B, 0x0E, (0x30, 0x37), 0x77, (0x80, 0x8F),
+    0xA0, 0xA1, 0xA2, 0xA8, 0xA9, 0xAA, (0xC8, 0xCF),
+)
+_0F_IMM8 = _ranges((0x70, 0x73), 0xA4, 0xAC, 0xBA, 0xC2, 0xC4, 0xC5, 0xC6)
+
+
+def decode(code, offset=0, address=0, x64=False):
+    """
+    Decodes the instruction at offset of code (bytes-like), address is its address
+    in the process, used for the relative operands. Returns an Instruction.
+
+    Only the length and the position of the operands are decoded, which is enough
+    to find instruction boundaries and relocate code. VEX/EVEX encoded instructions
+    and 16 bits addressing are not supported.
+    """
+    def byte(i):
+        if i >= len(code):
+            raise DecodeError("Truncated instruction at 0x%x." % address)
+        return code[i]
+
+    i = offset
+    operand16 = False
+    address16 = False
+    while byte(i) in _PREFIXES:
+        operand16 |= code[i] == 0x66
+        address16 |= code[i] == 0x67
+        i += 1
+    rex_w = False
+    if x64 and 0x40 <= byte(i) <= 0x4F:
+        rex_w = bool(code[i] & 8)
+        i += 1
+    if address16 and not x64:
+        raise DecodeError("16 bits addressing is not supported (0x%x)." % address)
+
+    op = byte(i)
+    i += 1
+    has_modrm = False
+    imm_size = 0
+    rel_size = 0
+    immz = 2 if operand16 else 4
+
+    if op == 0x0F:
+        op2 = byte(i)
+        i += 1
+        if op2 == 0x38:
+            opcode = 0x0F3800 | byte(i)
+            i += 1
+            has_modrm = True
+        elif op2 == 0x3A:
+            opcode = 0x0F3A00 | byte(i)
+            i += 1
+            has_modrm = True
+            imm_size = 1
+        else:
+            opcode = 0x0F00 | op2
+            has_modrm = op2 not in _0F_NO_MODRM
+            if op2 in _0F_IMM8:
+                imm_size = 1
+            if 0x80 <= op2 <= 0x8F:
+                rel_size = 4
+    else:
+        opcode = op
+        if x64 and op in (0xC4, 0xC5, 0x62):
+            raise DecodeError("VEX/EVEX instructions are not supported (0x%x)." % address)
+        if x64 and op in (0x06, 0x07, 0x0E, 0x16, 0x17, 0x1E, 0x1F, 0x27, 0x2F, 0x37, 0x3F, 0x60, 0x61, 0x9A, 0xCE, 0xD4, 0xD5, 0xEA):
+            raise DecodeError("Invalid x64 instruction 0x%02x at 0x%x." % (op, address))
+        has_modrm = op in _MODRM
+        if op in _IMM8:
+            imm_size = 1
+        elif op in _IMMZ:
+            imm_size = immz
+        elif 0xB8 <= op <= 0xBF:
+            imm_size = 8 if rex_w else immz
+        elif op in (0xC2, 0xCA):
+            imm_size = 2
+        elif op == 0xC8:
+            imm_size = 3
+        elif 0xA0 <= op <= 0xA3:
+            imm_size = 8 if x64 else 4
+        elif op in (0x9A, 0xEA):
+            imm_size = 4 + immz
+        if op in _REL8:
+            rel_size = 1
+        elif op in _REL32:
+            rel_size = immz
+
+    modrm = None
+    disp = None
+    rip_relative = False
+    if has_modrm:
+        modrm = i - offset
+        value = byte(i)
+        i += 1
+        mod, reg, rm = value >> 6, (value >> 3) & 7, value & 7
+        if opcode in (0xF6, 0xF7) and reg in (0, 1):
+            imm_size = 1 if opcode == 0xF6 else immz
+        if mod != 3:
+            disp_size = 0
+            if rm == 4:
+                sib = byte(i)
+                i += 1
+                if mod == 0 and sib & 7 == 5:
+                    disp_size = 4
+            elif mod == 0 and rm == 5:
+                disp_size = 4
+                rip_relative = x64
+            if mod == 1:
+                disp_size = 1
+            elif mod == 2:
+                disp_size = 4
+            if disp_size:
+                disp = (i - offset, disp_size)
+                i += disp_size
+
+    imm = None
+    branch = None
+    if rel_size:
+        rel = int.from_bytes(bytes(code[i:i + rel_size]), "little", signed=True)
+        imm = (i - offset, rel_size)
+        i += rel_size
+        branch = address + (i - offset) + rel
+    elif imm_size:
+        imm = (i - offset, imm_size)
+        i += imm_size
+    if i > len(code):
+        raise DecodeError("Truncated instruction at 0x%x." % address)
+
+    return Instruction(address, i - offset, opcode, modrm, disp, imm, rip_relative, branch)
+
+
+def rip_target(insn, code, offset=0):
+    """Returns the address referenced by the [rip+disp32] operand of insn (decoded at offset of code)."""
+    return insn.address + insn.length + struct.unpack_from("<i", code, offset + insn.disp[0])[0]
+
+
+def relocate(code, address, new_address, min_length, x64=False):
+    """
+    Copies the whole instructions of code (read at address) covering at least
+    min_length bytes so that they can run at new_address: relative calls and jumps
+    and [rip+disp32] operands are fixed. Returns (relocated code, length of the
+    original instructions), raises DecodeError if they can't be moved.
+    """
+    out = bytearray()
+    offset = 0
+    while offset < min_length:
+        insn = decode(code, offset, address + offset, x64)
+        raw = bytearray(code[offset:offset + insn.length])
+        new_ip = new_address + len(out)
+        if insn.branch is not None:
+            if insn.imm[1] != 4:
+                raise DecodeError("Can't relocate the short branch at 0x%x." % insn.address)
+            rel = insn.branch - (new_ip + insn.length)
+            if not x64:
+                # The 32 bits address space wraps around.
+                rel = (rel + 2 ** 31) % 2 ** 32 - 2 ** 31
+            if not -2 ** 31 <= rel < 2 ** 31:
+                raise DecodeError("The target of the branch at 0x%x is out of reach." % insn.address)
+            struct.pack_into("<i", raw, insn.imm[0], rel)
+        elif insn.rip_relative:
+            rel = rip_target(insn, code, offset) - (new_ip + insn.length)
+            if not -2 ** 31 <= rel < 2 ** 31:
+                raise DecodeError("The operand of the instruction at 0x%x is out of reach." % insn.address)
+            struct.pack_into("<i", raw, insn.disp[0], rel)
+        if insn.opcode in (0xC2, 0xC3, 0xCA, 0xCB, 0xCC) and offset + insn.length < min_length:
+            raise DecodeError("The function at 0x%x is too short to be hooked." % address)
+        out += raw
+        offset += insn.length
+    return bytes(out), offset
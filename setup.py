@@ -8,4 +8,7 @@ setuptools.setup(
     author='github.com/reduf, github.com/GregLando113',
     url='https://github.com/GregLando113/pymemlib',
     packages=setuptools.find_packages(),
+    extras_require={
+        'numpy': ['numpy'],
+    },
 )
\ No newline at end of file
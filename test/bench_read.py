@@ -0,0 +1,33 @@
+from memlib import *
+import os
+import struct
+import timeit
+
+# Reads the memory of the current process, so it runs on any platform with a backend.
+proc = Process(os.getpid())
+data = (DWORD * 4)(1, 2, 3, 4)
+addr = addressof(data)
+
+def legacy_read(addr, format="I"):
+    # Process.read before the struct cache and the reusable buffer.
+    size = struct.calcsize(format)
+    buffer = utils.create_buffer(size)
+    proc.backend.read_into(addr, buffer, size)
+    t = struct.unpack(format, buffer)
+    if len(t) == 1:
+        return t[0]
+    return t
+
+into = bytearray(16)
+raw = utils.create_buffer(4)
+number = 100000
+# The per-read overhead of memlib is the difference with the raw backend read.
+for name, stmt in [
+    ("backend", lambda: proc.backend.read_into(addr, raw, 4)),
+    ("legacy read", lambda: legacy_read(addr, "I")),
+    ("read", lambda: proc.read(addr, "I")),
+    ("read_into", lambda: proc.read_into(addr, into)),
+    ("read_struct", lambda: proc.read_struct(addr, DWORD * 4)),
+]:
+    t = min(timeit.repeat(stmt, number=number, repeat=5))
+    print("%-12s %.3f us/read" % (name, t / number * 1e6))
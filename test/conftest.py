@@ -0,0 +1,2 @@
+# Interactive scripts driving a Windows test.exe, run them by hand.
+collect_ignore = ["test_sharedmem.py", "test_x64call.py"]
@@ -0,0 +1,181 @@
+from memlib import win32
+from memlib.backend import LinuxBackend, UnsupportedOperation, open_backend
+from memlib.process import ModuleNotFoundError, Process
+
+import ctypes
+import os
+import struct
+import subprocess
+import sys
+import threading
+
+import pytest
+
+if not sys.platform.startswith("linux"):
+    pytest.skip("Tests the Linux backend.", allow_module_level=True)
+
+# Maps 2 pages filled with a pattern, prints their address and the pattern
+# bytes read back after each line of input.
+CHILD = """
+import ctypes, mmap, sys
+m = mmap.mmap(-1, 0x2000)
+m[:] = bytes(range(256)) * 32
+print(ctypes.addressof(ctypes.c_char.from_buffer(m)), flush=True)
+for line in sys.stdin:
+    offset, size = map(int, line.split())
+    print(m[offset:offset + size].hex(), flush=True)
+"""
+
+
+@pytest.fixture(scope="module")
+def child():
+    popen = subprocess.Popen([sys.executable, "-c", CHILD],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+    base = int(popen.stdout.readline())
+    proc = Process(popen.pid)
+
+    def peek(offset, size):
+        popen.stdin.write("%d %d\n" % (offset, size))
+        popen.stdin.flush()
+        return bytes.fromhex(popen.stdout.readline().strip())
+
+    yield proc, base, peek
+    popen.stdin.close()
+    popen.wait()
+
+
+def test_open_backend(child):
+    proc, _, _ = child
+    assert isinstance(proc.backend, LinuxBackend)
+    assert isinstance(open_backend(os.getpid()), LinuxBackend)
+
+
+def test_read(child):
+    proc, base, _ = child
+    assert proc.read(base, "4B") == (0, 1, 2, 3)
+    assert proc.read(base + 0x1FFC, "I") == 0xFFFEFDFC
+    assert proc.backend.read(base + 0xFF, 2) == b"\xFF\x00"
+
+    buffer = bytearray(8)
+    proc.read_into(base + 0x10, buffer)
+    assert buffer == bytes(range(0x10, 0x18))
+
+    # One process_vm_readv for the ranges, back to back in the buffer.
+    buffer = ctypes.create_string_buffer(6)
+    proc.backend.readv([(base + 1, 2), (base + 0x1001, 4)], buffer)
+    assert buffer.raw == b"\x01\x02\x01\x02\x03\x04"
+    assert proc.read_many([(base + 2, "B"), (base + 0x1800, "H")]) == [2, 0x0100]
+
+
+@pytest.fixture
+def readv_calls(child, monkeypatch):
+    proc, _, _ = child
+    calls = list()
+    readv = proc.backend.readv
+
+    def record(ranges, buffer):
+        calls.append(list(ranges))
+        return readv(ranges, buffer)
+
+    monkeypatch.setattr(proc.backend, "readv", record)
+    return calls
+
+
+def test_read_many(child, readv_calls):
+    proc, base, _ = child
+    items = [(base + 0x1000, "I"), (base + 0x10, "H"), (base + 0x12, "2B"), (base + 0x400, "B"), (base + 0x11, "B")]
+    expected = [0x03020100, 0x1110, (0x12, 0x13), 0x00, 0x11]
+    # Ranges closer than max_gap are read as one, overlapping ones included.
+    assert proc.read_many(items) == expected
+    assert readv_calls == [[(base + 0x10, 0x3F1), (base + 0x1000, 4)]]
+
+    del readv_calls[:]
+    assert proc.read_many(items, max_gap=0x10) == expected
+    assert readv_calls == [[(base + 0x10, 4), (base + 0x400, 1), (base + 0x1000, 4)]]
+
+    # Adjacent ranges are merged even without gap.
+    del readv_calls[:]
+    assert proc.read_many([(base + 4, "H"), (base + 6, "H")], max_gap=0) == [0x0504, 0x0706]
+    assert readv_calls == [[(base + 4, 4)]]
+
+
+def test_read_buffers(child):
+    proc, base, _ = child
+    # The buffer of a size is reused by the thread, the read_many one grows.
+    assert proc._get_read_buffer(4) is proc._get_read_buffer(4)
+    assert proc._get_read_buffer(8) is not proc._get_read_buffer(4)
+    gather = proc._get_gather_buffer(0x10)
+    assert proc._get_gather_buffer(len(gather)) is gather
+    assert len(proc._get_gather_buffer(len(gather) + 1)) == 2 * len(gather)
+
+    # Each thread gets its own buffers, so concurrent reads don't overwrite each other.
+    barrier = threading.Barrier(4)
+    buffers = dict()
+    errors = list()
+
+    def reader(index):
+        barrier.wait()
+        for i in range(500):
+            offset = (index * 0x100 + i) % 0x1FFC
+            expected = struct.unpack("<I", bytes((offset + j) & 0xFF for j in range(4)))[0]
+            if proc.read(base + offset, "I") != expected:
+                errors.append((index, offset))
+            if proc.read_many([(base + offset, "I"), (base + 0x1000, "B")]) != [expected, 0]:
+                errors.append((index, offset))
+        buffers[index] = (proc._get_read_buffer(4), proc._get_gather_buffer(8))
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert len({id(read) for read, _ in buffers.values()}) == 4
+    assert len({id(gather) for _, gather in buffers.values()}) == 4
+
+
+def test_read_unmapped(child):
+    proc, _, _ = child
+    with pytest.raises(OSError):
+        proc.read(0x10, "I")
+
+
+def test_write(child):
+    proc, base, peek = child
+    proc.write(base + 0x100, b"\xAA\xBB\xCC")
+    assert peek(0x100, 4) == b"\xAA\xBB\xCC\x03"
+    assert proc.read(base + 0x100, "3s") == b"\xAA\xBB\xCC"
+
+
+def test_regions(child):
+    proc, base, _ = child
+    region = next(region for region in proc.regions() if region.base <= base < region.end)
+    assert region.readable
+    assert region.end >= base + 0x2000
+    # A shared anonymous mapping, like a section view on Windows.
+    assert region.type == win32.MEM_MAPPED
+    size, protect = proc.page_info(base + 0x1000)
+    assert size >= 0x1000 and protect == region.protect
+
+
+def test_modules(child):
+    proc, _, _ = child
+    main = proc.module()
+    assert main.file == os.path.realpath(sys.executable)
+    assert proc.module(main.name) is main
+    assert proc.module_at(main.base) is main
+    with pytest.raises(ModuleNotFoundError):
+        proc.module("not_a_module.dll")
+
+
+def test_unsupported(child):
+    proc, _, _ = child
+    with pytest.raises(UnsupportedOperation):
+        proc.mmap(0x1000)
+    with pytest.raises(UnsupportedOperation):
+        proc.unmap(0x1000)
+    operations = (proc.kill, proc.join, proc.is_x64, lambda: proc.threads,
+        lambda: proc.spawn_thread(0x1000), lambda: proc.mapshared(0x1000))
+    for operation in operations:
+        with pytest.raises(UnsupportedOperation):
+            operation()
@@ -0,0 +1,387 @@
+from memlib import thread as thread_module
+from memlib import win32
+from memlib.debugger import DebuggerStats, HardwareHook, Hook, ProcessDebugger
+
+from ctypes import addressof, c_uint32, memmove, sizeof
+import asyncio
+import queue
+import threading
+import time
+import warnings
+
+import pytest
+
+PID = 7
+
+
+class FakeThread(object):
+    """A thread of which only the CONTEXT is known, records its calls in events."""
+
+    events = None
+
+    def __init__(self, id, process, handle=None):
+        self.id = id
+        self.handle = handle
+        self.exited = False
+        self.ctx = win32.CONTEXT()
+        self.ctx.Esp = 0x8000 + id * 0x100
+        process.opened.append((id, handle))
+
+    def suspend(self):
+        self.events.append(("suspend", self.id))
+
+    def resume(self):
+        self.events.append(("resume", self.id))
+
+    def context(self, flags=None, reuse=False):
+        if self.exited:
+            raise win32.Win32Exception(5, "Access is denied.")
+        return self.ctx
+
+    def set_context(self, ctx):
+        self.ctx = ctx
+        self.events.append(("set_context", self.id))
+
+
+class FakeModuleMap(object):
+
+    def invalidate(self):
+        pass
+
+
+class FakeProcess(object):
+    """The memory is a dict of the values read at an address."""
+
+    id = PID
+
+    def __init__(self):
+        self.opened = list()
+        self.values = dict()
+        self.memory = dict()
+        self.module_map = FakeModuleMap()
+        self.thread_registry = thread_module.ThreadRegistry(self)
+
+    @property
+    def threads(self):
+        return list(self.thread_registry)
+
+    def read(self, addr, fmt):
+        if addr in self.values:
+            return self.values[addr]
+        return b"\x55" if fmt == "s" else ()
+
+    def write(self, addr, data):
+        self.memory[addr] = data
+
+    def flush(self, addr, size):
+        pass
+
+
+@pytest.fixture
+def proc(monkeypatch):
+    events = list()
+    monkeypatch.setattr(FakeThread, "events", events)
+    monkeypatch.setattr(thread_module, "ProcessThread", FakeThread)
+    monkeypatch.setattr(win32, "GetCurrentProcess", lambda: -1, raising=False)
+    monkeypatch.setattr(win32, "DuplicateHandle", duplicate_handle, raising=False)
+    proc = FakeProcess()
+    proc.events = events
+    proc.continued = list()
+    monkeypatch.setattr(win32, "ContinueDebugEvent",
+                        lambda pid, tid, status: proc.continued.append((pid, tid, status)), raising=False)
+    return proc
+
+
+def duplicate_handle(source, handle, target, duplicate, access, inherit, options):
+    duplicate._obj.value = handle + 0x1000
+    return True
+
+
+def debug_event(code, tid, pid=PID, **fields):
+    evt = win32.DEBUG_EVENT()
+    evt.dwDebugEventCode = code
+    evt.dwProcessId = pid
+    evt.dwThreadId = tid
+    if code == win32.CREATE_THREAD_DEBUG_EVENT:
+        evt.u.CreateThread.hThread = 0x40 + tid
+    elif code == win32.CREATE_PROCESS_DEBUG_EVENT:
+        evt.u.CreateProcessInfo.hThread = 0x40 + tid
+    elif code == win32.EXCEPTION_DEBUG_EVENT:
+        evt.u.Exception.dwFirstChance = 1
+        for name, value in fields.items():
+            setattr(evt.u.Exception, name, value)
+    return evt
+
+
+def exception(code, addr=0):
+    return debug_event(win32.EXCEPTION_DEBUG_EVENT, 0, ExceptionCode=code, ExceptionAddress=addr).u.Exception
+
+
+def test_hardware_hook_checks():
+    proc = FakeProcess()
+    with pytest.raises(ValueError):
+        HardwareHook(proc, 0x2000, None, 0, HardwareHook.WRITE, 8)
+    with pytest.raises(ValueError):
+        HardwareHook(proc, 0x2000, None, 0, HardwareHook.EXECUTE, 4)
+    with pytest.raises(ValueError):
+        HardwareHook(proc, 0x2002, None, 0, HardwareHook.ACCESS, 4)
+
+    ctx = win32.CONTEXT()
+    ctx.Dr7 = 0xF0000003  # slot 3 and slot 0 are used by someone else
+    HardwareHook(proc, 0x2000, None, 1, HardwareHook.WRITE, 4).apply(ctx)
+    assert ctx.Dr1 == 0x2000 and ctx.Dr7 == 0xF0D00007
+    HardwareHook(proc, 0x2002, None, 1, HardwareHook.ACCESS, 2).apply(ctx)
+    assert ctx.Dr1 == 0x2002 and ctx.Dr7 == 0xF0700007
+    HardwareHook.clear(ctx, 1)
+    assert ctx.Dr1 == 0 and ctx.Dr7 == 0xF0000003
+
+
+def test_hardware_hook_threads(proc):
+    for id in (1, 2, 3):
+        proc.thread_registry.add(id, 0x40 + id)
+    proc.thread_registry.get(3).exited = True
+    dbg = ProcessDebugger()
+    dbg.proc = proc
+
+    # Every thread gets the registers, while suspended, the ones which exited are skipped.
+    watch = dbg.add_hardware_hook(0x2000, Hook.stdcall(c_uint32)(print), HardwareHook.WRITE, 4)
+    run = dbg.add_hardware_hook(0x401000, Hook.stdcall()(print))
+    assert (watch.slot, run.slot) == (0, 1)
+    for id in (1, 2):
+        ctx = proc.thread_registry.get(id).ctx
+        assert (ctx.Dr0, ctx.Dr1, ctx.Dr7) == (0x2000, 0x401000, 0xD0005)
+    assert proc.events[:4] == [("suspend", 1), ("set_context", 1), ("resume", 1), ("suspend", 2)]
+    assert ("resume", 3) in proc.events and ("set_context", 3) not in proc.events
+
+    dbg.add_hardware_hook(0x3000, Hook.stdcall()(print), HardwareHook.ACCESS)
+    dbg.add_hardware_hook(0x3001, Hook.stdcall()(print), HardwareHook.ACCESS)
+    with pytest.raises(RuntimeError):
+        dbg.add_hardware_hook(0x3002, Hook.stdcall()(print))
+    # Hooking an address again replaces its hook.
+    dbg.add_hardware_hook(0x3001, Hook.stdcall()(print), HardwareHook.WRITE)
+    dbg.remove_hardware_hook(0x2000)
+    dbg.remove_hardware_hook(0x3000)
+    assert [hw_hook and hw_hook.addr for hw_hook in dbg.hardware_hooks] == [None, 0x401000, None, 0x3001]
+    ctx = proc.thread_registry.get(1).ctx
+    assert (ctx.Dr0, ctx.Dr2, ctx.Dr3, ctx.Dr7) == (0, 0, 0x3001, 0x10000044)
+
+    # A thread created later gets them too, with its own handle.
+    dbg._handle_event(debug_event(win32.CREATE_THREAD_DEBUG_EVENT, 4))
+    ctx = proc.thread_registry.get(4).ctx
+    assert (ctx.Dr1, ctx.Dr3, ctx.Dr7) == (0x401000, 0x3001, 0x10000044)
+    assert proc.opened[-1] == (4, 0x1044)
+    assert proc.continued == [(PID, 4, win32.DBG_CONTINUE)]
+
+
+def test_hardware_breakpoint(proc):
+    calls = list()
+    dbg = ProcessDebugger()
+    dbg.proc = proc
+    thread = proc.thread_registry.add(1, 0x41)
+    dbg.add_hardware_hook(0x2000, Hook.stdcall(c_uint32)(lambda value: calls.append(("watch", value))),
+                          HardwareHook.WRITE, 4)
+    dbg.add_hardware_hook(0x401000, Hook.stdcall(c_uint32, c_uint32)(lambda a, b: calls.append(("run", a, b))))
+
+    # A watchpoint gets the value written, an execute breakpoint the arguments on the stack.
+    proc.values = {0x2000: 5, 0x8104: (1, 2)}
+    thread.ctx.Dr6 = 0x3
+    assert dbg._on_debug_event(thread, exception(win32.EXCEPTION_SINGLE_STEP, 0x401000)) == win32.DBG_CONTINUE
+    assert calls == [("watch", 5), ("run", 1, 2)]
+    assert thread.ctx.Dr6 == 0 and thread.ctx.EFlags & 0x10000
+    assert dbg.stats.hits == 2
+
+    # A single step of the process itself isn't handled.
+    assert dbg._on_debug_event(thread, exception(win32.EXCEPTION_SINGLE_STEP)) == win32.DBG_EXCEPTION_NOT_HANDLED
+
+    # The step after an INT3 hook can be the hit of a breakpoint too, the INT3 is put back.
+    dbg.add_hook(0x500000, Hook.stdcall(c_uint32, c_uint32)(lambda a, b: calls.append(("int3", a, b))))
+    assert dbg._on_debug_event(thread, exception(win32.EXCEPTION_BREAKPOINT, 0x500000)) == win32.DBG_CONTINUE
+    assert proc.memory[0x500000] == b"\x55" and thread.ctx.EFlags & 0x100
+    thread.ctx.Dr6 = 0x1
+    assert dbg._on_debug_event(thread, exception(win32.EXCEPTION_SINGLE_STEP, 0x500001)) == win32.DBG_CONTINUE
+    assert proc.memory[0x500000] == b"\xCC" and dbg.ss_hook is None
+    assert calls[2:] == [("int3", 1, 2), ("watch", 5)] and not dbg.stats.errors
+
+
+def test_stats():
+    stats = DebuggerStats()
+    stats._queued()
+    stats._queued()
+    stats._done(print, 0.25)
+    stats._queued()
+    stats._done(print, 0.75)
+    stats._failed(print, ValueError())
+    stats._done(len, 0.5)
+    assert (stats.hits, stats.pending, stats.max_pending, stats.errors) == (3, 0, 2, 1)
+    assert stats.hooks == {print: [2, 1.0, 0.75], len: [1, 0.5, 0.5]}
+    assert stats.latency(print) == 0.5 and stats.latency(input) == 0.0
+    assert stats.last_error[0] is print and isinstance(stats.last_error[1], ValueError)
+    assert repr(stats) == "<DebuggerStats 0 events, 3 hits, 0 pending, 1 errors>"
+
+
+def test_dispatch(proc):
+    calls = list()
+
+    def fail(value):
+        raise ValueError(value)
+
+    async def later(value):
+        calls.append(value)
+
+    # Without workers the hooks are called before the event is continued.
+    dbg = ProcessDebugger()
+    dbg._dispatch(Hook.stdcall(c_uint32)(calls.append), [1])
+    assert calls == [1]
+    dbg._dispatch(Hook.stdcall(c_uint32)(fail), [2])
+    # A coroutine needs a loop, it is closed without running else.
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        dbg._dispatch(Hook.stdcall(c_uint32)(later), [3])
+    assert calls == [1]
+    assert (dbg.stats.hits, dbg.stats.pending, dbg.stats.errors) == (3, 0, 2)
+    assert dbg.stats.last_error[0] is later and isinstance(dbg.stats.last_error[1], RuntimeError)
+    assert set(dbg.stats.hooks) == {calls.append, fail, later}
+
+    # With workers _dispatch returns at once, stop waits for the hooks left.
+    release = threading.Event()
+    dbg = ProcessDebugger(workers=2)
+    slow = Hook.stdcall(c_uint32)(lambda value: release.wait(5) and calls.append(value))
+    for value in (4, 5, 6):
+        dbg._dispatch(slow, [value])
+    assert dbg.stats.pending == 3 and calls == [1]
+    release.set()
+    dbg.stop()
+    assert sorted(calls) == [1, 4, 5, 6]
+    assert dbg.stats.pending == 0 and dbg.stats.max_pending == 3
+    assert dbg.stats.hooks[slow.callback][0] == 3
+
+
+class FakeDebugApi(object):
+    """The debug events of the process, queued by the test and received by the pump."""
+
+    def __init__(self, proc):
+        self.proc = proc
+        self.events = queue.Queue()
+        self.calls = list()
+        self.refused = False
+
+    def DebugActiveProcess(self, pid):
+        self.calls.append(("attach", pid, threading.current_thread().name))
+        return not self.refused
+
+    def DebugActiveProcessStop(self, pid):
+        self.calls.append(("detach", pid, threading.current_thread().name))
+        return True
+
+    def DebugSetProcessKillOnExit(self, kill):
+        return True
+
+    def WaitForDebugEvent(self, evt, timeout):
+        try:
+            event = self.events.get(timeout=timeout / 1000.0)
+        except queue.Empty:
+            return False
+        memmove(addressof(evt._obj), addressof(event), sizeof(event))
+        return True
+
+    def wait_continued(self, count):
+        deadline = time.monotonic() + 5
+        while len(self.proc.continued) < count and time.monotonic() < deadline:
+            time.sleep(0.005)
+        return self.proc.continued
+
+
+@pytest.fixture
+def api(proc, monkeypatch):
+    api = FakeDebugApi(proc)
+    for name in ("DebugActiveProcess", "DebugActiveProcessStop", "DebugSetProcessKillOnExit", "WaitForDebugEvent"):
+        monkeypatch.setattr(win32, name, getattr(api, name), raising=False)
+    monkeypatch.setattr(win32, "GetLastError", lambda: 5, raising=False)
+    monkeypatch.setattr(win32, "FormatMessage", lambda error: "Access is denied.")
+    return api
+
+
+def test_pump(proc, api):
+    release = threading.Event()
+    seen = list()
+
+    @Hook.stdcall(c_uint32, c_uint32)
+    def on_call(a, b):
+        release.wait(5)
+        seen.append(("call", a, b))
+
+    @Hook.stdcall(c_uint32, c_uint32)
+    async def on_async(a, b):
+        seen.append(("async", a, b, threading.current_thread() is threading.main_thread()))
+
+    async def main():
+        dbg = ProcessDebugger(workers=2)
+        dbg.start(proc)
+        try:
+            assert api.calls == [("attach", PID, "ProcessDebugger")]
+            proc.values = {0x401000: b"\x8B", 0x402000: b"\x8B", 0x8104: (1, 2), 0x8204: (3, 4)}
+            dbg.add_hook(0x401000, on_call)
+            dbg.add_hook(0x402000, on_async)
+            for event in (
+                debug_event(win32.CREATE_PROCESS_DEBUG_EVENT, 1),
+                debug_event(win32.CREATE_THREAD_DEBUG_EVENT, 2),
+                debug_event(win32.EXCEPTION_DEBUG_EVENT, 1, ExceptionCode=win32.EXCEPTION_BREAKPOINT, ExceptionAddress=0x401000),
+                debug_event(win32.EXCEPTION_DEBUG_EVENT, 1, ExceptionCode=win32.EXCEPTION_SINGLE_STEP, ExceptionAddress=0x401000),
+                debug_event(win32.EXCEPTION_DEBUG_EVENT, 2, ExceptionCode=win32.EXCEPTION_BREAKPOINT, ExceptionAddress=0x402000),
+                debug_event(win32.EXCEPTION_DEBUG_EVENT, 2, ExceptionCode=win32.EXCEPTION_SINGLE_STEP, ExceptionAddress=0x402000),
+                debug_event(win32.EXCEPTION_DEBUG_EVENT, 3, pid=8),
+                debug_event(win32.EXIT_THREAD_DEBUG_EVENT, 2),
+            ):
+                api.events.put(event)
+
+            # Every event is continued while the first hook still runs on a worker.
+            continued = await asyncio.get_running_loop().run_in_executor(None, api.wait_continued, 8)
+            assert [(pid, tid) for pid, tid, _ in continued] == [(PID, id) for id in (1, 2, 1, 1, 2, 2)] + [(8, 3), (PID, 2)]
+            assert [status for _, _, status in continued].count(win32.DBG_CONTINUE) == 7
+            assert dbg.stats.events == 8 and dbg.stats.pending >= 1
+            assert proc.memory[0x401000] == proc.memory[0x402000] == b"\xCC"
+            # The coroutine runs on the loop given to start.
+            while not seen:
+                await asyncio.sleep(0.005)
+            assert seen == [("async", 3, 4, True)]
+        finally:
+            release.set()
+            dbg.stop()
+        return dbg
+
+    dbg = asyncio.run(main())
+    assert seen[1] == ("call", 1, 2)
+    assert dbg.stats.pending == 0 and dbg.stats.hits == 2 and not dbg.stats.errors
+    # The handles of the events are kept, no thread is opened again.
+    assert proc.opened == [(1, 0x1041), (2, 0x1042)]
+    assert [thread.id for thread in proc.thread_registry] == [1]
+    # The pump detaches, the code of the hooks is restored.
+    assert api.calls[-1] == ("detach", PID, "ProcessDebugger") and not dbg.attached
+    assert proc.memory[0x401000] == proc.memory[0x402000] == b"\x8B"
+
+
+def test_pump_restart(proc, api):
+    calls = list()
+    dbg = ProcessDebugger(workers=1)
+    api.refused = True
+    with pytest.raises(win32.Win32Exception):
+        dbg.start(proc)
+    api.refused = False
+
+    # The pump stops with the process, stop recreates the pool on the next start.
+    for run in (1, 2):
+        dbg.start(proc)
+        try:
+            proc.values = {0x401000: b"\x8B", 0x8104: run}
+            dbg.add_hook(0x401000, Hook.stdcall(c_uint32)(lambda value: calls.append((value, threading.current_thread().name))))
+            api.events.put(debug_event(win32.CREATE_PROCESS_DEBUG_EVENT, 1))
+            api.events.put(debug_event(win32.EXCEPTION_DEBUG_EVENT, 1, ExceptionCode=win32.EXCEPTION_BREAKPOINT, ExceptionAddress=0x401000))
+            api.events.put(debug_event(win32.EXIT_PROCESS_DEBUG_EVENT, 1))
+            dbg._pump.join(5)
+            assert not dbg.attached and dbg.exit_code == 0
+        finally:
+            dbg.stop()
+        proc.thread_registry.clear()
+    assert [value for value, _ in calls] == [1, 2]
+    assert all(name.startswith("ThreadPoolExecutor") for _, name in calls)
+    assert dbg.stats.events == 6 and dbg.stats.hits == 2
@@ -0,0 +1,121 @@
+from memlib import win32
+from memlib.debugger import Hook
+from memlib.detour import InlineHook
+from memlib.thread import ThreadRegistry
+
+import struct
+
+ADDR = 0x401000
+STUB = 0x500000
+LOG_CODE = b"\x90" * 8
+
+# push ebp; mov ebp, esp; sub esp, 0x20; push ebx, the same in 32 and 64 bits.
+PROLOGUE = bytes.fromhex("55 89 E5 83 EC 20 53") + b"\xCC" * 25
+
+
+class FakeThread(object):
+    """A suspended thread of which only the instruction pointer is known."""
+
+    def __init__(self, id, ip, events):
+        self.id = id
+        self.ip = ip
+        self.events = events
+
+    def suspend(self):
+        self.events.append(("suspend", self.id))
+
+    def resume(self):
+        self.events.append(("resume", self.id))
+
+    def context(self, flags, reuse=False):
+        assert flags == win32.CONTEXT_CONTROL
+        if self.ip is None:
+            raise win32.Win32Exception(5, "Access is denied.")
+        context = win32.CONTEXT64() if win32.PROCESS_IS_64_BITS else win32.CONTEXT()
+        context.Rip = self.ip if win32.PROCESS_IS_64_BITS else 0
+        context.Eip = 0 if win32.PROCESS_IS_64_BITS else self.ip
+        return context
+
+    def set_context(self, context):
+        self.ip = context.Rip if win32.PROCESS_IS_64_BITS else context.Eip
+        self.events.append(("move", self.id))
+
+
+class FakeRegistry(ThreadRegistry):
+
+    def __init__(self, process, threads):
+        super(FakeRegistry, self).__init__(process)
+        self._threads = {thread.id: thread for thread in threads}
+
+    def refresh(self):
+        return list(self)
+
+
+class FakeProcess(object):
+    id = 1
+
+    def __init__(self):
+        self.events = list()
+        self.memory = dict()
+        self.thread_registry = None
+
+    def read(self, addr, fmt):
+        return PROLOGUE
+
+    def write(self, addr, data):
+        self.memory[addr] = data
+        self.events.append(("write", addr))
+
+    def flush(self, addr, size):
+        self.events.append(("flush", addr))
+
+
+class FakeHooker(object):
+
+    def __init__(self, proc):
+        self.proc = proc
+        self.x64 = win32.PROCESS_IS_64_BITS
+
+    def _log_code(self, hook, id):
+        return LOG_CODE, []
+
+    def _allocate(self, size, near):
+        return STUB
+
+
+def test_enable_moves_threads():
+    proc = FakeProcess()
+    hook = InlineHook(FakeHooker(proc), ADDR, Hook.stdcall()(lambda: None), 0)
+    moved = STUB + len(LOG_CODE)
+    assert hook.patch == b"\xE9" + struct.pack("<i", STUB - ADDR - 5) + b"\x90"
+    assert proc.memory[STUB][len(LOG_CODE):len(LOG_CODE) + 6] == PROLOGUE[:6]
+
+    events = proc.events = list()
+    threads = [
+        FakeThread(1, ADDR, events),            # runs the jmp
+        FakeThread(2, ADDR + 1, events),        # inside the replaced instructions
+        FakeThread(3, ADDR + 3, events),
+        FakeThread(4, ADDR + 6, events),        # past them
+        FakeThread(5, 0x7FF00000, events),
+        FakeThread(6, None, events),            # exited
+    ]
+    proc.thread_registry = FakeRegistry(proc, threads)
+    hook.enable()
+    assert [thread.ip for thread in threads[:5]] == [ADDR, moved + 1, moved + 3, ADDR + 6, 0x7FF00000]
+    assert proc.memory[ADDR] == hook.patch
+    # The prologue is written and flushed while every thread is suspended.
+    assert events == (
+        [("suspend", i) for i in range(1, 7)] +
+        [("move", 2), ("move", 3), ("write", ADDR), ("flush", ADDR)] +
+        [("resume", i) for i in range(1, 7)]
+    )
+
+    del events[:]
+    hook.disable()
+    assert proc.memory[ADDR] == PROLOGUE[:6]
+    assert [thread.ip for thread in threads[:5]] == [ADDR, moved + 1, moved + 3, ADDR + 6, 0x7FF00000]
+    assert events == (
+        [("suspend", i) for i in range(1, 7)] +
+        [("write", ADDR), ("flush", ADDR)] +
+        [("resume", i) for i in range(1, 7)]
+    )
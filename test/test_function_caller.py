@@ -0,0 +1,487 @@
+from memlib import win32, x86
+from memlib.function_caller import CallBuffer, CallStub, ProcessCaller, _struct_code
+
+import asyncio
+import ctypes
+import mmap
+import os
+import platform
+import shutil
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+
+@pytest.mark.parametrize("argtype, code", [
+    (ctypes.c_int8, "b"),
+    (ctypes.c_uint16, "H"),
+    (ctypes.c_int32, "i"),
+    (ctypes.c_long, "q" if ctypes.sizeof(ctypes.c_long) == 8 else "i"),
+    (ctypes.c_uint64, "Q"),
+    (ctypes.c_void_p, "Q" if ctypes.sizeof(ctypes.c_void_p) == 8 else "I"),
+    (ctypes.c_float, "f"),
+    (ctypes.c_double, "d"),
+    (ctypes.c_bool, "?"),
+    (ctypes.c_char_p, None),
+    (ctypes.c_int32 * 2, None),
+])
+def test_struct_code(argtype, code):
+    assert _struct_code(argtype) == code
+
+
+def test_frame_layout():
+    stub = CallStub("x64", 0x1000, [ctypes.c_int64, ctypes.c_int32, CallBuffer, ctypes.c_double, ctypes.c_int32 * 2])
+    assert stub.struct.format == "<qixxxxQd8s"
+    assert stub.struct.size == 40
+
+    # A double takes 2 slots on x86, the frame has room for a double result.
+    assert CallStub("stdcall", 0x1000, [ctypes.c_int32, ctypes.c_double]).struct.format == "<id"
+    assert CallStub("stdcall", 0x1000, [ctypes.c_int8]).struct.format == "<bxxxxxxx"
+
+    with pytest.raises(TypeError):
+        CallStub("x64", 0x1000, [ctypes.c_int32 * 4])
+    with pytest.raises(ValueError):
+        CallStub("thiscall", 0x1000, [])
+
+
+def test_prepare():
+    stub = CallStub("x64", 0x1000, [ctypes.c_int32, CallBuffer, CallBuffer])
+    out = CallBuffer(bytes(5))
+    values, buffers, size = stub.prepare([1, out, [b"ab", b"c"]])
+    assert values == [1, 0, 0]
+    # Only the CallBuffer's are read back, the data is 8 bytes aligned after the frame.
+    assert buffers == [(1, out, bytes(5)), (2, None, b"abc")]
+    assert size == stub.struct.size + 16
+
+    with pytest.raises(TypeError):
+        stub.prepare([1])
+
+    class Point(ctypes.Structure):
+        _fields_ = [("x", ctypes.c_int16), ("y", ctypes.c_int16)]
+
+    # Structures and arrays are passed by value, from an instance or a tuple.
+    stub = CallStub("x64", 0x1000, [Point, ctypes.c_int16 * 2])
+    assert stub.prepare([Point(1, 2), (3, 4)])[0] == [b"\x01\x00\x02\x00", b"\x03\x00\x04\x00"]
+    assert stub.prepare([(1, 2), (ctypes.c_int16 * 2)(3, 4)])[0] == [b"\x01\x00\x02\x00", b"\x03\x00\x04\x00"]
+    # Without call buffers nor conversions, the arguments are packed as they are.
+    stub = CallStub("x64", 0x1000, [ctypes.c_int32])
+    assert stub.prepare((1,)) == ((1,), (), stub.struct.size)
+    assert stub.coerce([2 ** 32 + 5]) == [5]
+
+
+def test_decode():
+    buffer = struct.pack("<IQd", 0xFFFFFFFF, 0xFFFFFFFFFFFFFFFE, 1.5)
+    assert CallStub("stdcall", 0x1000, [], ctypes.c_int32).decode(buffer, 0) == -1
+    assert CallStub("stdcall", 0x1000, []).decode(buffer, 0) == 0xFFFFFFFF
+    assert CallStub("x64", 0x1000, [], ctypes.c_int64).decode(buffer, 4) == -2
+    assert CallStub("x64", 0x1000, [], ctypes.c_double).decode(buffer, 12) == 1.5
+    stub = CallStub("stdcall", 0x1000, [], ctypes.c_double)
+    assert stub.result_in_frame and stub.decode(buffer, 12) == 1.5
+
+
+def instructions(code, x64):
+    offset = 0
+    decoded = list()
+    while offset < len(code):
+        insn = x86.decode(code, offset, 0x1000 + offset, x64)
+        decoded.append(code[offset:offset + insn.length])
+        offset += insn.length
+    assert offset == len(code)
+    return decoded
+
+
+@pytest.mark.parametrize("code, x64", [
+    (ProcessCaller._worker_x86_code, False),
+    (ProcessCaller._worker_x64_code, True),
+    (ProcessCaller._batch_x86_code, False),
+    (ProcessCaller._batch_x64_code, True),
+])
+def test_worker_code(code, x64):
+    assert instructions(code, x64)[-1] in (b"\xC3", b"\xC2\x04\x00")
+
+
+def test_x86_stubs():
+    argtypes = [ctypes.c_int32, ctypes.c_double, ctypes.c_int32, ctypes.c_int32]
+    # The double (offset 4) is pushed as two dwords, the last argument first.
+    stub = CallStub("stdcall", 0x401000, argtypes, ctypes.c_float)
+    code = instructions(stub.code, False)
+    assert code[4:9] == [b"\xFF\xB6" + struct.pack("<i", offset) for offset in (16, 12, 8, 4, 0)]
+    assert code[9:11] == [b"\xB8\x00\x10\x40\x00", b"\xFF\xD0"]
+    assert code[-3:] == [b"\x5E", b"\x5D", b"\xC2\x04\x00"]
+
+    # fastcall passes the first two dword arguments in ecx and edx.
+    stub = CallStub("fastcall", 0x401000, argtypes)
+    code = instructions(stub.code, False)
+    assert code[4:9] == [b"\xFF\xB6" + struct.pack("<i", offset) for offset in (16, 8, 4)] + [
+        b"\x8B\x8E" + struct.pack("<i", 0), b"\x8B\x96" + struct.pack("<i", 12)]
+
+
+# Functions of the Microsoft x64 convention run by the worker of a caller in
+# this process, WaitForSingleObject and SetEvent are stood in by polling.
+LIBRARY = r"""
+#include <stdint.h>
+#include <unistd.h>
+
+#define MS __attribute__((ms_abi))
+
+MS uint32_t wait_event(void *event, uint32_t ms) { usleep(20); return 0; }
+MS int32_t set_event(void *event) { return 1; }
+
+MS int64_t sum6(int64_t a, int32_t b, int64_t c, int64_t d, int64_t e, int8_t f)
+{
+    return a + 10 * b + 100 * c + 1000 * d + 10000 * e + 100000 * f;
+}
+
+MS double mix(double x, int64_t n, float y, double z) { return x * n + y - z; }
+MS float half(float x) { return x / 2; }
+
+struct point { int16_t x, y; };
+MS int32_t manhattan(struct point p, struct point q) { return (q.x - p.x) + (q.y - p.y); }
+
+MS int32_t fill(char *buffer, int32_t size, int32_t seed)
+{
+    for (int32_t i = 0; i < size; i++)
+        buffer[i] = (char)(seed + i);
+    return size;
+}
+
+MS int32_t fill2(char *first, char *second, int32_t size)
+{
+    for (int32_t i = 0; i < size; i++) {
+        first[i] = (char)('a' + i);
+        second[i] = (char)('A' + i);
+    }
+    return 2 * size;
+}
+
+MS uint64_t block(volatile int32_t *flag)
+{
+    while (!__atomic_load_n(flag, __ATOMIC_ACQUIRE))
+        usleep(100);
+    return 7;
+}
+"""
+
+
+def executable(size):
+    memory = mmap.mmap(-1, size, prot=mmap.PROT_READ | mmap.PROT_WRITE | mmap.PROT_EXEC)
+    return memory, ctypes.addressof(ctypes.c_char.from_buffer(memory))
+
+
+class LocalThread(object):
+    """Runs code of the Microsoft x64 convention in a thread, through a System V thunk."""
+
+    def __init__(self, process, entry, param):
+        # mov rcx, rdi; mov rax, entry; jmp rax
+        thunk = process.mmap(16)
+        process.write(thunk, b"\x48\x89\xF9\x48\xB8" + struct.pack("<Q", entry) + b"\xFF\xE0")
+        function = ctypes.CFUNCTYPE(ctypes.c_uint64, ctypes.c_uint64)(thunk)
+        self.thread = threading.Thread(target=function, args=(param,), daemon=True)
+
+    def resume(self):
+        self.thread.start()
+
+    @property
+    def alive(self):
+        return self.thread.is_alive()
+
+    def join(self, timeout):
+        self.thread.join(timeout / 1000)
+
+
+class LocalMemory(object):
+
+    def __init__(self, process, size):
+        self.memory, self.base_remote = executable(size)
+        self.data = (ctypes.c_ubyte * size).from_address(self.base_remote)
+        self.view = memoryview(self.data).cast("B")
+
+    def cast(self, ctype, offset=0):
+        return ctype.from_buffer(self.data, offset)
+
+
+class LocalModule(object):
+
+    def __init__(self, exports):
+        self.exports = exports
+
+    def get_proc_address(self, name):
+        return self.exports[name]
+
+
+class LocalProcess(object):
+    """The parts of Process a ProcessCaller uses, over this process."""
+
+    def __init__(self, library):
+        self.id = os.getpid()
+        self.handle = None
+        self.maps = list()
+        self.kernel32 = LocalModule({
+            "WaitForSingleObject": address(library.wait_event),
+            "SetEvent": address(library.set_event),
+        })
+
+    def mmap(self, size):
+        memory, addr = executable(size)
+        self.maps.append(memory)
+        return addr
+
+    def unmap(self, addr):
+        pass
+
+    def write(self, addr, data):
+        ctypes.memmove(addr, data, len(data))
+
+    def mapshared(self, size):
+        return LocalMemory(self, size)
+
+    def module(self, name):
+        assert name == "kernel32.dll"
+        return self.kernel32
+
+    def spawn_thread(self, entry, param=None):
+        return LocalThread(self, entry, param)
+
+
+def address(function):
+    return ctypes.cast(function, ctypes.c_void_p).value
+
+
+class LocalCaller(ProcessCaller):
+    """Stops its worker in close(), while the Win32 functions are still stood in."""
+
+    def close(self):
+        ProcessCaller.__del__(self)
+
+    def __del__(self):
+        pass
+
+
+def duplicate_handle(source_process, source, target_process, target, access, inherit, options):
+    if target is not None:
+        target._obj.value = source
+    return True
+
+
+@pytest.fixture(scope="module")
+def library(tmp_path_factory):
+    if not sys.platform.startswith("linux") or platform.machine() != "x86_64" or shutil.which("gcc") is None:
+        pytest.skip("Runs the x64 worker natively, needs gcc on Linux x86-64.")
+    path = tmp_path_factory.mktemp("caller")
+    source = path / "functions.c"
+    source.write_text(LIBRARY)
+    binary = path / "functions.so"
+    subprocess.check_call(["gcc", "-O2", "-shared", "-fPIC", "-o", str(binary), str(source)])
+    return ctypes.CDLL(str(binary))
+
+
+@pytest.fixture
+def caller(library, monkeypatch):
+    monkeypatch.setattr(win32, "PROCESS_IS_64_BITS", True)
+    monkeypatch.setattr(win32, "CreateEventW", lambda *args: 1, raising=False)
+    monkeypatch.setattr(win32, "DuplicateHandle", duplicate_handle, raising=False)
+    monkeypatch.setattr(win32, "GetCurrentProcess", lambda: None, raising=False)
+    monkeypatch.setattr(win32, "CloseHandle", lambda handle: True, raising=False)
+    monkeypatch.setattr(win32, "SetEvent", lambda event: True, raising=False)
+    monkeypatch.setattr(win32, "WaitForSingleObject", lambda handle, ms: time.sleep(ms / 10000), raising=False)
+
+    def create(stack_size=0x100000):
+        created = LocalCaller(LocalProcess(library), stack_size)
+        callers.append(created)
+        return created
+
+    callers = list()
+    yield create
+    for created in callers:
+        created.close()
+
+
+def test_call(caller, library):
+    caller = caller()
+    sum6 = caller.x64call(address(library.sum6), ctypes.c_int64, ctypes.c_int32,
+        ctypes.c_int64, ctypes.c_int64, ctypes.c_int64, ctypes.c_int8, restype=ctypes.c_int64)
+    assert sum6(1, 2, 3, 4, 5, 6).result(timeout=5) == 654321
+    assert sum6(-1, -2, 0, 0, 0, 0).result(timeout=5) == -21
+
+    mix = caller.x64call(address(library.mix), ctypes.c_double, ctypes.c_int64,
+        ctypes.c_float, ctypes.c_double, restype=ctypes.c_double)
+    assert mix(1.5, 4, 0.25, 2.0).result(timeout=5) == 4.25
+    half = caller.x64call(address(library.half), ctypes.c_float, restype=ctypes.c_float)
+    assert half(3.0).result(timeout=5) == 1.5
+
+    class Point(ctypes.Structure):
+        _fields_ = [("x", ctypes.c_int16), ("y", ctypes.c_int16)]
+
+    manhattan = caller.x64call(address(library.manhattan), Point, Point, restype=ctypes.c_int32)
+    assert manhattan(Point(1, 2), (4, 8)).result(timeout=5) == 9
+
+    fill = caller.x64call(address(library.fill), CallBuffer, ctypes.c_int32, ctypes.c_int32, restype=ctypes.c_int32)
+    out = CallBuffer(bytes(10))
+    assert fill(out, 10, 0x30).result(timeout=5) == 10
+    assert out.data == b"0123456789"
+
+    # The stub of a signature is compiled once.
+    stubs = len(caller._stubs)
+    caller.x64call(address(library.half), ctypes.c_float, restype=ctypes.c_float)
+    assert len(caller._stubs) == stubs
+    assert asyncio.run(half_async(half)) == 2.0
+
+
+async def half_async(half):
+    return await half(4.0)
+
+
+def test_batch(caller, library):
+    caller = caller(0x2000)
+    fill = caller.x64call(address(library.fill), CallBuffer, ctypes.c_int32, ctypes.c_int32, restype=ctypes.c_int32)
+    buffers = [CallBuffer(bytes(20)) for _ in range(200)]
+    with caller.batch() as batch:
+        futures = [fill(out, 20, i) for i, out in enumerate(buffers)]
+        assert repr(futures[0]) == "<CallFuture queued>"
+    # The calls don't fit in one call list of a quarter of the frame pool.
+    assert batch.results() == [20] * 200
+    assert [out.data for out in buffers] == [bytes((i + j) & 0xFF for j in range(20)) for i in range(200)]
+
+
+def test_concurrent_calls(caller, library):
+    # 64 blocks of frame pool and 64 slots for 8 threads, the posts wait for the calls to complete.
+    caller = caller(0x2000)
+    fill = caller.x64call(address(library.fill), CallBuffer, ctypes.c_int32, ctypes.c_int32, restype=ctypes.c_int32)
+    errors = list()
+
+    def run(thread):
+        try:
+            pending = list()
+            for i in range(300):
+                out = CallBuffer(bytes(100))
+                pending.append((fill(out, 100, thread + i), out, thread + i))
+                if len(pending) > 20:
+                    future, out, seed = pending.pop(0)
+                    assert future.result(timeout=10) == 100
+                    assert out.data == bytes((seed + j) & 0xFF for j in range(100))
+            for future, out, seed in pending:
+                assert future.result(timeout=10) == 100
+                assert out.data == bytes((seed + j) & 0xFF for j in range(100))
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+    assert errors == []
+    assert not any(caller._blocks)
+
+
+def test_full_ring_waits_without_lock(caller, library):
+    caller = caller()
+    flag = ctypes.c_int32(0)
+    block = caller.x64call(address(library.block), ctypes.c_void_p, restype=ctypes.c_uint64)
+    half = caller.x64call(address(library.half), ctypes.c_float, restype=ctypes.c_float)
+
+    # The worker is stuck in the first call, the ring fills up.
+    futures = [block(ctypes.addressof(flag))]
+    futures += [half(float(i)) for i in range(1, ProcessCaller._RING_SIZE)]
+    poster = threading.Thread(target=lambda: futures.append(half(128.0)))
+    poster.start()
+    poster.join(0.2)
+    assert poster.is_alive()
+    assert caller._lock.acquire(timeout=1)
+    caller._lock.release()
+
+    flag.value = 1
+    poster.join(10)
+    assert not poster.is_alive()
+    assert [future.result(timeout=5) for future in futures] == [7] + [i / 2 for i in range(1, ProcessCaller._RING_SIZE)] + [64.0]
+
+
+def test_call_future(caller, library):
+    caller = caller()
+    flag = ctypes.c_int32(0)
+    block = caller.x64call(address(library.block), ctypes.c_void_p, restype=ctypes.c_uint64)
+    half = caller.x64call(address(library.half), ctypes.c_float, restype=ctypes.c_float)
+
+    future = block(ctypes.addressof(flag))
+    queued = half(8.0)
+    assert repr(future) == "<CallFuture pending>" and not future.done()
+    with pytest.raises(TimeoutError):
+        future.result(timeout=0.05)
+    # A timeout leaves the call running, its result can still be waited for.
+    assert not queued.done()
+    flag.value = 1
+    assert future.result(timeout=5) == 7
+    assert queued.result(timeout=5) == 4.0
+    assert repr(future) == "<CallFuture done>" and future.done()
+    assert future.result(timeout=0) == 7
+
+    async def gather():
+        # The awaits of several coroutines wait for their calls concurrently.
+        return await asyncio.gather(*[half(float(i)) for i in range(32)])
+
+    assert asyncio.run(gather()) == [i / 2 for i in range(32)]
+    assert not any(caller._blocks)
+
+
+def test_batch_context(caller, library):
+    caller = caller()
+    half = caller.x64call(address(library.half), ctypes.c_float, restype=ctypes.c_float)
+
+    with caller.batch() as batch:
+        first = half(2.0)
+        with pytest.raises(RuntimeError):
+            first.result(timeout=1)
+        # Calls from other threads aren't part of the batch.
+        other = list()
+        thread = threading.Thread(target=lambda: other.append(half(6.0).result(timeout=5)))
+        thread.start()
+        thread.join(10)
+        assert other == [3.0]
+        with caller.batch() as inner:
+            second = half(4.0)
+        assert inner.results(timeout=5) == [2.0]
+        batch.flush()
+        assert repr(batch) == "<CallBatch 0 queued, 1 posted>"
+        third = half(8.0)
+        assert repr(batch) == "<CallBatch 1 queued, 1 posted>"
+    assert getattr(caller._batches, "current", None) is None
+    assert batch.results(timeout=5) == [1.0, 4.0]
+    assert (first.result(), second.result(), third.result()) == (1.0, 2.0, 4.0)
+
+    # The calls of a block which raised are dropped.
+    with pytest.raises(ValueError):
+        with caller.batch() as dropped:
+            half(10.0)
+            raise ValueError()
+    assert repr(dropped) == "<CallBatch 0 queued, 0 posted>"
+    assert half(12.0).result(timeout=5) == 6.0
+
+
+def test_call_frames(caller, library):
+    caller = caller(0x2000)
+    fill2 = caller.x64call(address(library.fill2), CallBuffer, CallBuffer, ctypes.c_int32, restype=ctypes.c_int32)
+
+    # The buffers of a call get their own space in its frame.
+    first, second = CallBuffer(bytes(16)), CallBuffer(bytes(16))
+    assert fill2(first, second, 16).result(timeout=5) == 32
+    assert first.data == bytes(range(ord("a"), ord("a") + 16))
+    assert second.data == bytes(range(ord("A"), ord("A") + 16))
+    assert not any(caller._blocks)
+
+    async def task(i):
+        a, b = CallBuffer(bytes(i + 1)), CallBuffer(bytes(i + 1))
+        assert await fill2(a, b, i + 1) == 2 * (i + 1)
+        return a.data, b.data
+
+    async def tasks():
+        return await asyncio.gather(*[task(i) for i in range(100)])
+
+    # More calls in flight than ring slots, from asyncio tasks.
+    for i, (a, b) in enumerate(asyncio.run(tasks())):
+        assert a == bytes(range(ord("a"), ord("a") + i + 1))
+        assert b == bytes(range(ord("A"), ord("A") + i + 1))
+    assert not any(caller._blocks)
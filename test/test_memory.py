@@ -0,0 +1,117 @@
+from memlib import win32
+from memlib.memory import SharedMemBuffer
+
+import ctypes
+
+import pytest
+
+
+class FakeWin32(object):
+    """Maps the buffers in a local array and records the unmapping calls."""
+
+    REMOTE = 0x70000000
+
+    def __init__(self):
+        self.memory = list()
+        self.calls = list()
+
+    def CreateFileMappingW(self, file, attributes, protect, size_high, size_low, name):
+        return 0x44
+
+    def MapViewOfFile(self, handle, access, offset_high, offset_low, size):
+        self.memory.append(ctypes.create_string_buffer(0x1000))
+        return ctypes.addressof(self.memory[-1])
+
+    def NtMapViewOfSection(self, handle, process, base, *args):
+        base._obj.value = FakeWin32.REMOTE
+        return 0
+
+    def NtUnmapViewOfSection(self, process, base):
+        self.calls.append(("remote", base.value))
+        return 0
+
+    def UnmapViewOfFile(self, base):
+        self.calls.append(("local", base.value))
+        return True
+
+    def CloseHandle(self, handle):
+        self.calls.append(("close", handle))
+        return True
+
+    def GetLastError(self):
+        return 0
+
+
+class FakeProcess(object):
+    handle = 0x88
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    fake = FakeWin32()
+    monkeypatch.setattr(win32, "kernel32", fake)
+    monkeypatch.setattr(win32, "ntdll", fake)
+    return fake
+
+
+def unmapped(fake, mem):
+    return fake.calls == [("remote", FakeWin32.REMOTE), ("local", mem.base_local), ("close", 0x44)]
+
+
+def test_access(fake):
+    mem = SharedMemBuffer(FakeProcess(), 0x1000)
+    mem.pack_into("II", 0x10, 1, 2)
+    assert mem.unpack_from("II", 0x10) == (1, 2)
+    assert mem.cast(ctypes.c_uint32, 0x14).value == 2
+    assert bytes(mem[0x10:0x14]) == b"\x01\x00\x00\x00"
+    assert mem.remote(0x10) == FakeWin32.REMOTE + 0x10
+    # data and view are the buffers to hand to other functions, not the object itself.
+    assert memoryview(mem.data).nbytes == memoryview(mem.view).nbytes == 0x1000
+    assert bytes(mem.view[0x10:0x14]) == b"\x01\x00\x00\x00"
+    with pytest.raises(TypeError):
+        memoryview(mem)
+
+
+def test_close(fake):
+    mem = SharedMemBuffer(FakeProcess(), 0x1000)
+    local = mem.base_local
+    mem.close()
+    assert unmapped(fake, mem) and mem.base_local == local
+    mem.close()
+    assert len(fake.calls) == 3
+
+
+def test_close_with_views(fake):
+    mem = SharedMemBuffer(FakeProcess(), 0x1000)
+    value = mem.cast(ctypes.c_uint32, 8)
+    view = memoryview(mem.view)
+    mem.close()
+    # The views still look at the memory, it is unmapped with the last one.
+    assert fake.calls == []
+    value.value = 5
+    del value
+    assert fake.calls == []
+    assert view[8] == 5
+    view.release()
+    del view
+    assert unmapped(fake, mem)
+
+
+def test_del(fake):
+    mem = SharedMemBuffer(FakeProcess(), 0x1000)
+    expected = [("remote", FakeWin32.REMOTE), ("local", mem.base_local), ("close", 0x44)]
+    del mem
+    assert fake.calls == expected
+
+
+def test_array(fake):
+    numpy = pytest.importorskip("numpy")
+    mem = SharedMemBuffer(FakeProcess(), 0x1000)
+    counters = mem.array("u4", 0x100, 4)
+    counters[:] = numpy.arange(4)
+    assert mem.unpack_from("4I", 0x100) == (0, 1, 2, 3)
+    del mem
+    assert fake.calls == []
+    assert counters.sum() == 6
+    del counters
+    assert len(fake.calls) == 3
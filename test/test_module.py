@@ -0,0 +1,136 @@
+from memlib import module
+from memlib.module import ModuleMap, ProcessModule
+from memlib.pe import PEFormatError
+from memlib.process import ModuleNotFoundError, Process
+
+import pytest
+
+
+class FakePE(object):
+
+    def __init__(self, exports, ordinals=None):
+        self.exports = exports
+        self.ordinals = ordinals or dict()
+
+
+class BrokenPE(object):
+
+    @property
+    def exports(self):
+        raise PEFormatError("No DOS header.")
+
+
+class FakeBackend(object):
+    """Lists the loaded modules and counts the listings."""
+
+    def __init__(self):
+        self.loaded = list()
+        self.listings = 0
+
+    def modules(self, proc):
+        self.listings += 1
+        return list(self.loaded)
+
+
+class FakeProcess(object):
+    id = 1
+    module = Process.module
+
+    def __init__(self):
+        self.backend = FakeBackend()
+        self.module_map = ModuleMap(self)
+
+    def load(self, name, base, size=0x1000, pe=None):
+        module = ProcessModule(base, self)
+        module.name, module.base, module.size = name, base, size
+        module._pe = pe
+        self.backend.loaded.append(module)
+        return module
+
+
+def test_get_proc_address():
+    proc = FakeProcess()
+    game = proc.load("game.exe", 0x400000, pe=FakePE(
+        {"Run": 0x1000, "Sleep": "kernel32.Sleep", "Missing": "kernel32.Missing", "Free": "msvcrt.free"},
+        {1: 0x1000, 2: "KERNEL32.#7"},
+    ))
+    proc.load("kernel32.dll", 0x70000000, pe=FakePE({"Sleep": 0x2000}, {7: 0x3000}))
+    assert game.get_proc_address("Run") == 0x401000
+    assert game.get_proc_address(1) == 0x401000
+    assert game.get_proc_address("Other") is None
+    # Forwarded by name and by ordinal.
+    assert game.get_proc_address("Sleep") == 0x70002000
+    assert game.get_proc_address(2) == 0x70003000
+    assert game.get_proc_address("Missing") is None
+    with pytest.raises(ModuleNotFoundError):
+        game.get_proc_address("Free")
+
+
+def test_get_proc_address_api_set():
+    proc = FakeProcess()
+    kernel32 = proc.load("kernel32.dll", 0x70000000, pe=FakePE({
+        "Sleep": "api-ms-win-core-synch-l1-2-0.Sleep",
+        "WaitOnAddress": "api-ms-win-core-synch-l1-2-0.WaitOnAddress",
+        "strlen": "api-ms-win-crt-string-l1-1-0.strlen",
+        "Ordinal": "api-ms-win-core-synch-l1-2-0.#3",
+        "Missing": "ext-ms-win-missing-l1-1-0.Missing",
+        "Loaded": "api-ms-win-loaded-l1-1-0.Loaded",
+    }))
+    # The hosts forward some exports themselves, only the actual code counts.
+    proc.load("kernelbase.dll", 0x71000000, pe=FakePE({"Sleep": 0x1000, "strlen": "ucrtbase.strlen"}))
+    proc.load("broken.dll", 0x72000000, pe=BrokenPE())
+    proc.load("ucrtbase.dll", 0x73000000, pe=FakePE({"strlen": 0x2000}))
+    proc.load("synch.dll", 0x74000000, pe=FakePE({"WaitOnAddress": 0x3000}))
+    proc.load("api-ms-win-loaded-l1-1-0.dll", 0x75000000, pe=FakePE({"Loaded": 0x4000}))
+
+    assert kernel32.get_proc_address("Sleep") == 0x71001000
+    assert kernel32.get_proc_address("strlen") == 0x73002000
+    # Not in the usual hosts, found in the other modules.
+    assert kernel32.get_proc_address("WaitOnAddress") == 0x74003000
+    # A loaded API set dll is used as is.
+    assert kernel32.get_proc_address("Loaded") == 0x75004000
+    assert kernel32.get_proc_address("Ordinal") is None
+    assert kernel32.get_proc_address("Missing") is None
+
+
+
+def test_module_map(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(module.time, "monotonic", lambda: now[0])
+    proc = FakeProcess()
+    game = proc.load("game.exe", 0x400000, 0x5000)
+    kernel32 = proc.load("kernel32.dll", 0x70000000, 0x10000)
+    ntdll = proc.load("ntdll.dll", 0x10000000, 0x2000)
+    modules = proc.module_map
+
+    # Listed once on first use, sorted by base for module_at.
+    assert modules.main is None and proc.backend.listings == 0
+    assert modules.module_at(0x400000) is game
+    assert modules.module_at(0x404FFF) is game
+    assert modules.module_at(0x10001000) is ntdll
+    assert modules.module_at(0x7000FFFF) is kernel32
+    assert proc.backend.listings == 1
+    assert modules.main is game and len(modules) == 3
+    assert modules.get("KERNEL32.DLL") is kernel32 and "ntdll.dll" in modules
+    assert modules.symbolize(0x70001A2B) == "kernel32.dll+0x1a2b"
+
+    # A miss refreshes the map at most once every refresh_interval seconds.
+    assert modules.module_at(0x405000) is None
+    assert modules.module_at(0x0FFFFFFF) is None
+    assert modules.get("user32.dll") is None
+    assert proc.backend.listings == 1
+    user32 = proc.load("user32.dll", 0x60000000, 0x1000)
+    assert modules.get("user32.dll") is None
+    now[0] += 1.0
+    assert modules.get("user32.dll") is user32
+    assert proc.backend.listings == 2
+    assert modules.symbolize(0x12345) == "0x12345"
+    assert proc.backend.listings == 2
+
+    # invalidate refreshes on the next lookup, even a hit, whatever the interval.
+    proc.backend.loaded.remove(user32)
+    modules.invalidate()
+    assert modules.module_at(0x400000) is game
+    assert proc.backend.listings == 3
+    assert modules.module_at(0x60000000) is None
+    assert [module.name for module in modules] == ["game.exe", "ntdll.dll", "kernel32.dll"]
@@ -0,0 +1,218 @@
+from memlib.pe import PEFormatError, PEImage, PEImport, PETls
+
+import struct
+
+import pytest
+
+BASE = 0x10000000
+
+# rva's of the functions of .text
+ALPHA, BETA, HIDDEN, CALLBACK1, CALLBACK2 = 0x1000, 0x1010, 0x1020, 0x1030, 0x1040
+
+
+class Blob(object):
+    """Data of a section built piece by piece, add() returns the rva of each piece."""
+
+    def __init__(self, rva):
+        self.rva = rva
+        self.data = bytearray()
+
+    def add(self, data, align=8):
+        self.data += bytes(-len(self.data) % align)
+        rva = self.rva + len(self.data)
+        self.data += data
+        return rva
+
+
+def build_rdata(x64):
+    rdata = Blob(0x2000)
+    thunk = "<Q" if x64 else "<I"
+    ordinal_flag = 1 << (63 if x64 else 31)
+
+    # Exports: Alpha, Beta, Gamma forwarded to kernel32.Sleep and ordinal 4 without name.
+    export_dir = rdata.add(bytes(40))
+    forwarder = rdata.add(b"kernel32.Sleep\0")
+    dll_name = rdata.add(b"test.dll\0")
+    names = [rdata.add(name + b"\0") for name in (b"Alpha", b"Beta", b"Gamma")]
+    functions = rdata.add(struct.pack("<4I", ALPHA, BETA, forwarder, HIDDEN))
+    name_table = rdata.add(struct.pack("<3I", *names))
+    name_ordinals = rdata.add(struct.pack("<3H", 0, 1, 2))
+    struct.pack_into("<IIHHIIIIIII", rdata.data, export_dir - rdata.rva,
+        0, 0, 0, 0, dll_name, 1, 4, 3, functions, name_table, name_ordinals)
+    # The forwarder string is inside the export directory.
+    export_size = rdata.rva + len(rdata.data) - export_dir
+
+    # Imports: kernel32.dll!Sleep, kernel32.dll!#5 and user32.dll!MessageBoxA.
+    sleep = rdata.add(b"\x10\x00Sleep\0", 2)
+    message_box = rdata.add(b"\x20\x00MessageBoxA\0", 2)
+    kernel32 = rdata.add(b"KERNEL32.dll\0")
+    user32 = rdata.add(b"USER32.dll\0")
+    kernel32_thunks = struct.pack(thunk, sleep) + struct.pack(thunk, ordinal_flag | 5) + bytes(struct.calcsize(thunk))
+    user32_thunks = struct.pack(thunk, message_box) + bytes(struct.calcsize(thunk))
+    kernel32_lookup = rdata.add(kernel32_thunks)
+    kernel32_iat = rdata.add(kernel32_thunks)
+    user32_lookup = rdata.add(user32_thunks)
+    user32_iat = rdata.add(user32_thunks)
+    import_dir = rdata.add(
+        struct.pack("<5I", kernel32_lookup, 0, 0, kernel32, kernel32_iat) +
+        # Without lookup table, the IAT is read.
+        struct.pack("<5I", 0, 0, 0, user32, user32_iat) +
+        bytes(20)
+    )
+    directories = {
+        0: (export_dir, export_size),
+        1: (import_dir, 60),
+    }
+    imports = [
+        PEImport("kernel32.dll", "Sleep", None, kernel32_iat),
+        PEImport("kernel32.dll", None, 5, kernel32_iat + struct.calcsize(thunk)),
+        PEImport("user32.dll", "MessageBoxA", None, user32_iat),
+    ]
+    return rdata.data, directories, imports
+
+
+def build_data(x64):
+    data = Blob(0x3000)
+    pointer = "<Q" if x64 else "<I"
+    index = data.add(bytes(4))
+    callbacks = data.add(struct.pack("<3" + pointer[1:], BASE + CALLBACK1, BASE + CALLBACK2, 0))
+    template = data.add(b"tls data")
+    tls_dir = data.add(struct.pack("<4" + pointer[1:] + "II",
+        BASE + template, BASE + template + 8, BASE + index, BASE + callbacks, 0, 0))
+    tls = PETls(BASE + template, BASE + template + 8, BASE + index, [BASE + CALLBACK1, BASE + CALLBACK2])
+    return data.data, {9: (tls_dir, 40 if x64 else 24)}, tls
+
+
+def build_pe(x64):
+    """Returns (file, image mapped at BASE, imports, tls) of a dll with exports, imports and TLS."""
+    rdata, directories, imports = build_rdata(x64)
+    data, tls_directory, tls = build_data(x64)
+    directories.update(tls_directory)
+    text = b"\xC3" * 0x50
+    sections = [
+        (b".text", 0x1000, text, 0x60000020),
+        (b".rdata", 0x2000, bytes(rdata), 0x40000040),
+        (b".data", 0x3000, bytes(data), 0xC0000040),
+    ]
+
+    optional_size = 240 if x64 else 224
+    optional = bytearray(optional_size)
+    struct.pack_into("<HBB", optional, 0, 0x20B if x64 else 0x10B, 14, 0)
+    struct.pack_into("<I", optional, 16, ALPHA)
+    if x64:
+        struct.pack_into("<Q", optional, 24, BASE)
+    else:
+        struct.pack_into("<I", optional, 28, BASE)
+    struct.pack_into("<II", optional, 32, 0x1000, 0x200)
+    struct.pack_into("<II", optional, 56, 0x4000, 0x400)
+    struct.pack_into("<H", optional, 68, 2)
+    directory_offset = 112 if x64 else 96
+    struct.pack_into("<I", optional, directory_offset - 4, 16)
+    for index, (rva, size) in directories.items():
+        struct.pack_into("<II", optional, directory_offset + 8 * index, rva, size)
+
+    headers = bytearray(0x400)
+    headers[:2] = b"MZ"
+    struct.pack_into("<I", headers, 0x3C, 0x80)
+    struct.pack_into("<4sHHIIIHH", headers, 0x80, b"PE\0\0", 0x8664 if x64 else 0x14C,
+        len(sections), 0, 0, 0, optional_size, 0x2022)
+    headers[0x98:0x98 + optional_size] = optional
+    table = 0x98 + optional_size
+
+    file = bytearray(headers)
+    image = bytearray(0x4000)
+    for i, (name, rva, content, characteristics) in enumerate(sections):
+        raw_size = len(content) + -len(content) % 0x200
+        struct.pack_into("<8sIIII12xI", file, table + 40 * i,
+            name, len(content), rva, raw_size, len(file), characteristics)
+        file += content + bytes(raw_size - len(content))
+        image[rva:rva + len(content)] = content
+    image[:0x400] = file[:0x400]
+    return bytes(file), bytes(image), imports, tls
+
+
+class FakeProcess(object):
+    """Maps an image at BASE and records the reads."""
+
+    def __init__(self, image):
+        self.image = image
+        self.reads = list()
+
+    def read_into(self, addr, buffer, size):
+        self.reads.append((addr - BASE, size))
+        if not 0 <= addr - BASE <= len(self.image) - size:
+            raise OSError("Unmapped address 0x%x." % addr)
+        buffer[:size] = self.image[addr - BASE:addr - BASE + size]
+
+
+@pytest.fixture(params=[True, False], ids=["x64", "x86"])
+def sample(request, tmp_path):
+    file, image, imports, tls = build_pe(request.param)
+    path = tmp_path / "test.dll"
+    path.write_bytes(file)
+    proc = FakeProcess(image)
+    images = {
+        "file": PEImage.from_file(str(path)),
+        "buffer": PEImage.from_buffer(image),
+        "process": PEImage.from_process(proc, BASE),
+    }
+    yield request.param, images, imports, tls, proc
+    images["file"].close()
+
+
+def test_headers(sample):
+    x64, images, _, _, _ = sample
+    for pe in images.values():
+        assert pe.x64 == x64
+        assert pe.machine == (0x8664 if x64 else 0x14C)
+        assert pe.base == BASE and pe.image_base == BASE
+        assert pe.entry_point == ALPHA
+        assert [section.name for section in pe.sections] == [".text", ".rdata", ".data"]
+        assert pe.section(".data").rva == 0x3000
+        assert pe.section_at(0x2010).name == ".rdata"
+        assert pe.section(".bss") is None
+
+
+def test_exports(sample):
+    _, images, _, _, _ = sample
+    for pe in images.values():
+        assert pe.exports == {"Alpha": ALPHA, "Beta": BETA, "Gamma": "kernel32.Sleep"}
+        # The NONAME export only has an ordinal.
+        assert pe.ordinals == {1: ALPHA, 2: BETA, 3: "kernel32.Sleep", 4: HIDDEN}
+
+
+def test_imports(sample):
+    _, images, imports, _, _ = sample
+    for pe in images.values():
+        assert pe.imports == imports
+        assert pe.import_address("kernel32.DLL", "Sleep") == imports[0].iat
+        assert pe.import_address("kernel32.dll", 5) == imports[1].iat
+        assert pe.import_address("user32.dll", "Sleep") is None
+
+
+def test_tls(sample):
+    _, images, _, tls, _ = sample
+    for pe in images.values():
+        assert pe.tls == tls
+
+
+def test_read(sample):
+    _, images, _, _, _ = sample
+    file, image = images["file"], images["process"]
+    # Crosses the end of the headers and of .text, the end of .data isn't in the file.
+    for rva, size in [(0xFF8, 16), (0x1FF8, 16), (0x3FF0, 16)]:
+        assert image.read(rva, size) == file.read(rva, size)
+        assert len(image.read(rva, size)) == size
+
+
+def test_process_reads_sections_once(sample):
+    _, images, _, _, proc = sample
+    pe = images["process"]
+    pe.exports, pe.imports, pe.tls
+    pe.read(0xFF8, 16)
+    assert sorted(proc.reads) == [(0, 0x1000), (0x1000, 0x1000), (0x2000, 0x1000), (0x3000, 0x1000)]
+
+
+def test_not_pe():
+    with pytest.raises(PEFormatError):
+        PEImage.from_buffer(b"\x7fELF" + bytes(0x200))
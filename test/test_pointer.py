@@ -0,0 +1,115 @@
+from memlib import pointer
+from memlib.linux import LinuxException
+from memlib.pointer import PointerPath, PointerResolver
+
+import errno
+import struct
+
+import pytest
+
+
+class PointerProcess(object):
+    """Maps 8 bytes values at their addresses and records the read_many calls."""
+    id = 1
+
+    def __init__(self, memory):
+        self.memory = memory
+        self.batches = list()
+        self.reads = list()
+
+    def read(self, addr, format):
+        self.reads.append(addr)
+        if addr not in self.memory:
+            raise LinuxException(errno.EFAULT)
+        value = self.memory[addr]
+        if format != "P":
+            return struct.unpack(format, struct.pack("<Q", value)[:struct.calcsize(format)])[0]
+        return value
+
+    def read_many(self, items):
+        self.batches.append([addr for addr, _ in items])
+        if any(addr not in self.memory for addr, _ in items):
+            raise LinuxException(errno.EFAULT)
+        return [self.read(addr, format) for addr, format in items]
+
+
+MEMORY = {
+    0x1000: 0x2000,            # agent array
+    0x2000: 0x3000,
+    0x2054: 0x4000,
+    0x3000: 0,                 # null pointer
+    0x3010: 0x5000,
+    0x4010: 1234,
+    0x5000: 0x9000,            # dangling
+}
+
+
+def test_resolve_many():
+    proc = PointerProcess(dict(MEMORY))
+    resolver = PointerResolver(proc)
+    paths = [
+        PointerPath(0x1000, [0]),
+        PointerPath(0x1000, [0x54, 0x10], "I"),
+        PointerPath(0x1000, [0, 0x10]),
+        PointerPath(0x1000, [0, 0, 8]),
+        PointerPath(0x1000),
+    ]
+    assert resolver.resolve_many(paths) == [0x2000, 1234, 0x3010, None, 0x1000]
+    # The shared prefix 0x1000 is read once, then each distinct pointer of a level.
+    assert proc.batches == [[0x1000], [0x2054, 0x2000], [0x3000], [0x4010]]
+    assert resolver.resolve(PointerPath(0x1000, [0, 0x10, 0])) == 0x5000
+
+
+def test_resolve_dangling():
+    proc = PointerProcess(dict(MEMORY))
+    resolver = PointerResolver(proc)
+    paths = [
+        PointerPath(0x3010, [0, 0, 0]),
+        PointerPath(0x1000, [0x54, 0x10, 0]),
+        PointerPath(0x5000, [0], "I"),
+    ]
+    # The batches with the dangling 0x9000 fail, their pointers are read one by one.
+    assert resolver.resolve_many(paths) == [None, 1234, None]
+    assert proc.batches == [[0x3010, 0x1000, 0x5000], [0x5000, 0x2054], [0x9000, 0x4010], [0x9000]]
+    assert proc.reads[-3:] == [0x9000, 0x4010, 0x9000]
+
+
+def test_resolve_errors():
+    class BrokenProcess(PointerProcess):
+        def read_many(self, items):
+            raise ValueError("not a read failure")
+
+    with pytest.raises(ValueError):
+        PointerResolver(BrokenProcess(MEMORY)).resolve(PointerPath(0x1000, [0]))
+
+
+def test_resolve_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(pointer.time, "monotonic", lambda: now[0])
+    proc = PointerProcess(dict(MEMORY))
+    resolver = PointerResolver(proc, ttl=1.0)
+
+    path = PointerPath(0x1000, [0x54, 0x10])
+    assert resolver.resolve(path) == 0x4010
+    assert resolver.resolve(PointerPath(0x1000, [0x54])) == 0x2054
+    assert len(proc.batches) == 2
+
+    # Within the ttl, a longer path only reads its new level.
+    proc.memory[0x2054] = 0x6000
+    now[0] += 0.5
+    assert resolver.resolve(PointerPath(0x1000, [0x54, 0x10, 0])) == 1234
+    assert proc.batches[2:] == [[0x4010]]
+    assert len(resolver._cache) == 3
+
+    # Past the ttl, the levels are read again.
+    now[0] += 0.6
+    assert resolver.resolve(path) == 0x6010
+    assert proc.batches[3:] == [[0x1000], [0x2054]]
+
+    # The expired entries are dropped, not only refreshed.
+    now[0] += 1.0
+    assert resolver.resolve(PointerPath(0x1000, [0x54])) == 0x2054
+    assert list(resolver._cache) == [(0x1000, (0x54,))]
+
+    resolver.invalidate()
+    assert not resolver._cache
@@ -0,0 +1,145 @@
+from memlib import utils
+from memlib.remote_class import RemoteClass, format_to_dtype
+
+import struct
+
+import pytest
+
+BASE = 0x1000
+
+
+class MemoryBackend(object):
+
+    def __init__(self, memory):
+        self.memory = memory
+        self.reads = 0
+
+    def readv(self, ranges, buffer):
+        self.reads += 1
+        view = memoryview(buffer).cast("B")
+        position = 0
+        for addr, size in ranges:
+            view[position:position + size] = self.memory[addr - BASE:addr - BASE + size]
+            position += size
+
+
+class MemoryProcess(object):
+    """Maps memory at BASE and counts the reads."""
+
+    def __init__(self, memory):
+        self.memory = bytearray(memory)
+        self.backend = MemoryBackend(self.memory)
+
+    def read(self, addr, fmt):
+        self.backend.reads += 1
+        value = utils.get_struct(fmt).unpack_from(self.memory, addr - BASE)
+        return value[0] if len(value) == 1 else value
+
+    def read_into(self, addr, buffer):
+        self.backend.readv([(addr, memoryview(buffer).nbytes)], buffer)
+        return buffer
+
+    def _get_gather_buffer(self, size):
+        return utils.create_buffer(size)
+
+
+class Agent(RemoteClass):
+
+    _vtable = RemoteClass.Field(0x0, "I")
+    id = RemoteClass.Field(0x4, "I")
+    _pad = RemoteClass.Field(0x8, "4s")
+    pos = RemoteClass.Field(0xC, "ff")
+    hp = RemoteClass.Field(0x14, "H", cast=lambda inst, value: value / 100)
+
+
+def agent_memory(count):
+    memory = bytearray()
+    for i in range(count):
+        memory += struct.pack("=II4sffH2x", 0x400000, i + 1, b"pad!", i, -i, 5000 + i)
+    return memory
+
+
+def test_snapshot():
+    proc = MemoryProcess(agent_memory(3))
+    agent = Agent(proc, BASE + 0x18)
+    assert Agent.layout_size == 0x16
+
+    snapshot = agent.snapshot()
+    assert proc.backend.reads == 1
+    # Fields starting with an underscore keep their names.
+    assert snapshot._fields == ("_vtable", "id", "_pad", "pos", "hp")
+    assert snapshot == (0x400000, 2, b"pad!", (1.0, -1.0), 50.01)
+    assert (snapshot._vtable, snapshot.id, snapshot._pad, snapshot.pos) == (0x400000, 2, b"pad!", (1.0, -1.0))
+    assert snapshot._asdict()["hp"] == 50.01
+    assert repr(snapshot).startswith("AgentSnapshot(_vtable=4194304, id=2,")
+    assert agent.id == 2 and agent.hp == 50.01
+
+    snapshots = Agent.snapshot_all(proc, [BASE, BASE + 0x30, BASE + 0x18])
+    assert [snapshot.id for snapshot in snapshots] == [1, 3, 2]
+
+
+def test_slots():
+    proc = MemoryProcess(agent_memory(1))
+    agent = Agent(proc, BASE)
+    assert not hasattr(agent, "__dict__")
+    with pytest.raises(AttributeError):
+        agent.name = "agent"
+
+    class NamedAgent(Agent):
+        __slots__ = ("name",)
+
+    class LooseAgent(Agent):
+        __slots__ = ("__dict__",)
+
+    agent = NamedAgent(proc, BASE)
+    agent.name = "agent"
+    assert agent.name == "agent" and agent.id == 1
+    agent = LooseAgent(proc, BASE)
+    agent.anything = 1
+    assert agent.anything == 1 and agent.snapshot().id == 1
+
+    # A slot would hide the field of the same name.
+    with pytest.raises(TypeError):
+        class BrokenAgent(Agent):
+            __slots__ = ("id",)
+
+
+class Packet(RemoteClass):
+
+    size = RemoteClass.Field(0x0, ">H")
+    opcode = RemoteClass.Field(0x2, "!H")
+    flags = RemoteClass.Field(0x4, "<I")
+    values = RemoteClass.Field(0x8, "2i")
+    name = RemoteClass.Field(0x10, "4s")
+
+
+def test_format_to_dtype():
+    numpy = pytest.importorskip("numpy")
+    assert format_to_dtype("I") == numpy.dtype("=u4")
+    assert format_to_dtype("@I") == numpy.dtype("=u4")
+    assert format_to_dtype(">H") == numpy.dtype(">u2")
+    assert format_to_dtype("!H") == numpy.dtype(">u2")
+    assert format_to_dtype("<ff") == numpy.dtype(("<f4", 2))
+    assert format_to_dtype("3s") == numpy.dtype("S3")
+    with pytest.raises(ValueError):
+        format_to_dtype("Ih")
+
+
+def test_read_array():
+    pytest.importorskip("numpy")
+    memory = bytearray()
+    for i in range(4):
+        memory += struct.pack(">HH", 0x100 + i, 0xABCD) + struct.pack("<I2i4s", 1 << i, i, -i, b"pk%02d" % i)
+    proc = MemoryProcess(memory)
+
+    table = Packet.read_array(proc, BASE, 4)
+    assert proc.backend.reads == 1
+    # The big-endian fields are decoded as such, like by the struct formats.
+    assert table["size"].tolist() == [0x100, 0x101, 0x102, 0x103]
+    assert table["opcode"].tolist() == [0xABCD] * 4
+    assert table["flags"].tolist() == [1, 2, 4, 8]
+    assert table["values"][3].tolist() == [3, -3]
+    assert table["name"][2] == b"pk02"
+    snapshot = Packet(proc, BASE + 0x14).snapshot()
+    assert snapshot == (0x101, 0xABCD, 2, (1, -1), b"pk01")
+    assert table["size"][1] == snapshot.size
@@ -0,0 +1,175 @@
+from memlib.ring import SharedRing
+
+import mmap
+import shutil
+import subprocess
+import sys
+import time
+
+import pytest
+
+
+def test_put_get():
+    ring = SharedRing.create(bytearray(SharedRing.size_for(256)), record="II")
+    assert ring.capacity == 256
+    assert ring.put((1, 2), type=7)
+    assert ring.put(b"\x03\x00\x00\x00\x04\x00\x00\x00")
+    assert ring.get() == [(7, (1, 2)), (0, (3, 4))]
+    assert ring.get() == []
+    assert len(ring) == 0
+
+
+def test_attach():
+    buffer = bytearray(0x40 + SharedRing.size_for(64))
+    SharedRing.create(buffer, 0x40).put(b"abc", 1)
+    assert SharedRing(buffer, 0x40).get() == [(1, b"abc")]
+    with pytest.raises(ValueError):
+        SharedRing(buffer, 0)
+
+
+def test_wraparound():
+    ring = SharedRing.create(bytearray(SharedRing.size_for(128)))
+    sent = list()
+    received = list()
+    full = 0
+    # Records of 16 to 56 bytes never line up with the end of the data.
+    for i in range(200):
+        payload = bytes([i & 0xFF]) * (8 + 8 * (i % 6))
+        if not ring.put(payload, i):
+            full += 1
+            received += ring.get()
+            assert ring.put(payload, i)
+        sent.append((i, payload))
+        if i % 3 == 0:
+            received += ring.get(max_count=1)
+    received += ring.get()
+    assert received == sent
+    assert full and ring.dropped == full
+
+
+def test_drop_counting():
+    ring = SharedRing.create(bytearray(SharedRing.size_for(64)))
+    for i in range(4):
+        assert ring.put(bytes(8), i)      # 16 bytes each
+    assert not ring.put(bytes(8))
+    assert not ring.put(bytes(1))
+    assert ring.dropped == 2
+    assert [type for type, _ in ring.get(max_count=1)] == [0]
+    assert ring.put(bytes(8), 4)
+    assert [type for type, _ in ring.get()] == [1, 2, 3, 4]
+    with pytest.raises(ValueError):
+        ring.put(bytes(64))
+
+
+def test_get_waits():
+    ring = SharedRing.create(bytearray(SharedRing.size_for(64)))
+    start = time.monotonic()
+    assert ring.get(timeout=0.05) == []
+    assert time.monotonic() - start >= 0.05
+
+
+# A producer following the protocol of the SharedRing docstring, with a compare
+# and swap on head, run by many threads writing (thread, sequence) records.
+PRODUCER = r"""
+#include <fcntl.h>
+#include <pthread.h>
+#include <sched.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/mman.h>
+
+static uint8_t *ring;
+static uint32_t count;
+
+static int put(uint32_t type, const void *payload, uint32_t len)
+{
+    uint32_t capacity = *(uint32_t *)(ring + 0x04);
+    uint64_t *dropped = (uint64_t *)(ring + 0x08);
+    uint64_t *head = (uint64_t *)(ring + 0x40);
+    uint64_t *tail = (uint64_t *)(ring + 0x80);
+    uint8_t *data = ring + 0xC0;
+    uint64_t need = (8 + len + 7) & ~7ull, pos, pad;
+    uint8_t *record;
+
+    do {
+        pos = __atomic_load_n(head, __ATOMIC_ACQUIRE);
+        uint64_t off = pos & (capacity - 1);
+        pad = off + need > capacity ? capacity - off : 0;
+        if (pos + pad + need - __atomic_load_n(tail, __ATOMIC_ACQUIRE) > capacity) {
+            __atomic_fetch_add(dropped, 1, __ATOMIC_RELAXED);
+            return 0;
+        }
+    } while (!__atomic_compare_exchange_n(head, &pos, pos + pad + need, 0, __ATOMIC_ACQ_REL, __ATOMIC_ACQUIRE));
+
+    if (pad) {
+        record = data + (pos & (capacity - 1));
+        *(uint32_t *)(record + 4) = 0xFFFFFFFF;
+        __atomic_store_n((uint32_t *)record, (uint32_t)pad, __ATOMIC_RELEASE);
+    }
+    record = data + ((pos + pad) & (capacity - 1));
+    memcpy(record + 8, payload, len);
+    *(uint32_t *)(record + 4) = 1;
+    __atomic_store_n((uint32_t *)record, 8 + len, __ATOMIC_RELEASE);
+    return 1;
+}
+
+static void *produce(void *arg)
+{
+    uint32_t payload[2] = { (uint32_t)(uintptr_t)arg, 0 };
+    for (; payload[1] < count; payload[1]++) {
+        /* Every record is retried until it fits, the failures are counted as dropped. */
+        while (!put(1, payload, sizeof(payload)))
+            sched_yield();
+    }
+    return NULL;
+}
+
+int main(int argc, char **argv)
+{
+    int fd = open(argv[1], O_RDWR);
+    uint32_t threads = atoi(argv[2]);
+    pthread_t ids[64];
+
+    count = atoi(argv[3]);
+    ring = mmap(NULL, atoi(argv[4]), PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+    for (uint32_t i = 0; i < threads; i++)
+        pthread_create(&ids[i], NULL, produce, (void *)(uintptr_t)i);
+    for (uint32_t i = 0; i < threads; i++)
+        pthread_join(ids[i], NULL);
+    return 0;
+}
+"""
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux") or shutil.which("gcc") is None,
+    reason="Needs gcc and a Linux shared mapping.")
+def test_native_producers(tmp_path):
+    source = tmp_path / "producer.c"
+    source.write_text(PRODUCER)
+    binary = tmp_path / "producer"
+    subprocess.check_call(["gcc", "-O2", "-pthread", "-o", str(binary), str(source)])
+
+    threads, count = 4, 50000
+    size = SharedRing.size_for(0x10000)
+    path = tmp_path / "ring"
+    path.write_bytes(bytes(size))
+    with open(str(path), "r+b") as f:
+        data = mmap.mmap(f.fileno(), size)
+    ring = SharedRing.create(data, record="II")
+
+    producer = subprocess.Popen([str(binary), str(path), str(threads), str(count), str(size)])
+    expected = [0] * threads
+    received = 0
+    deadline = time.monotonic() + 60
+    while received < threads * count and time.monotonic() < deadline:
+        for type, (thread, sequence) in ring.get(timeout=0.1):
+            # The records of one thread are committed in order.
+            assert type == 1 and sequence == expected[thread]
+            expected[thread] += 1
+            received += 1
+    assert producer.wait(10) == 0
+    assert expected == [count] * threads
+    assert ring.get() == [] and len(ring) == 0
+    del ring
+    data.close()
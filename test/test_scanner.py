@@ -0,0 +1,319 @@
+from memlib import scanner, win32
+from memlib.linux import LinuxException
+from memlib.memory import MemoryRegion
+from memlib.pe import PEFormatError
+from memlib.scanner import (
+    ProcessScanner, RegionScanner, Signature, SignatureCache, compile_signatures,
+    iter_chunks, module_fingerprint, scan_buffer
+)
+
+import errno
+import hashlib
+import json
+import os
+import struct
+import random
+import threading
+
+import pytest
+
+
+def test_signature_parsing():
+    sig = Signature("56 8B F1 ?? ? 72 04", 3)
+    assert sig.size == 7 and sig.offset == 3
+    assert sig.segments == [(0, b"\x56\x8B\xF1"), (5, b"\x72\x04")]
+    assert sig.literals == [(0, 0x56), (1, 0x8B), (2, 0xF1), (5, 0x72), (6, 0x04)]
+    assert (sig.anchor_offset, sig.anchor) == (0, b"\x56\x8B\xF1")
+    assert str(sig) == "56 8B F1 ?? ?? 72 04"
+
+    sig = Signature(b"\x90\x90")
+    assert sig.segments == [(0, b"\x90\x90")] and str(sig) == "90 90"
+
+    with pytest.raises(ValueError):
+        Signature("?? ??")
+
+
+def test_signature_match():
+    sig = Signature("?? 8B ?? 04")
+    buffer = b"\x00\x55\x8B\x00\x04\x8B\x01\x04"
+    assert sig.match(buffer, 1)
+    assert not sig.match(buffer, 0)
+    assert not sig.match(buffer, 5)  # past the end
+    assert sig.search(buffer) == 1
+    assert sig.search(buffer, 2) == 4
+    assert sig.search(buffer, 5) == -1
+
+
+@pytest.fixture(params=["numpy", "find"])
+def engine(request, monkeypatch):
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(scanner, "numpy", None)
+    return request.param
+
+
+def test_scan_buffer(engine):
+    buffer = b"\xCC" * 16 + b"\x56\x8B\xF1\x12\x34\x72\x04" + b"\x8B" * 16 + b"\x11\x22"
+    signatures = compile_signatures({
+        "full": "56 8B F1 ?? ?? 72 04",
+        "tail": ("?? ?? 72 04", 2),
+        "short": "8B ?? 8B",
+        "start": "?? ?? CC",
+        "end": "8B 11 22",
+        "past_end": "22 ??",
+        "missing": "56 8B F1 ?? ?? 72 05",
+    })
+    # The index is the one of the first byte, the offset is added by the callers.
+    assert scan_buffer(buffer, signatures) == {
+        "full": 16, "tail": 19, "short": 23, "start": 0, "end": 38,
+    }
+
+
+@pytest.mark.parametrize("chunk_size", [0x100000, 0x1000, 7])
+def test_scan_buffer_random(engine, chunk_size):
+    # Checks the first match of many wildcard signatures against Signature.search,
+    # the matches of the small chunks straddle their ends.
+    rand = random.Random(1)
+    buffer = bytes(rand.choice(b"\x00\x8B\x48\x89\xE8\xC3\xCC\x05") for _ in range(0x10000))
+    signatures = dict()
+    for i in range(64):
+        size = rand.randrange(2, 10)
+        start = rand.randrange(len(buffer) - size)
+        tokens = ["%02X" % b if rand.random() < 0.6 else "??" for b in buffer[start:start + size]]
+        tokens[rand.randrange(size)] = "%02X" % rand.randrange(256)
+        signatures[i] = " ".join(tokens)
+    signatures = compile_signatures(signatures)
+    expected = dict()
+    for name, sig in signatures.items():
+        index = sig.search(buffer)
+        if index >= 0:
+            expected[name] = index
+    assert scan_buffer(buffer, signatures, chunk_size) == expected
+
+
+class FakeProcess(object):
+
+    def __init__(self, code):
+        self.code = code
+
+    def read(self, addr, fmt):
+        return self.code
+
+
+def operand(code, x64=False):
+    scan = ProcessScanner.__new__(ProcessScanner)
+    scan.sections = []
+    scan.x64 = x64
+    scan.proc = FakeProcess(bytes.fromhex(code) + bytes(16))
+    return scan.operand(0x1000)
+
+
+@pytest.mark.parametrize("code, x64, expected", [
+    ("E8 FB 0F 00 00", False, 0x2000),             # call rel32
+    ("EB 10", False, 0x1012),                      # jmp rel8
+    ("A1 00 10 40 00", False, 0x401000),           # mov eax, [moffs32]
+    ("8B 05 00 10 40 00", False, 0x401000),        # mov eax, [disp32]
+    ("8B 04 8D 00 10 40 00", False, 0x401000),     # mov eax, [ecx*4+disp32]
+    ("68 00 10 40 00", False, 0x401000),           # push imm32
+    ("48 8B 05 10 00 00 00", True, 0x1017),        # mov rax, [rip+0x10]
+    ("8B 04 25 00 10 40 00", True, 0x401000),      # mov eax, [disp32]
+    ("48 B8 00 10 40 00 01 00 00 00", True, 0x100401000),
+])
+def test_operand(code, x64, expected):
+    assert operand(code, x64) == expected
+
+
+@pytest.mark.parametrize("code, x64", [
+    ("8B 83 10 00 00 00", False),                  # mov eax, [ebx+0x10]
+    ("8B 84 24 10 00 00 00", False),               # mov eax, [esp+0x10]
+    ("8B 44 24 10", False),                        # mov eax, [esp+0x10]
+    ("48 8B 83 10 00 00 00", True),                # mov rax, [rbx+0x10]
+    ("89 C8", False),                              # mov eax, ecx
+])
+def test_operand_with_base(code, x64):
+    with pytest.raises(RuntimeError):
+        operand(code, x64)
+
+
+def region(base, size, protect=win32.PAGE_READWRITE):
+    return MemoryRegion(base, size, protect, win32.MEM_COMMIT, win32.MEM_PRIVATE)
+
+
+def test_iter_chunks():
+    regions = [region(0x1000, 0x2800), region(0x10000, 0x400)]
+    assert list(iter_chunks(regions, 0x1000)) == [
+        (0x1000, 0x1000), (0x2000, 0x1000), (0x3000, 0x800), (0x10000, 0x400),
+    ]
+    # Each chunk but the last of a region runs overlap bytes into the next one.
+    assert list(iter_chunks(regions, 0x1000, 0x10)) == [
+        (0x1000, 0x1010), (0x2000, 0x1010), (0x3000, 0x800), (0x10000, 0x400),
+    ]
+    # No chunk made only of the overlap of the previous one.
+    assert list(iter_chunks([region(0, 0x1008)], 0x1000, 0x10)) == [(0, 0x1008)]
+
+
+class RegionBackend(object):
+    """Serves reads from a dict of base -> bytes and records the reading threads."""
+
+    def __init__(self, memory, failing=()):
+        self.memory = memory
+        self.failing = failing
+        self.threads = set()
+
+    def read(self, addr, size):
+        self.threads.add(threading.get_ident())
+        if addr in self.failing:
+            raise LinuxException(errno.EFAULT)
+        for base, data in self.memory.items():
+            if base <= addr and addr + size <= base + len(data):
+                return data[addr - base:addr - base + size]
+        raise LinuxException(errno.EFAULT)
+
+
+class RegionProcess(object):
+    id = 1
+
+    def __init__(self, backend):
+        self.backend = backend
+
+
+def test_region_scan(engine):
+    rand = random.Random(2)
+    memory = {
+        0x10000: bytes(rand.randrange(0x80) for _ in range(0x4000)),
+        0x40000: bytes(rand.randrange(0x80) for _ in range(0x1000)),
+    }
+    # A match straddling the boundary of the first two chunks, one past the end of
+    # the second region's first chunk and a match in an unreadable region.
+    first = bytearray(memory[0x10000])
+    first[0xFFD:0x1003] = b"\xAA\xBB\xCC\xDD\xEE\xFF"
+    first[0x3FFC:] = b"\xF0\xF1\xF2\xF3"
+    memory[0x10000] = bytes(first)
+    memory[0x40000] = memory[0x40000][:0xFFE] + b"\xF0\xF1"
+    memory[0x80000] = b"\xFE\xFD" * 0x100
+
+    regions = [
+        region(0x10000, 0x4000), region(0x40000, 0x1000),
+        region(0x80000, 0x200), region(0x90000, 0x1000, win32.PAGE_NOACCESS),
+    ]
+    backend = RegionBackend(memory, failing=(0x80000,))
+    scan = RegionScanner(RegionProcess(backend), regions, chunk_size=0x1000, workers=4)
+    assert [r.base for r in scan.regions] == [0x10000, 0x40000, 0x80000]
+
+    assert scan.find_all({
+        "straddle": "AA BB ?? DD EE FF",
+        "offset": ("CC DD EE", 1),
+        "end": "F2 F3",
+        "second": "F0 F1",
+    }) == {"straddle": 0x10FFD, "offset": 0x10FFF + 1, "end": 0x13FFE, "second": 0x13FFC}
+    # The chunks were read by the worker threads of the pool.
+    assert backend.threads and threading.get_ident() not in backend.threads
+
+    with pytest.raises(RuntimeError):
+        scan.find("FE FD FE")
+
+
+def test_region_scan_propagates(engine):
+    class BrokenBackend(RegionBackend):
+        def read(self, addr, size):
+            raise ValueError("not a read failure")
+
+    scan = RegionScanner(RegionProcess(BrokenBackend({})), [region(0x1000, 0x1000)])
+    with pytest.raises(ValueError):
+        scan.find("90 90")
+
+
+class ImageModule(object):
+    name = "game.exe"
+
+    def __init__(self, base, size):
+        self.base = base
+        self.size = size
+
+    @property
+    def pe(self):
+        raise PEFormatError("Not parsed by these tests.")
+
+
+class ImageProcess(object):
+    """Maps an image at 0x400000 and records the reads."""
+    id = 1
+
+    def __init__(self, image):
+        self.image = bytearray(image)
+        self.reads = list()
+        self.main = ImageModule(0x400000, len(image))
+
+    def module(self, name=None):
+        return self.main
+
+    def read(self, addr, fmt):
+        self.reads.append(addr)
+        value = struct.unpack_from(fmt, self.image, addr - self.main.base)
+        return value[0] if len(value) == 1 else value
+
+    def page_info(self, addr):
+        return self.main.base + self.main.size - addr, win32.PAGE_EXECUTE_READ
+
+
+def build_image(timestamp, code):
+    image = bytearray(0x2000)
+    image[:2] = b"MZ"
+    struct.pack_into("<I", image, 0x3C, 0x80)
+    struct.pack_into("<I", image, 0x88, timestamp)
+    struct.pack_into("<I", image, 0xD8, 0x1234)
+    image[0x1100:0x1100 + len(code)] = code
+    return image
+
+
+def test_module_fingerprint():
+    proc = ImageProcess(build_image(0x5F000000, b""))
+    assert module_fingerprint(proc, proc.main) == "5f00000000001234"
+
+    proc = ImageProcess(b"\x7FELF" + bytes(0x1FFC))
+    assert module_fingerprint(proc, proc.main) == hashlib.sha1(proc.image[:0x1000]).hexdigest()
+
+
+def test_signature_cache(tmp_path):
+    path = str(tmp_path / "cache" / "signatures.json")
+    signatures = {"send": ("55 8B EC ?? 2C", 1), "recv": "53 56 57"}
+    proc = ImageProcess(build_image(1, b"\x55\x8B\xEC\x83\x2C\x53\x56\x57"))
+
+    with SignatureCache(path) as cache:
+        addrs = ProcessScanner(proc, cache).find_all(signatures)
+        assert addrs == {"send": 0x401101, "recv": 0x401105}
+        # Nothing is written before the cache is closed.
+        assert not os.path.exists(path)
+    with open(path) as f:
+        entries = json.load(f)
+    key = "game.exe|2000|0000000100001234|"
+    assert entries == {key: {"send": ["55 8B EC ?? 2C", 1, 0x1101], "recv": ["53 56 57", 0, 0x1105]}}
+    assert os.listdir(os.path.dirname(path)) == ["signatures.json"]
+
+    # A hit doesn't read the section.
+    proc.reads = list()
+    cache = SignatureCache(path)
+    assert ProcessScanner(proc, cache).find_all(signatures) == addrs
+    assert 0x401000 not in proc.reads
+    # A signature that isn't cached is scanned.
+    assert ProcessScanner(proc, cache).find("55 8B EC ?? 2C") == 0x401100
+    assert 0x401000 in proc.reads
+    cache.close()
+    # Without new results, the file isn't written again.
+    os.unlink(path)
+    cache.close()
+    assert not os.path.exists(path)
+    cache.flush()
+    assert not os.path.exists(path)
+    with open(path, "w") as f:
+        json.dump(entries, f)
+
+    # A rebuilt binary misses and its results replace the ones of the old build.
+    proc = ImageProcess(build_image(2, b"\x90\x55\x8B\xEC\x83\x2C\x53\x56\x57"))
+    with SignatureCache(path) as cache:
+        assert ProcessScanner(proc, cache).find_all(signatures) == {"send": 0x401102, "recv": 0x401106}
+        assert list(cache.entries) == ["game.exe|2000|0000000200001234|"]
+        cache.put("other.dll|1000|0|", "f", Signature("90"), 0x10)
+    with open(path) as f:
+        assert sorted(json.load(f)) == ["game.exe|2000|0000000200001234|", "other.dll|1000|0|"]
@@ -2,11 +2,15 @@ from memlib import *
 
 proc = Process.from_name('test.exe')
 mem = proc.mapshared(0x100)
-buf = (BYTE * 0x100).from_address(mem.base_local)
+buf = mem.data
 
 print(f'mem.base_local={hex(mem.base_local)}')
 print(f'mem.base_remote={hex(mem.base_remote)}')
 
+mem.pack_into('II', 0, 0xDEADBEEF, 0x1234)
+assert proc.read(mem.remote(0), 'II') == (0xDEADBEEF, 0x1234)
+assert mem.cast(DWORD, 4).value == 0x1234
+
 if __name__ == '__main__':
     import code
-    code.interact(local=locals())
\ No newline at end of file
+    code.interact(local=locals())
@@ -0,0 +1,96 @@
+from memlib.linux import LinuxException
+from memlib.snapshot import MemorySnapshot
+
+import errno
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+
+
+class Region(object):
+
+    def __init__(self, base, size):
+        self.base = base
+        self.size = size
+        self.readable = True
+
+
+class FakeProcess(object):
+
+    base = 0x1000
+
+    def __init__(self, size):
+        self.memory = bytearray(size)
+
+    def read_into(self, addr, buffer):
+        if not self.base <= addr < self.base + len(self.memory):
+            raise LinuxException(errno.EFAULT)
+        buffer[:] = self.memory[addr - self.base : addr - self.base + len(buffer)]
+
+
+@pytest.fixture
+def snapshots():
+    proc = FakeProcess(0x5000)
+    regions = [Region(0x1000, 0x5000)]
+    old = MemorySnapshot.capture(proc, regions)
+    proc.memory[0x3000 - proc.base] = 1
+    new = MemorySnapshot.capture(proc, regions)
+    yield new, old
+    new.close()
+    old.close()
+
+
+def test_changed_pages(snapshots):
+    new, old = snapshots
+    assert list(new.changed_pages(old)) == [0x3000]
+
+
+def test_compare_aligned(snapshots):
+    new, old = snapshots
+    assert list(new.compare(old, "i4")) == [0x3000]
+    assert list(new.compare(old, "i4", "increased")) == [0x3000]
+    assert not len(new.compare(old, "i4", "decreased"))
+
+
+def test_compare_unaligned_crosses_pages(snapshots):
+    new, old = snapshots
+    # Values starting at the end of the unchanged page before also changed.
+    assert list(new.compare(old, "i4", aligned=False)) == [0x2FFD, 0x2FFE, 0x2FFF, 0x3000]
+
+
+def test_unchanged(snapshots):
+    new, old = snapshots
+    assert new.unchanged_ranges(old) == [(0x1000, 0x2000), (0x4000, 0x2000)]
+    # The values of the unchanged pages are listed too.
+    unchanged = new.compare(old, "i4", "unchanged", aligned=False)
+    assert len(unchanged) == 0x5000 - 3 - 4
+    assert list(unchanged[0x1FFC:0x2001]) == [0x2FFC, 0x3001, 0x3002, 0x3003, 0x3004]
+    assert list(new.compare(old, "i4", "unchanged")) == [0x1000 + 4 * i for i in range(0x1400) if i != 0x800]
+    # Functions may select equal values, they look at every page too.
+    assert len(new.compare(old, "i4", lambda n, o: n == 0)) == 0x1400 - 1
+    pages = numpy.array([False, False, True, True, False])
+    found = numpy.concatenate(list(new.iter_compare(old, "B", "unchanged", pages=pages)))
+    assert list(found) == list(range(0x3001, 0x5000))
+
+
+def test_capture_chunks():
+    proc = FakeProcess(0x5000)
+    proc.memory[0x2100 - proc.base] = 1
+    regions = [Region(0x1000, 0x5000), Region(0x9000, 0x1000)]
+    # The scratch chunk has the rounded size, the reads of unmapped memory fail.
+    snapshot = MemorySnapshot.capture(proc, regions, chunk_size=0x1800, keep_data=False)
+    assert snapshot.valid.tolist() == [True] * 5 + [False]
+    full = MemorySnapshot.capture(proc, regions[:1])
+    assert snapshot.hashes[:5].tolist() == full.hashes.tolist()
+    assert snapshot.hashes[1] != snapshot.hashes[0] == snapshot.hashes[2]
+    full.close()
+
+
+def test_capture_errors():
+    class BrokenProcess(FakeProcess):
+        def read_into(self, addr, buffer):
+            raise ValueError("not a read failure")
+
+    with pytest.raises(ValueError):
+        MemorySnapshot.capture(BrokenProcess(0x1000), [Region(0x1000, 0x1000)])
@@ -0,0 +1,87 @@
+from memlib import win32
+from memlib.thread import ThreadRegistry
+
+import pytest
+
+
+class FakeProcess(object):
+    id = 1
+
+
+class FakeWin32(object):
+    """Opens the threads of ids, records the calls on the handles (id + 0x1000)."""
+
+    def __init__(self):
+        self.ids = list()
+        self.calls = list()
+        self.denied = set()
+
+    def OpenThread(self, access, inherit, id):
+        self.calls.append(("open", id))
+        return 0 if id in self.denied else id + 0x1000
+
+    def CloseHandle(self, handle):
+        self.calls.append(("close", handle - 0x1000))
+        return True
+
+    def SuspendThread(self, handle):
+        self.calls.append(("suspend", handle - 0x1000))
+        return 0xFFFFFFFF if handle - 0x1000 in self.denied else 0
+
+    def ResumeThread(self, handle):
+        self.calls.append(("resume", handle - 0x1000))
+        return 1
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    fake = FakeWin32()
+    for name in ("OpenThread", "CloseHandle", "SuspendThread", "ResumeThread"):
+        monkeypatch.setattr(win32, name, getattr(fake, name), raising=False)
+    monkeypatch.setattr(win32, "GetLastError", lambda: 5, raising=False)
+    monkeypatch.setattr(win32, "FormatMessage", lambda error: "Access is denied.")
+    monkeypatch.setattr(ThreadRegistry, "_snapshot", lambda registry: list(fake.ids))
+    return fake
+
+
+def test_refresh(fake):
+    registry = ThreadRegistry(FakeProcess())
+    fake.ids = [1, 2, 3]
+    first = registry.refresh()
+    assert [thread.id for thread in first] == [1, 2, 3]
+    assert fake.calls == [("open", 1), ("open", 2), ("open", 3)]
+
+    # Only the new threads are opened, the ones which exited are closed.
+    del fake.calls[:]
+    fake.ids = [2, 3, 4, 5]
+    fake.denied = {5}  # exited since the snapshot
+    threads = registry.refresh()
+    assert [thread.id for thread in threads] == [2, 3, 4]
+    assert threads[:2] == first[1:] and threads[0] is first[1]
+    del first, threads
+    assert sorted(fake.calls) == [("close", 1), ("open", 4), ("open", 5)]
+    assert len(registry) == 3 and 4 in registry and 1 not in registry
+
+    # A debugger keeps it up to date without snapshots.
+    del fake.calls[:]
+    registry.add(6, 0x1006)
+    assert registry.get(6).handle == 0x1006 and registry.get(2).id == 2
+    registry.remove(2)
+    assert fake.calls == [("close", 2)]
+    assert sorted(thread.id for thread in registry) == [3, 4, 6]
+
+
+def test_suspended(fake):
+    registry = ThreadRegistry(FakeProcess())
+    fake.ids = [1, 2, 3, 4]
+    registry.refresh()
+    fake.denied = {3}
+    del fake.calls[:]
+
+    with pytest.raises(ValueError):
+        with registry.suspended(exclude=2) as threads:
+            assert [thread.id for thread in threads] == [1, 4]
+            assert fake.calls == [("suspend", 1), ("suspend", 3), ("suspend", 4)]
+            raise ValueError()
+    # The threads are resumed even when the block raises, only the suspended ones.
+    assert fake.calls[3:] == [("resume", 1), ("resume", 4)]
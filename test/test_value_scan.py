@@ -0,0 +1,124 @@
+from memlib import MemoryRegion, Process
+
+import subprocess
+import struct
+import sys
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+
+if not sys.platform.startswith("linux"):
+    pytest.skip("Runs a child process with the Linux backend.", allow_module_level=True)
+
+# Maps 4 pages, prints their address and writes "<offset> <format> <value>" lines in them.
+CHILD = """
+import ctypes, mmap, struct, sys
+m = mmap.mmap(-1, 0x4000)
+print(ctypes.addressof(ctypes.c_char.from_buffer(m)), flush=True)
+for line in sys.stdin:
+    offset, fmt, value = line.split()
+    struct.pack_into(fmt, m, int(offset, 0), float(value) if fmt in 'fd' else int(value, 0))
+    print('ok', flush=True)
+"""
+
+
+class Child(object):
+
+    def __init__(self):
+        self.popen = subprocess.Popen([sys.executable, "-c", CHILD],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+        self.base = int(self.popen.stdout.readline())
+        self.proc = Process(self.popen.pid)
+        region = next(r for r in self.proc.regions() if r.base <= self.base < r.end)
+        self.regions = [MemoryRegion(self.base, 0x4000, region.protect, region.state, region.type)]
+
+    def write(self, offset, fmt, value):
+        self.popen.stdin.write("%d %s %r\n" % (offset, fmt, value))
+        self.popen.stdin.flush()
+        assert self.popen.stdout.readline() == "ok\n"
+
+    def close(self):
+        self.popen.stdin.close()
+        self.popen.wait()
+
+
+@pytest.fixture
+def child():
+    child = Child()
+    yield child
+    child.close()
+
+
+def offsets(child, scan):
+    return [int(addr) - child.base for addr in scan.addresses]
+
+
+def test_exact(child):
+    child.write(0x10, "i", 1234)
+    child.write(0x2000, "i", 1234)
+    scan = child.proc.scan_value(1234, "i4", child.regions)
+    assert offsets(child, scan) == [0x10, 0x2000]
+    assert list(scan.values) == [1234, 1234]
+
+    child.write(0x2000, "i", 1235)
+    assert scan.rescan(1234) == 1
+    assert offsets(child, scan) == [0x10]
+
+
+def test_unaligned(child):
+    # Crosses the first page boundary.
+    child.write(0xFFE, "i", 0x12345678)
+    assert not len(child.proc.scan_value(0x12345678, "i4", child.regions))
+    scan = child.proc.scan_value(0x12345678, "i4", child.regions, aligned=False)
+    assert offsets(child, scan) == [0xFFE]
+
+
+def test_tolerance(child):
+    child.write(0x100, "f", 3.14159)
+    child.write(0x104, "f", 3.5)
+    scan = child.proc.scan_value(3.14, "f4", child.regions, tolerance=0.01)
+    assert offsets(child, scan) == [0x100]
+
+
+def test_range(child):
+    child.write(0x300, "i", 550)
+    child.write(0x304, "i", 650)
+    scan = child.proc.scan_value((500, 600), "i4", child.regions)
+    assert offsets(child, scan) == [0x300]
+
+    child.write(0x300, "i", 540)
+    assert scan.rescan(op="decreased") == 1
+    child.write(0x300, "i", 700)
+    assert scan.rescan((500, 600)) == 0
+
+
+def test_unknown_changed(child):
+    scan = child.proc.scan_value(None, "i4", child.regions)
+    assert len(scan) == 0x1000
+    child.write(0x2004, "i", 7)
+    assert scan.rescan(op="changed") == 1
+    assert offsets(child, scan) == [0x2004]
+    assert scan.snapshot is None
+
+
+def test_unknown_unchanged(child):
+    scan = child.proc.scan_value(None, "i4", child.regions)
+    child.write(0x2004, "i", 7)
+    # The unchanged pages stay a mask, only the page that changed is listed.
+    assert scan.rescan(op="unchanged") == 0x1000 - 1
+    assert scan.snapshot is not None
+    assert len(scan.addresses) == 0x400 - 1
+
+    child.write(0x10, "i", 5)
+    child.write(0x2008, "i", 5)
+    assert scan.rescan(op="increased") == 2
+    assert offsets(child, scan) == [0x10, 0x2008]
+    assert scan.rescan(5) == 2
+
+
+def test_unknown_value(child):
+    scan = child.proc.scan_value(None, "i4", child.regions)
+    child.write(0x3000, "i", 42)
+    assert scan.rescan(42) == 1
+    assert offsets(child, scan) == [0x3000]
@@ -0,0 +1,99 @@
+from memlib import x86
+
+import struct
+
+import pytest
+
+
+def code(text):
+    return bytes.fromhex(text)
+
+
+@pytest.mark.parametrize("text, x64, length", [
+    ("55", False, 1),                               # push ebp
+    ("8B EC", False, 2),                            # mov ebp, esp
+    ("83 EC 10", False, 3),                         # sub esp, 0x10
+    ("81 EC 00 01 00 00", False, 6),                # sub esp, 0x100
+    ("8B 83 10 00 00 00", False, 6),                # mov eax, [ebx+0x10]
+    ("8B 44 24 08", False, 4),                      # mov eax, [esp+8]
+    ("8B 04 8D 00 10 40 00", False, 7),             # mov eax, [ecx*4+0x401000]
+    ("66 B8 34 12", False, 4),                      # mov ax, 0x1234
+    ("F7 C1 00 00 00 01", False, 6),                # test ecx, 0x1000000
+    ("F7 D8", False, 2),                            # neg eax
+    ("0F B6 C0", False, 3),                         # movzx eax, al
+    ("0F 1F 44 00 00", False, 5),                   # nop dword [eax+eax]
+    ("64 A1 30 00 00 00", False, 6),                # mov eax, fs:[0x30]
+    ("48 89 5C 24 08", True, 5),                    # mov [rsp+8], rbx
+    ("48 83 EC 28", True, 4),                       # sub rsp, 0x28
+    ("48 B8 88 77 66 55 44 33 22 11", True, 10),    # mov rax, imm64
+    ("48 8B 05 10 00 00 00", True, 7),              # mov rax, [rip+0x10]
+    ("41 FF E3", True, 3),                          # jmp r11
+    ("C2 08 00", False, 3),                         # ret 8
+])
+def test_decode_length(text, x64, length):
+    assert x86.decode(code(text), 0, 0x1000, x64).length == length
+
+
+def test_decode_operands():
+    insn = x86.decode(code("E8 FB 0F 00 00"), 0, 0x1000)
+    assert insn.branch == 0x2000 and insn.imm == (1, 4)
+
+    insn = x86.decode(code("0F 84 FA 0F 00 00"), 0, 0x1000)
+    assert insn.opcode == 0x0F84 and insn.branch == 0x2000
+
+    insn = x86.decode(code("EB FE"), 0, 0x1000)
+    assert insn.branch == 0x1000 and insn.imm == (1, 1)
+
+    data = code("90 48 8B 05 10 00 00 00")
+    insn = x86.decode(data, 1, 0x1001, True)
+    assert insn.rip_relative and insn.disp == (3, 4) and insn.modrm == 2
+    assert x86.rip_target(insn, data, 1) == 0x1018
+
+    # Without REX/x64, 8B 05 is an absolute [disp32].
+    assert not x86.decode(code("8B 05 00 10 40 00"), 0, 0x1000).rip_relative
+
+
+def test_decode_truncated():
+    with pytest.raises(x86.DecodeError):
+        x86.decode(code("8B 83 10 00"), 0, 0x1000)
+
+
+def test_relocate_rel32():
+    # call 0x2000; push ebp; mov ebp, esp
+    original = code("E8 FB 0F 00 00 55 8B EC")
+    relocated, length = x86.relocate(original, 0x1000, 0x5000, 6)
+    assert length == 6
+    rel, = struct.unpack_from("<i", relocated, 1)
+    assert 0x5000 + 5 + rel == 0x2000
+    assert relocated[5:] == code("55")
+
+
+def test_relocate_rel32_wraps_on_x86():
+    original = code("E9 00 00 00 00")       # jmp 0x10005
+    relocated, _ = x86.relocate(original, 0x10000, 0xFFFF0000, 5)
+    rel, = struct.unpack_from("<i", relocated, 1)
+    assert (0xFFFF0005 + rel) % 2 ** 32 == 0x10005
+
+
+def test_relocate_rip_relative():
+    # mov rax, [rip+0x10]; sub rsp, 0x28
+    original = code("48 8B 05 10 00 00 00 48 83 EC 28")
+    relocated, length = x86.relocate(original, 0x140001000, 0x140100000, 5, x64=True)
+    assert length == 7
+    insn = x86.decode(relocated, 0, 0x140100000, True)
+    assert x86.rip_target(insn, relocated) == 0x140001017
+
+
+def test_relocate_rejects_short_branch():
+    with pytest.raises(x86.DecodeError, match="short branch"):
+        x86.relocate(code("74 10 55 8B EC"), 0x1000, 0x5000, 5)
+
+
+def test_relocate_rejects_out_of_reach():
+    with pytest.raises(x86.DecodeError, match="out of reach"):
+        x86.relocate(code("48 8B 05 10 00 00 00"), 0x140001000, 0x7FF000000000, 5, x64=True)
+
+
+def test_relocate_rejects_short_function():
+    with pytest.raises(x86.DecodeError, match="too short"):
+        x86.relocate(code("33 C0 C3 CC CC"), 0x1000, 0x5000, 5)